@@ -1,12 +1,29 @@
 from CAencrypt.util import *
 from CAencrypt.rand import *
 from CAencrypt.enc  import *
+from CAencrypt.writer import *
+from CAencrypt.checkpoint import *
+from CAencrypt.stats import *
+from CAencrypt.avalanche import *
+from CAencrypt.keyring import *
+from CAencrypt.plan import *
+from CAencrypt.container import *
+from CAencrypt.progress import *
+from CAencrypt.cluster import *
+from CAencrypt.frames import *
+from CAencrypt.rekey import *
+from CAencrypt.cache import *
+from CAencrypt.channels import *
+from CAencrypt.compress import *
+from CAencrypt.memprof import *
 
 import argparse
 from argparse import RawTextHelpFormatter
 
 from os.path import exists
+import sys
 import time
+import signal
 
 prog_description = """
 
@@ -36,6 +53,11 @@ parser = argparse.ArgumentParser(prog="CA Encrypt/Decrypt",\
 # General arguments
 parser.add_argument("-f","--keyFile-name",default="key.shared",type=str,\
                     help="The filename of the shared key, default 'key.shared'.")
+parser.add_argument("--key-id",default=None,type=str,\
+                    help="Use the key with this ID in the --keyring file instead of the -f keyfile.\n"+\
+                    "With -G the generated key is added to the keyring under this ID.")
+parser.add_argument("--keyring",default="keys.ring",type=str,\
+                    help="The filename of the keyring used with --key-id, default 'keys.ring'.")
 
 # Arguments for shared key generation
 parser.add_argument("-G","--Gen",action="store_true",\
@@ -46,20 +68,185 @@ parser.add_argument("-T","--T",default=5,type=int,\
                     help="The number of CA steps to take for encryption/decryption (default 5).")
 parser.add_argument("-N","--N",default=-1,type=int,\
                     help="The seed to use for the noise parameter, -ve for random.")
+parser.add_argument("--forward-enc",action="store_true",\
+                    help="Generate a key that encrypts with the cheap forwards CA steps, and decrypts\n"+\
+                    "with backwards steps (recorded in the key).")
+parser.add_argument("--noise-gen",default="EQaDG",type=str,choices=["EQaDG","philox"],\
+                    help="The generator of the noise XORed with the message (recorded in the key),\n"+\
+                    "default EQaDG. philox is a counter based generator whose chunks of noise\n"+\
+                    "can be generated in parallel, see --noise-workers.")
+parser.add_argument("--fixed-boundary",action="store_true",\
+                    help="Generate a key whose CA has a fixed boundary (recorded in the key) rather than\n"+\
+                    "a periodic one, the cells before the first cell being a constant derived from\n"+\
+                    "the key. Each backwards encryption step is then a single pass with no guessing,\n"+\
+                    "so encryption costs about the same as decryption. As nothing wraps around, each\n"+\
+                    "step only spreads a change towards the end of the message, so every other step\n"+\
+                    "is mirrored to spread changes towards the start too. Use at least 2 steps (-T),\n"+\
+                    "with a single step the last cells of the message get almost no diffusion.\n"+\
+                    "Cannot be used with --forward-enc.")
+parser.add_argument("--channel-layout",default="interleaved",type=str,choices=["interleaved","planar"],\
+                    help="How the channels of RGB, RGBA and greyscale with alpha images are encrypted\n"+\
+                    "(recorded in the key), default interleaved. interleaved encrypts all the\n"+\
+                    "channels as one ring, planar encrypts each channel plane as its own ring with\n"+\
+                    "its own noise seed derived from -N, see --channel-workers.")
+parser.add_argument("--noise-workers",default=1,type=int,\
+                    help="Number of threads used to generate the noise with a counter based noise\n"+\
+                    "generator, default 1.")
 
 # General arguments
 parser.add_argument("-V","--verbose",action="store_true",\
                     help="Use a verbose output.")
 
 # Arguments for the input type
+parser.add_argument("-P","--pipe",action="store_true",\
+                    help="Read raw bytes to encrypt/decrypt from stdin and write the result to stdout.\n"+\
+                    "All other output is written to stderr.")
 parser.add_argument("-B","--BW",default="img.png",type=str,\
-                    help="Use an input image from the given input file, default 'img.png'.")
+                    help="Use an input image from the given input file, default 'img.png'. The\n"+\
+                    "input may also be a packed container (see --out-format).")
 
 # Output file(s)
 parser.add_argument("-O","--output-file",default="DEFAULT",type=str,\
-                    help="output filename, default either encrypted.png or decrypted.png.")
+                    help="output filename, default either encrypted.png or decrypted.png (.cab for packed output).")
+parser.add_argument("--out-format",default="auto",type=str,choices=["auto","png","packed"],\
+                    help="The format of the output, a png image or a packed container (raw packed\n"+\
+                    "bits with a small header, much faster to write and read than a png). The\n"+\
+                    "default auto uses the format of the -O output file extension (.png or .cab),\n"+\
+                    "or otherwise the format of the input.")
+parser.add_argument("--compress",default=None,type=str,choices=list(compressCodecs),\
+                    help="Losslessly compress the image with the given codec before it is XORed with\n"+\
+                    "noise and encrypted, so the steps are taken on a shorter ring. The codec is\n"+\
+                    "recorded in the output, which must be a packed container, and the message is\n"+\
+                    "decompressed after decryption. The compressed message is a single ring\n"+\
+                    "whatever the channel layout of the key.")
 parser.add_argument("-S","--verbose-save",action="store_true",\
                     help="Save after every encryption/decryption step.")
+parser.add_argument("--snap-format",default="png",type=str,choices=["png","packed","npy"],\
+                    help="Format of the per-step saves with -S, one of png, packed (raw packed bits)\n"+\
+                    "or npy (packed bits as a numpy array), default png.")
+parser.add_argument("--snap-queue",default=4,type=int,\
+                    help="Maximum number of per-step saves with -S waiting to be written, default 4.")
+
+# Checkpointing of long runs
+parser.add_argument("--checkpoint",default="",type=str,\
+                    help="Periodically checkpoint encryption/decryption steps to the given file.")
+parser.add_argument("--resume",action="store_true",\
+                    help="Resume encryption/decryption from the last step saved in the --checkpoint file.")
+parser.add_argument("--checkpoint-overhead",default=0.03,type=float,\
+                    help="Maximum fraction of the run time spent writing checkpoints, default 0.03.")
+
+# Randomness statistics of (encrypted) files
+parser.add_argument("--stats",default=None,type=str,nargs="+",\
+                    help="Print randomness statistics of the given files (png images, packed containers,\n"+\
+                    "whose header and step hints are left out, or raw bytes), treated as one\n"+\
+                    "concatenated stream. Raw files and containers are streamed, png images are\n"+\
+                    "decoded whole.")
+parser.add_argument("--stats-workers",default=1,type=int,\
+                    help="Number of worker processes used for --stats, default 1.")
+parser.add_argument("--stats-block",default=128,type=int,\
+                    help="Block size in bits for the --stats block frequency test, default 128.")
+
+# Avalanche/diffusion measurements
+parser.add_argument("--avalanche",default=None,type=str,choices=["plain","rule","seed"],\
+                    help="Measure the Hamming distance between encryptions with a single bit of the\n"+\
+                    "plaintext, key rules or noise seed flipped.")
+parser.add_argument("--aval-k",default=[5,7],type=int,nargs="+",\
+                    help="Neighbourhood sizes for --avalanche, default 5 7.")
+parser.add_argument("--aval-T",default=[1,2,3,5],type=int,nargs="+",\
+                    help="Numbers of steps for --avalanche, default 1 2 3 5.")
+parser.add_argument("--aval-N",default=[4096],type=int,nargs="+",\
+                    help="Message lengths in bits for --avalanche, default 4096.")
+parser.add_argument("--aval-trials",default=32,type=int,\
+                    help="Number of trials for each k, T and N with --avalanche, default 32.")
+parser.add_argument("--aval-workers",default=1,type=int,\
+                    help="Number of worker processes used for --avalanche, default 1.")
+parser.add_argument("--aval-keys",default=["periodic"],type=str,nargs="+",\
+                    choices=list(avalancheKeys),\
+                    help="The kinds of key compared with --avalanche, periodic (the default), fixed (a\n"+\
+                    "fixed boundary, see --fixed-boundary) and forward (see --forward-enc), each with\n"+\
+                    "the --noise-gen noise generator. Each is encrypted with the plan chosen by the\n"+\
+                    "planner, see --mem-budget and --plan-cache.")
+parser.add_argument("--aval-target",default=None,type=float,\
+                    help="Report the cheapest k, T, N and kind of key (by the planner's estimate of the\n"+\
+                    "encryption time) whose mean fraction of flipped bits is at least this value\n"+\
+                    "with --avalanche.")
+
+# Execution planning
+parser.add_argument("--plan",action="store_true",\
+                    help="Print the execution plans chosen for encrypting and decrypting the -B image\n"+\
+                    "(or --plan-N cells) with the key, with their time and memory estimates.")
+parser.add_argument("--plan-N",default=None,type=int,\
+                    help="The number of cells to plan for with --plan, instead of the -B image size.")
+parser.add_argument("--auto-plan",action="store_true",\
+                    help="Encrypt/decrypt with the execution plan chosen by the planner.")
+parser.add_argument("--mem-budget",default=None,type=float,\
+                    help="The memory budget in MB for --plan, --auto-plan and --avalanche, default\n"+\
+                    "unlimited.")
+parser.add_argument("--mem-report",default=None,type=str,\
+                    help="Trace the memory of encrypting/decrypting a single image, writing the peak\n"+\
+                    "traced memory, resident set size and top allocation sites of each phase\n"+\
+                    "(decode, noise, each step, encode) to the given JSON file. Tracing slows the run.")
+parser.add_argument("--plan-cache",default=defaultCache,type=str,\
+                    help="The file the planner calibration is cached in, default\n"+\
+                    "'"+defaultCache+"'.")
+parser.add_argument("--recalibrate",action="store_true",\
+                    help="Rerun the planner calibration benchmarks with --plan, replacing the cache.")
+
+# Progress reports
+parser.add_argument("--progress",default=None,type=float,\
+                    help="Report the progress of the encryption/decryption steps (with an estimate\n"+\
+                    "of the time remaining) to stderr every given number of seconds. SIGINT or\n"+\
+                    "SIGTERM stop encryption/decryption cleanly, writing no output (but saving a\n"+\
+                    "checkpoint of the completed steps with --checkpoint).")
+
+# Cluster mode
+parser.add_argument("--cluster",default=None,type=str,nargs="+",\
+                    help="Take the forwards steps (decryption, or encryption with a --forward-enc\n"+\
+                    "key) on a cluster of workers at the given host:port addresses, each stepping\n"+\
+                    "a contiguous segment of the image and exchanging only the (k-1)/2 cells at\n"+\
+                    "the ends of the segments between steps. Cannot be used with -P, -S or\n"+\
+                    "--checkpoint.")
+parser.add_argument("--cluster-worker",default=None,type=str,\
+                    help="Run a cluster worker listening on the given host:port.")
+
+# Multi-frame images
+parser.add_argument("--frame-workers",default=1,type=int,\
+                    help="Number of worker processes encrypting/decrypting the frames of a multi-frame\n"+\
+                    "input, i.e. an image with several frames (e.g. an animated gif or multi-page\n"+\
+                    "tiff) or a directory of frames. Each frame is encrypted with its own noise seed\n"+\
+                    "derived from -N and the frame index. The output is a directory of frames, or a\n"+\
+                    "multi-page tiff if -O ends in .tif or .tiff.")
+parser.add_argument("--channel-workers",default=1,type=int,\
+                    help="Number of worker processes encrypting/decrypting the channel planes of an\n"+\
+                    "image with a key with --channel-layout planar, default 1.")
+
+# Result cache
+parser.add_argument("--result-cache",default=None,type=str,nargs="?",const=defaultResultCache,\
+                    help="Cache the results of encrypting images in the given directory (default\n"+\
+                    "'"+defaultResultCache+"'), so encrypting the same image\n"+\
+                    "with the same key and noise seed again reads the result from the cache. Not\n"+\
+                    "used with -S or --resume.")
+parser.add_argument("--result-cache-size",default=defaultResultCacheSize/2**20,type=float,\
+                    help="The size limit of the result cache in MB, the least recently used results\n"+\
+                    "are removed beyond it. Default "+str(defaultResultCacheSize//2**20)+" MB.")
+
+# Re-keying
+parser.add_argument("--rekey",default=None,type=str,nargs="+",\
+                    help="Re-encrypt the given encrypted files (images or packed containers) from the\n"+\
+                    "-f (or --key-id) key and -N noise seed to the --new-keyFile-name (or\n"+\
+                    "--new-key-id) key and --new-N noise seed, decrypting and encrypting in memory.\n"+\
+                    "The output is saved under the same names in --rekey-dir.")
+parser.add_argument("--new-keyFile-name",default=None,type=str,\
+                    help="The filename of the new key used with --rekey.")
+parser.add_argument("--new-key-id",default=None,type=str,\
+                    help="Use the key with this ID in the --keyring file as the new key of --rekey.")
+parser.add_argument("--new-N",default=-1,type=int,\
+                    help="The new noise seed used with --rekey, a random seed if not given.")
+parser.add_argument("--rekey-dir",default="rekeyed",type=str,\
+                    help="The directory the files re-encrypted with --rekey are saved to, default\n"+\
+                    "'rekeyed'.")
+parser.add_argument("--rekey-workers",default=1,type=int,\
+                    help="Number of worker processes each re-encrypting one file at a time with --rekey.")
 
 # Options to encrypt or decrypt
 parser.add_argument("-E","--Enc",action="store_true",\
@@ -84,6 +271,44 @@ if __name__ == "__main__":
         EXIT("Cannot have -G and -D flags set")
     elif args.Enc and args.Dec:
         EXIT("Cannot have -E and -D flags set")
+    if args.rekey and (args.Gen or args.Enc or args.Dec):
+        EXIT("Cannot have --rekey with -G, -E or -D flags set")
+    if args.resume and not args.checkpoint:
+        EXIT("--resume requires the --checkpoint file to resume from")
+    memBudget = None
+    if args.mem_budget is not None:
+        if args.mem_budget<=0:
+            EXIT("Memory budget must be positive")
+        memBudget = int(args.mem_budget*2**20)
+    if args.progress is not None and args.progress<0:
+        EXIT("Progress interval must not be negative")
+    if args.cluster and (args.pipe or args.verbose_save or args.checkpoint):
+        EXIT("--cluster cannot be used with -P, -S or --checkpoint")
+    if args.frame_workers<1:
+        EXIT("Number of frame workers must be at least 1")
+    if args.channel_workers<1:
+        EXIT("Number of channel workers must be at least 1")
+    multiFrame = (args.Enc or args.Dec) and not args.pipe and isMultiFrame(args.BW)
+    if multiFrame and (args.checkpoint or args.verbose_save or args.cluster):
+        EXIT("Multi-frame input cannot be used with -S, --checkpoint or --cluster")
+    if args.compress and (args.pipe or args.verbose_save or multiFrame):
+        EXIT("--compress cannot be used with -P, -S or multi-frame input")
+    if args.mem_report and (not (args.Enc or args.Dec) or args.pipe or multiFrame):
+        EXIT("--mem-report can only be used encrypting or decrypting a single image")
+
+    # Trace the memory of each phase of the run if requested
+    prof = memoryProfiler(enabled=args.mem_report is not None)
+
+    # Report the progress of the encryption/decryption steps, and cancel them cleanly on
+    # SIGINT or SIGTERM
+    token = cancelToken()
+    if args.progress is not None:
+        progress = progressMonitor(interval=args.progress,token=token)
+    else:
+        progress = progressMonitor(callback=lambda report: None,interval=float("inf"),token=token)
+    if args.Enc or args.Dec or args.rekey:
+        signal.signal(signal.SIGINT,lambda signum, frame: token.cancel())
+        signal.signal(signal.SIGTERM,lambda signum, frame: token.cancel())
     
 
     if (args.Gen):
@@ -104,8 +329,25 @@ if __name__ == "__main__":
         # Generate a valid ruleset
         C.genRulesLeftReversible()
 
+        # Record the direction of the encryption steps in the key
+        if args.forward_enc:
+            C.setEncDir("forward")
+
+        # Record the noise generator in the key
+        C.setNoiseGen(args.noise_gen)
+
+        # Record the boundary of the CA in the key
+        if args.fixed_boundary:
+            C.setBoundary("fixed")
+
+        # Record how the channels of multi-channel images are encrypted in the key
+        C.setChannelLayout(args.channel_layout)
+
         # And save the output
-        C.saveKey(args.keyFile_name)
+        if args.key_id is not None:
+            keyring(args.keyring).add(args.key_id,C)
+        else:
+            C.saveKey(args.keyFile_name)
 
 
     elif (args.Enc):
@@ -114,9 +356,15 @@ if __name__ == "__main__":
 
         # Start by initialising a CA
         C = CA()
+        if args.noise_workers<1:
+            EXIT("Number of noise workers must be at least 1")
+        C.noiseWorkers = args.noise_workers
 
         # Read the input file
-        C.readKey(args.keyFile_name)
+        if args.key_id is not None:
+            keyring(args.keyring).get(args.key_id,C)
+        else:
+            C.readKey(args.keyFile_name)
         
         # Set or generate the noise seed
         if args.N>0:
@@ -126,7 +374,46 @@ if __name__ == "__main__":
         else:
             EXIT("Noise seed cannot be 0")
         
-        if args.BW:
+        if args.pipe:
+
+            # Encrypt raw bytes from stdin to stdout
+            data = sys.stdin.buffer.read()
+            if args.verbose:
+                print("Read "+str(len(data))+" bytes from stdin",file=sys.stderr)
+            if args.auto_plan:
+                autoPlan(C,8*len(data),"enc",memBudget,args.plan_cache)
+            try:
+                out = C.encryptBytes(data,progress=progress)
+            except CAcancelled as e:
+                EXIT("Encryption cancelled after "+str(e.step)+" steps, no output written")
+            sys.stdout.buffer.write(out)
+            sys.stdout.buffer.flush()
+            print("    = random noise seed "+str(C.noiseSeed),file=sys.stderr)
+
+        elif multiFrame:
+
+            # Encrypt each frame on a pool of workers, each with its own noise seed
+            if args.output_file == "DEFAULT":
+                outfile = "encrypted"
+            else:
+                outfile = args.output_file
+            fmt = "png" if args.out_format == "auto" else args.out_format
+            if args.verbose:
+                print("Attempting to encrypt the "+str(numFrames(args.BW))+" frames of "+args.BW)
+
+            S = frameSink(outfile,fmt,C.k,C.numSteps)
+            for binArr, d, hints in mapFrames(C,"enc",readFrames(args.BW),C.noiseSeed,args.frame_workers):
+                S.write(binArr,d,hints)
+                if token.cancelled():
+                    S.close()
+                    EXIT("Encryption cancelled after "+str(S.count)+" frames")
+            S.close()
+
+            if args.verbose:
+                print("Save of "+str(S.count)+" encrypted frames to '"+outfile+"' successful")
+            print("    = random noise seed "+str(C.noiseSeed))
+
+        elif args.BW:
 
             if args.verbose:
                 print("Attempting to encrypt the greyscale image "+args.BW)
@@ -135,52 +422,135 @@ if __name__ == "__main__":
             if not exists(args.BW):
                 EXIT("Input black and white image '"+args.BW+"' does not exist.")
 
-            # Read the input image and its dimensions and set the array in the CA class
-            I, d = readBWImage2BinArr(args.BW)
-            C.setBinEndVec(I.flatten())
+            # Read the input image (or packed container) and its dimensions
+            prof.begin("decode")
+            I, d, _, inFormat, _ = readCipherInput(args.BW)
+            outFormat = chooseOutputFormat(args.out_format,"packed" if args.compress else inFormat,\
+                                           None if args.output_file == "DEFAULT" else args.output_file)
+
+            # Compress the image before it is encrypted, the codec being recorded in the output
+            if args.compress:
+                if outFormat != "packed":
+                    EXIT("Output of --compress must be a packed container")
+                n = len(I)
+                I = compressBinArr(I,args.compress)
+                if len(I)<C.k:
+                    EXIT("Compressed image is smaller than the neighbourhood size")
+                if args.verbose:
+                    print("Compressed image with "+args.compress+" from "+str(n//8)+" to "+\
+                          str(len(I)//8)+" bytes")
+
+            # Encrypt each channel plane as its own ring for keys with a planar channel layout
+            planar = C.channelLayout == "planar" and numChannels(d)>1 and not args.compress
+            if planar and (args.checkpoint or args.verbose_save or args.cluster):
+                EXIT("Images with several channels cannot be encrypted with -S, --checkpoint or "+\
+                     "--cluster by a key with a planar channel layout")
             
             if args.verbose:
                 print("Loaded image "+args.BW)
 
-            # XOR final encrypted image with noise
-            C.XORendArr()
+            if args.auto_plan:
+                autoPlan(C,len(I),"enc",memBudget,args.plan_cache,verbose=args.verbose)
+
+            # Look up the result of an earlier encryption of the same image with the same key and seed
+            cache = None
+            cached = None
+            if args.result_cache and not args.resume and not args.verbose_save:
+                cache = resultCache(args.result_cache,int(args.result_cache_size*2**20))
+                cacheKey = cache.digest(C,"enc",I,d)
+                cached = cache.get(cacheKey)
+
+            firstStep = 0
+            if args.resume:
+                # Continue from the checkpointed state, which has already been XORed with noise
+                firstStep, seed, state, hints = readCheckpoint(args.checkpoint,"enc",C.keyFingerprint())
+                if len(state) != len(I):
+                    EXIT("Checkpoint '"+args.checkpoint+"' was not written for image "+args.BW)
+                C.setNoiseSeed(seed)
+                C.setEncArr(state,xor=False)
+                C.stepHints = hints
+                if args.verbose:
+                    print("Resuming from checkpoint '"+args.checkpoint+"' after "+str(firstStep)+" steps")
+            elif not args.cluster and not planar and cached is None:
+                # Set the image to encrypt and XOR with noise
+                prof.begin("noise")
+                C.setEncArr(I,copy=False)
                 
-            if args.verbose:
+            if args.verbose and cached is None:
                 print("XORed input array with random noise generated with seed "+str(C.noiseSeed))
                 print("Attempting "+str(C.numSteps)+" encryption steps with k="+str(C.k))
+                if C.encDir == "forward":
+                    print("Using forwards CA steps for encryption")
                 if args.verbose_save:
                     print("Also saving output image after each encryption step")
+
+            # Checkpoint the encryption steps if requested
+            ck = None
+            if args.checkpoint:
+                ck = checkpointer(args.checkpoint,"enc",C.keyFingerprint(),C.noiseSeed,C.numSteps,\
+                                  maxOverhead=args.checkpoint_overhead)
                 
-            # Perform the encryption steps
+            # Save after every encryption step if requested, with the saves written in the background
+            W = None
+            saveStep = None
             if args.verbose_save:
-                # Save after every encryption step
-                C.CAts = C.end # Needed as single step only works with the work array C.CAts
-                for i in range(C.numSteps):
-                    if args.verbose:
-                        t = time.time()
-                    C.singleCAstepReverseL()
-                    saveBinArr2BWImage("enc"+str(i+1)+".png",C.CAts,d)
-                    if args.verbose:
-                        print("    + encryption step : "+str(i+1),\
-                              " took : "+str('%.3f'%(time.time()-t))+" seconds")
-                # Needed as single step only works with the work array C.CAts
-                C.start = C.CAts
-            else:
-                # Do not save after every encryption step
-                if args.verbose:
-                    C.CAstepsReverse(numSteps=C.numSteps,verbose=True)
+                W = snapshotWriter(fmt=args.snap_format,maxQueue=args.snap_queue)
+                saveStep = lambda i, A : W.submit("enc"+str(i)+W.ext,A,d)
+
+            # Perform the encryption steps
+            prof.begin("steps" if cached is not None or args.cluster or planar else "step "+str(firstStep+1))
+            try:
+                if cached is not None:
+                    encArr, hints = cached
+                elif args.cluster:
+                    # The noise and forwards steps are taken by the cluster workers
+                    C.setBinEndVec(clusterEncrypt(args.cluster,C,I,progress=progress),copy=False)
+                elif planar:
+                    encArr, hints = cryptImage(C,"enc",I,d,workers=args.channel_workers,progress=progress)
                 else:
-                    C.CAstepsReverse(numSteps=C.numSteps,verbose=False)
+                    C.encSteps(numSteps=C.numSteps,verbose=args.verbose,firstStep=firstStep,checkpoint=ck,\
+                               callback=prof.stepCallback(C.numSteps,saveStep),progress=progress)
+            except CAcancelled as e:
+                if W is not None:
+                    W.close()
+                # The state is that after the completed steps, so can be resumed from
+                if ck is not None:
+                    ck.save(e.step,C.CAts,C.stepHints)
+                    EXIT("Encryption cancelled after "+str(e.step)+" steps, no output written, "+\
+                         "checkpoint saved to '"+args.checkpoint+"'")
+                EXIT("Encryption cancelled after "+str(e.step)+" steps, no output written")
+            if W is not None:
+                W.close()
+
+            prof.begin("encode")
+            if cached is None:
+                if not planar:
+                    encArr = C.getEncArr()
+                    hints = None
+                    if C.encDir == "forward":
+                        hints = C.getMaskedHints()
+                if cache is not None:
+                    cache.put(cacheKey,encArr,d,hints,C.k,C.numSteps)
+            if cache is not None:
+                totals = cache.totals()
+                if args.verbose:
+                    print("Result cache "+("hit" if cached is not None else "miss")+", "+\
+                          ", ".join([str(totals[name])+" "+name for name in resultCache.statNames])+\
+                          " in total")
 
-            if args.verbose:
-                print("Encryption successful, saving output as encrypted.png")
-            
-            # Then save the output image
+            # Then save the output, along with the step hints for forwards encryption
             if args.output_file == "DEFAULT":
-                outfile = "encrypted.png"
+                outfile = "encrypted"+outputFormats[outFormat]
             else:
                 outfile = args.output_file
-            saveBinArr2BWImage(outfile,C.start,d)
+            if args.verbose:
+                print("Encryption successful, saving output as "+outfile)
+            saveCipherOutput(outfile,encArr,d,outFormat,C.k,C.numSteps,hints,args.compress)
+            prof.save(args.mem_report)
+
+            # The run is complete so the checkpoint is no longer needed
+            if ck is not None:
+                ck.remove()
 
             # And print info about the output image/encryption
             if args.verbose:
@@ -199,9 +569,15 @@ if __name__ == "__main__":
         
         # Start by initialising a CA
         C = CA()
+        if args.noise_workers<1:
+            EXIT("Number of noise workers must be at least 1")
+        C.noiseWorkers = args.noise_workers
 
         # Read the input file
-        C.readKey(args.keyFile_name)
+        if args.key_id is not None:
+            keyring(args.keyring).get(args.key_id,C)
+        else:
+            C.readKey(args.keyFile_name)
 
         # Set or generate the noise seed
         if args.N>0:
@@ -211,7 +587,44 @@ if __name__ == "__main__":
         else:
             EXIT("Noise seed cannot be 0")
             
-        if args.BW:
+        if args.pipe:
+
+            # Decrypt raw bytes from stdin to stdout
+            data = sys.stdin.buffer.read()
+            if args.verbose:
+                print("Read "+str(len(data))+" bytes from stdin",file=sys.stderr)
+            if args.auto_plan:
+                autoPlan(C,8*len(data),"dec",memBudget,args.plan_cache)
+            try:
+                out = C.decryptBytes(data,progress=progress)
+            except CAcancelled as e:
+                EXIT("Decryption cancelled after "+str(e.step)+" steps, no output written")
+            sys.stdout.buffer.write(out)
+            sys.stdout.buffer.flush()
+
+        elif multiFrame:
+
+            # Decrypt each frame on a pool of workers, each with its own noise seed
+            if args.output_file == "DEFAULT":
+                outfile = "decrypted"
+            else:
+                outfile = args.output_file
+            fmt = "png" if args.out_format == "auto" else args.out_format
+            if args.verbose:
+                print("Attempting to decrypt the "+str(numFrames(args.BW))+" frames of "+args.BW)
+
+            S = frameSink(outfile,fmt)
+            for binArr, d, hints in mapFrames(C,"dec",readFrames(args.BW),C.noiseSeed,args.frame_workers):
+                S.write(binArr,d,hints)
+                if token.cancelled():
+                    S.close()
+                    EXIT("Decryption cancelled after "+str(S.count)+" frames")
+            S.close()
+
+            if args.verbose:
+                print("Save of "+str(S.count)+" decrypted frames to '"+outfile+"' successful")
+
+        elif args.BW:
 
             if args.verbose:
                 print("Attempting to decrypt the greyscale image "+args.BW)
@@ -223,48 +636,116 @@ if __name__ == "__main__":
             if not exists(args.BW):
                 EXIT("Input black and white image '"+args.BW+"' does not exist.")
 
-            # Read the input image and its dimensions and set the array in the CA class
-            I, d = readBWImage2BinArr(args.BW)
-            C.setBinStartVec(I.flatten())
+            # Read the input image (or packed container), its dimensions and any step hints
+            prof.begin("decode")
+            I, d, hints, inFormat, codec = readCipherInput(args.BW,C.k,C.numSteps)
+            outFormat = chooseOutputFormat(args.out_format,inFormat,\
+                                           None if args.output_file == "DEFAULT" else args.output_file)
+            if codec is not None and args.verbose_save:
+                EXIT("-S cannot be used to decrypt a compressed message")
+
+            # Decrypt each channel plane as its own ring for keys with a planar channel layout
+            planar = C.channelLayout == "planar" and numChannels(d)>1 and codec is None
+            if planar and (args.checkpoint or args.verbose_save or args.cluster):
+                EXIT("Images with several channels cannot be decrypted with -S, --checkpoint or "+\
+                     "--cluster by a key with a planar channel layout")
             
             if args.verbose:
                 print("Loaded image "+args.BW)
+
+            if args.auto_plan:
+                autoPlan(C,len(I),"dec",memBudget,args.plan_cache,verbose=args.verbose)
+
+            # Input encrypted with forwards steps also holds the step hints
+            if C.encDir == "forward":
+                if hints is None:
+                    EXIT("Input '"+args.BW+"' does not contain the step hints needed by a forward encryption key")
+                if not planar:
+                    C.setMaskedHints(hints)
+
+            firstStep = 0
+            if args.resume:
+                # Continue from the checkpointed state
+                firstStep, seed, state, hints = readCheckpoint(args.checkpoint,"dec",C.keyFingerprint())
+                if len(state) != len(I):
+                    EXIT("Checkpoint '"+args.checkpoint+"' was not written for image "+args.BW)
+                if seed != C.noiseSeed:
+                    EXIT("Checkpoint '"+args.checkpoint+"' was written with a different noise seed")
+                C.setDecArr(state)
+                if args.verbose:
+                    print("Resuming from checkpoint '"+args.checkpoint+"' after "+str(firstStep)+" steps")
+            elif not planar:
+                C.setDecArr(I,copy=False)
+
+            # Checkpoint the decryption steps if requested
+            ck = None
+            if args.checkpoint:
+                ck = checkpointer(args.checkpoint,"dec",C.keyFingerprint(),C.noiseSeed,C.numSteps,\
+                                  maxOverhead=args.checkpoint_overhead)
                 
             if args.verbose:
                 print("Attempting "+str(C.numSteps)+" decryption steps with k="+str(C.k))
                 
-            # Perform the encryption steps
+            # Save after every decryption step if requested, with the saves written in the background
+            W = None
+            saveStep = None
             if args.verbose_save:
-                # Save after every encryption step
-                C.CAts = C.start # Needed as single step only works with the work array C.CAts
-                for i in range(C.numSteps):
-                    if args.verbose:
-                        t = time.time()
-                    C.singleCAstep()
-                    saveBinArr2BWImage("dec"+str(i+1)+".png",C.CAts,d)
-                    if args.verbose:
-                        print("    + decryption step : "+str(i+1),\
-                              " took : "+str('%.3f'%(time.time()-t))+" seconds")
-                C.end = C.CAts # Needed as single step only works with the work array C.CAts
-            else:
-                if args.verbose:
-                    C.CAsteps(numSteps=C.numSteps,verbose=True)
+                W = snapshotWriter(fmt=args.snap_format,maxQueue=args.snap_queue)
+                saveStep = lambda i, A : W.submit("dec"+str(i)+W.ext,A,d)
+
+            # Perform the decryption steps
+            prof.begin("steps" if args.cluster or planar else "step "+str(firstStep+1))
+            try:
+                if args.cluster:
+                    decArr = clusterDecrypt(args.cluster,C,I,progress=progress)
+                elif planar:
+                    decArr, _ = cryptImage(C,"dec",I,d,hints=hints,workers=args.channel_workers,\
+                                           progress=progress)
                 else:
-                    C.CAsteps(numSteps=C.numSteps,verbose=False)
-
-            # Then XOR the final step with the random noise
-            C.XORendArr()
+                    C.decSteps(numSteps=C.numSteps,verbose=args.verbose,firstStep=firstStep,checkpoint=ck,\
+                               callback=prof.stepCallback(C.numSteps,saveStep),progress=progress)
+            except CAcancelled as e:
+                if W is not None:
+                    W.close()
+                # The state is that after the completed steps, so can be resumed from
+                if ck is not None:
+                    ck.save(e.step,C.CAts)
+                    EXIT("Decryption cancelled after "+str(e.step)+" steps, no output written, "+\
+                         "checkpoint saved to '"+args.checkpoint+"'")
+                EXIT("Decryption cancelled after "+str(e.step)+" steps, no output written")
+            if W is not None:
+                W.close()
+
+            # Then XOR the final step with the random noise (done segment-wise by cluster workers,
+            # and for each plane by cryptImage)
+            if not args.cluster and not planar:
+                prof.begin("noise")
+                decArr = C.XORdecArr()
+
+            # Then decompress a message compressed before it was encrypted
+            if codec is not None:
+                prof.begin("decompress")
+                decArr = decompressBinArr(decArr,codec)
+                if len(decArr) not in (8*int(np.prod(d)),16*int(np.prod(d))):
+                    EXIT("Decompressed message does not match the image dimensions "+str(tuple(d)))
+                if args.verbose:
+                    print("Decompressed message with "+codec)
                 
-            if args.verbose:
-                print("XORed final step with random noise generated with seed "+str(C.noiseSeed))
-                print("Decryption successful, saving output as decrypted.png")
-            
-            # Then save the output image
+            # Then save the output
             if args.output_file == "DEFAULT":
-                outfile = "decrypted.png"
+                outfile = "decrypted"+outputFormats[outFormat]
             else:
                 outfile = args.output_file
-            saveBinArr2BWImage(outfile,C.end,d)
+            if args.verbose:
+                print("XORed final step with random noise generated with seed "+str(C.noiseSeed))
+                print("Decryption successful, saving output as "+outfile)
+            prof.begin("encode")
+            saveCipherOutput(outfile,decArr,d,outFormat)
+            prof.save(args.mem_report)
+
+            # The run is complete so the checkpoint is no longer needed
+            if ck is not None:
+                ck.remove()
 
             # And print info about the output image/encryption
             if args.verbose:
@@ -274,6 +755,97 @@ if __name__ == "__main__":
 
             EXIT("No valid encryption flag/file given")
 
+
+    elif args.rekey:
+
+        # Re-encrypt the given files from the old key and noise seed to the new ones
+        if args.rekey_workers<1:
+            EXIT("Number of rekey workers must be at least 1")
+
+        old = CA()
+        if args.key_id is not None:
+            keyring(args.keyring).get(args.key_id,old)
+        else:
+            old.readKey(args.keyFile_name)
+        if args.N>0:
+            old.setNoiseSeed(args.N)
+        elif args.N<0:
+            EXIT("Noise seed must be set for decryption")
+        else:
+            EXIT("Noise seed cannot be 0")
+
+        new = CA()
+        if args.new_key_id is not None:
+            keyring(args.keyring).get(args.new_key_id,new)
+        elif args.new_keyFile_name is not None:
+            new.readKey(args.new_keyFile_name)
+        else:
+            EXIT("--rekey needs the new key, set with --new-keyFile-name or --new-key-id")
+        if args.new_N>0:
+            new.setNoiseSeed(args.new_N)
+        elif args.new_N<0:
+            new.setRandNoiseSeed()
+        else:
+            EXIT("Noise seed cannot be 0")
+
+        if args.verbose:
+            print("Re-encrypting "+str(len(args.rekey))+" files to '"+args.rekey_dir+"'")
+        done = 0
+        for f, outfile in rekeyFiles(old,new,args.rekey,args.rekey_dir,args.out_format,args.rekey_workers):
+            done += 1
+            if args.verbose:
+                print("    - re-encrypted '"+f+"' to '"+outfile+"'")
+            if token.cancelled():
+                EXIT("Rekey cancelled after "+str(done)+" files")
+        print("    = new random noise seed "+str(new.noiseSeed))
+
+    elif args.cluster_worker:
+
+        # Serve segments of the forwards steps to cluster coordinators until interrupted
+        print("Cluster worker listening on "+args.cluster_worker)
+        serveClusterWorker(args.cluster_worker)
+
+    elif args.plan:
+
+        # Print the execution plans for the key and input size
+        C = CA()
+        if args.key_id is not None:
+            keyring(args.keyring).get(args.key_id,C)
+        else:
+            C.readKey(args.keyFile_name)
+
+        if args.plan_N is not None:
+            if args.plan_N<C.k:
+                EXIT("--plan-N must be at least k")
+            N = args.plan_N
+        else:
+            if not exists(args.BW):
+                EXIT("Input black and white image '"+args.BW+"' does not exist.")
+            N = len(readCipherInput(args.BW)[0])
+
+        cal = loadCalibration(args.plan_cache,recalibrate=args.recalibrate,verbose=True)
+        for mode in ("enc","dec"):
+            plan, est = planSteps(C,N,mode,cal,memBudget)
+            printPlan(plan,est,mode,N)
+
+    elif args.avalanche:
+
+        # Measure how a single flipped bit spreads through encryption
+        keys = [dict(avalancheKeys[name]) for name in args.aval_keys]
+        if args.noise_gen != "EQaDG":
+            for opts in keys:
+                opts["G"] = args.noise_gen
+        res = avalanche(args.aval_k,args.aval_T,args.aval_N,flip=args.avalanche,\
+                        trials=args.aval_trials,workers=args.aval_workers,keys=keys,\
+                        budget=memBudget,cacheFile=args.plan_cache)
+        printAvalancheReport(res,target=args.aval_target)
+
+    elif args.stats:
+
+        # Find randomness statistics of the given files
+        S = parallelFileStats(args.stats,workers=args.stats_workers,blockSize=args.stats_block)
+        printStatsReport(S.report(),", ".join(args.stats))
+
             
     else:
 
@@ -0,0 +1,190 @@
+import random as r
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+from CAencrypt.plan import *
+
+
+# The key option sets that can be compared with avalanche, by name
+avalancheKeys = {"periodic":{}, "fixed":{"B":"fixed"}, "forward":{"D":"forward"}}
+
+
+def keyOptionsName(opts):
+    """
+    Return a short name for the key options opts (as returned by CA.getKeyOptions).
+    """
+
+    if not opts:
+        return "default"
+    return ",".join([name+":"+str(opts[name]) for name in sorted(opts)])
+
+
+def encryptTrial(C,bits):
+    """
+    Encrypt the binary array bits with the key and noise seed set in the CA C, returning the
+    encrypted array, or None if a backwards step could not be found. Any other error exits as
+    usual.
+    """
+
+    try:
+        return C.encryptArr(bits).copy()
+    except SystemExit as e:
+        if "Cannot reverse CA step" in str(e.code):
+            return None
+        raise
+
+
+def avalancheTrial(trial):
+    """
+    Run a single avalanche trial, encrypting a random message and then the same message with a
+    single bit of either the message, the key rules or the noise seed flipped.
+
+    INPUTS
+    ======
+    trial
+        A tuple (k, T, N, flip, seed, opts, plan) where k is the neighbourhood size, T the
+        number of steps, N the message length in bits, flip one of "plain", "rule" or "seed",
+        seed the seed used to generate the key, message, noise seed and bit to flip for this
+        trial, opts the key options (see CA.setKeyOptions) and plan the execution plan (see
+        CA.setPlan) the messages are encrypted with.
+
+    RETURNS
+    =======
+    Hamming distance
+        The number of bits that differ between the two encrypted messages, or None if either
+        message could not be encrypted.
+    """
+
+    k, T, N, flip, seed, opts, plan = trial
+
+    # Generate the key, noise seed and message for this trial
+    r.seed(seed)
+    C = CA(k=k,numSteps=T)
+    C.setKeyOptions(opts)
+    C.setPlan(plan)
+    C.genRulesLeftReversible()
+    C.setRandNoiseSeed()
+    rng = np.random.default_rng(seed)
+    bits = rng.integers(0,2,N,dtype=np.uint8)
+
+    c1 = encryptTrial(C,bits)
+    if c1 is None:
+        return None
+
+    # Flip a single bit of the message, rules or noise seed
+    if flip == "plain":
+        bits[rng.integers(0,N)] ^= 1
+    elif flip == "rule":
+        # Swap the outputs of a pair of rules, i.e. flip an entry of g, which keeps Z_left=1
+        C.g[int(rng.integers(0,C.numkM1))] ^= 1
+        C.setRuleTables()
+    elif flip == "seed":
+        C.setNoiseSeed(C.noiseSeed ^ (1<<int(rng.integers(0,32))))
+    else:
+        EXIT("Unknown avalanche flip '"+str(flip)+"', use plain, rule or seed")
+
+    c2 = encryptTrial(C,bits)
+    if c2 is None:
+        return None
+
+    return int(np.count_nonzero(c1 != c2))
+
+
+def avalanche(ks,Ts,Ns,flip="plain",trials=32,workers=1,seed=1,keys=None,budget=None,\
+              cacheFile=defaultCache):
+    """
+    Measure the diffusion of a single flipped bit through encryption, for every combination of
+    neighbourhood size k in ks, number of steps T in Ts, message length N in Ns and key options
+    in keys.
+
+    The messages of each combination are encrypted with the fastest execution plan for it
+    chosen by planSteps (within budget bytes, with the calibration cached in cacheFile), so the
+    trials use the engines the combination would be encrypted with. The trials are run in
+    parallel across a pool of worker processes.
+
+    INPUTS
+    ======
+    keys
+        A list of key option dictionaries (see CA.setKeyOptions) to compare, e.g. the values of
+        avalancheKeys, default only the default options.
+
+    RETURNS
+    =======
+    results
+        A dictionary with keys (k,T,N,name), with name the keyOptionsName of the key options,
+        and values the array of Hamming distances of the successful trials for that combination,
+        the number of failed trials and the estimate (see estimatePlan) of encrypting with the
+        plan chosen.
+    """
+
+    if keys is None:
+        keys = [{}]
+    configs = [(k,T,N,opts) for k in ks for T in Ts for N in Ns for opts in keys]
+    for k, T, N, opts in configs:
+        if k<3 or k%2 == 0:
+            EXIT("Avalanche k values must be odd and at least 3")
+        if T<1:
+            EXIT("Avalanche T values must be at least 1")
+        if N<k:
+            EXIT("Avalanche N values must be at least k")
+
+    # Choose the plan of each combination, the rules do not change the plan or its estimates
+    # so a CA with the same k, T and options will do
+    cal = loadCalibration(cacheFile)
+    plans = []
+    for k, T, N, opts in configs:
+        C = CA(k=k,numSteps=T)
+        C.setKeyOptions(opts)
+        plans.append(planSteps(C,N,"enc",cal,budget))
+
+    jobs = [(k,T,N,flip,seed+t,opts,P[0]) for (k,T,N,opts), P in zip(configs,plans) \
+            for t in range(trials)]
+    if workers>1:
+        from multiprocessing import Pool
+        with Pool(workers) as P:
+            D = P.map(avalancheTrial,jobs,chunksize=max(1,len(jobs)//(4*workers)))
+    else:
+        D = list(map(avalancheTrial,jobs))
+
+    results = {}
+    for i, (k,T,N,opts) in enumerate(configs):
+        d = D[i*trials:(i+1)*trials]
+        ok = np.array([x for x in d if x is not None],dtype=np.int64)
+        results[(k,T,N,keyOptionsName(opts))] = (ok,len(d)-len(ok),plans[i][1])
+    return results
+
+
+def printAvalancheReport(results,target=None):
+    """
+    Print the distribution of Hamming distances, as a fraction of the message length, and the
+    estimated encryption time for each (k,T,N,key options) from avalanche. If target is given
+    the cheapest combination whose mean fraction is at least target is also reported, where
+    the cost of encryption is the time estimated by estimatePlan.
+    """
+
+    w = max([len(name) for (k,T,N,name) in results]+[3])
+    print("     k     T          N  "+"key".rjust(w)+"   trials  failed     mean      std      min"+\
+          "      p05      p50      max  time (s)")
+    best = None
+    for (k,T,N,name), (d,failed,est) in sorted(results.items()):
+        line = str(k).rjust(6)+str(T).rjust(6)+str(N).rjust(11)+"  "+name.rjust(w)+\
+            str(len(d)).rjust(9)+str(failed).rjust(8)
+        if len(d)>0:
+            f = d/N
+            for v in (f.mean(),f.std(),f.min(),np.percentile(f,5),np.median(f),f.max()):
+                line += str('%.4f'%v).rjust(9)
+            if target is not None and f.mean()>=target:
+                if best is None or est["time"]<best[0]:
+                    best = (est["time"],k,T,N,name)
+        else:
+            line += " "*54
+        print(line+str('%.4g'%est["time"]).rjust(10))
+
+    if target is not None:
+        if best is None:
+            print("No combination reached the diffusion target of "+str(target))
+        else:
+            print("Cheapest combination reaching the diffusion target of "+str(target)+\
+                  " : k="+str(best[1])+" T="+str(best[2])+" N="+str(best[3])+" key "+best[4]+\
+                  " (estimated "+str('%.4g'%best[0])+" seconds)")
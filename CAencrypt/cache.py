@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.container import *
+
+
+# The default directory of the result cache and its default size limit in bytes
+defaultResultCache = os.path.join(os.path.expanduser("~"),".cache","CAencrypt","results")
+defaultResultCacheSize = 1024*2**20
+
+
+class resultCache:
+    """
+    A cache on local disk of the results of encryptions, so encrypting the same message with the
+    same key and noise seed again reads back the result instead of taking the steps.
+
+    Each result is stored as a packed container (see savePackedCipher) named by the digest of
+    the inputs it was computed from, a SHA-256 hash of the rule lookup table and fingerprint of
+    the key (which covers k, T and the key options), the noise seed, the mode, the image
+    dimensions (which set the channel planes of a key with a planar channel layout) and the
+    message packed 8 cells per byte. Hashing the message takes a single pass over N/8 bytes, much less
+    than even one CA step. As the lookup table itself is hashed, the digest of a message cannot
+    be found without the key.
+
+    Entries are evicted least recently used first whenever the total size of the cache exceeds
+    maxBytes (checked when the cache is opened and after each store), with the modification
+    time of each entry updated when it is read. Entries are written to a temporary file and
+    then renamed, so a partly written entry is never read.
+
+    The numbers of hits, misses, stores and evictions are counted both for this instance and
+    in total over all uses of the cache directory (kept in stats.json in the directory).
+
+    USAGE
+    =====
+
+        cache = resultCache("cache",2**30)
+        key = cache.digest(C,"enc",binArr,dim)
+        res = cache.get(key)
+        if res is None:
+            out = C.encryptArr(binArr)
+            cache.put(key,out,dim)
+    """
+
+    ext = ".cab"
+    statNames = ("hits","misses","stores","evictions")
+
+    def __init__(self,dirname=defaultResultCache,maxBytes=defaultResultCacheSize):
+
+        if maxBytes<=0:
+            EXIT("Result cache size must be positive")
+        self.dirname  = dirname
+        self.maxBytes = maxBytes
+        os.makedirs(dirname,exist_ok=True)
+
+        self.counts = dict([(name,0) for name in self.statNames])
+
+        # The size limit may be lower than when the cache was last used
+        self.evict()
+
+
+    def digest(self,C,mode,binArr,dims=None):
+        """
+        Return the hex digest identifying the result of encrypting (mode "enc") or decrypting
+        (mode "dec") the binary array binArr, of an image with dimensions dims, with the key and
+        noise seed of the CA C. dims is None for an array that is not an image.
+        """
+
+        if C.lut is None:
+            C.setRuleTables()
+        if C.noiseSeed is None:
+            EXIT("Noise seed must be set to find a result cache digest")
+        h = hashlib.sha256(b"CAcache")
+        h.update(np.asarray(C.lut,dtype=np.uint8).tobytes())
+        h.update(C.keyFingerprint())
+        dims = "none" if dims is None else "x".join([str(int(n)) for n in dims])
+        h.update((mode+" "+str(C.noiseSeed)+" "+str(len(binArr))+" "+dims+"\n").encode())
+        h.update(np.packbits(np.asarray(binArr,dtype=np.uint8)).tobytes())
+        return h.hexdigest()
+
+
+    def path(self,key):
+        return os.path.join(self.dirname,key+self.ext)
+
+
+    def get(self,key):
+        """
+        Return the cached result (array, hints) for the digest key, None if it is not cached.
+        """
+
+        filename = self.path(key)
+        try:
+            os.utime(filename)
+            binArr, dims, k, T, hints, codec = readPackedCipher(filename)
+        except (FileNotFoundError,SystemExit):
+            # Missing, or evicted by another process since the check
+            self.counts["misses"] += 1
+            return None
+        self.counts["hits"] += 1
+        return binArr, hints
+
+
+    def put(self,key,binArr,dim,hints=None,k=0,T=0):
+        """
+        Store the result binArr (with the image dimensions dim, step hints hints, and k and T
+        of the key) for the digest key, then evict entries until the cache is within maxBytes.
+        """
+
+        filename = self.path(key)
+        savePackedCipher(filename+".tmp",binArr,dim,k,T,hints)
+        os.replace(filename+".tmp",filename)
+        self.counts["stores"] += 1
+        self.evict()
+
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within maxBytes.
+        """
+
+        entries = []
+        total = 0
+        for e in os.scandir(self.dirname):
+            if e.name.endswith(self.ext):
+                s = e.stat()
+                entries.append((s.st_mtime_ns,s.st_size,e.path))
+                total += s.st_size
+
+        entries.sort()
+        for t, size, filename in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(filename)
+                self.counts["evictions"] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+    def totals(self):
+        """
+        Add the counts of this instance to the totals kept in the cache directory, returning
+        the new totals. The counts of this instance are then reset.
+        """
+
+        filename = os.path.join(self.dirname,"stats.json")
+        totals = dict([(name,0) for name in self.statNames])
+        try:
+            with open(filename,"r") as f:
+                totals.update(json.load(f))
+        except (FileNotFoundError,ValueError):
+            pass
+        for name in self.statNames:
+            totals[name] += self.counts[name]
+            self.counts[name] = 0
+
+        with open(filename+".tmp","w") as f:
+            json.dump(totals,f)
+        os.replace(filename+".tmp",filename)
+        return totals
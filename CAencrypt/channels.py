@@ -0,0 +1,174 @@
+import hashlib
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+from CAencrypt.progress import *
+
+
+
+def planeSeed(noiseSeed,plane):
+    """
+    Return the noise seed of channel plane plane of an image encrypted with a key with
+    channelLayout "planar" and the base noise seed noiseSeed, so no two planes are XORed with
+    the same noise. The seed is taken from a sha256 hash of the base seed and plane, and is
+    never 0.
+    """
+
+    h = hashlib.sha256(b"CAplane"+int(noiseSeed).to_bytes(8,"little")+int(plane).to_bytes(8,"little"))
+    return int.from_bytes(h.digest()[:4],"little") or 1
+
+
+def numChannels(dims):
+    """
+    Return the number of channels of an image of dimensions dims, as returned by
+    readBWImage2BinArr.
+    """
+
+    return dims[2] if len(dims) == 3 else 1
+
+
+def splitPlanes(binArr,dims):
+    """
+    Split the binary array of an image of dimensions dims (with the channels of each pixel
+    interleaved, as read by readBWImage2BinArr) into the binary arrays of its channel planes.
+    Each value keeps all its bits (8 or 16), so each plane is a slice of a view of binArr as
+    (pixels,channels,bits) and no values are converted.
+    """
+
+    c = numChannels(dims)
+    pixels = int(np.prod(dims[:2]))
+    if pixels == 0 or len(binArr) % (pixels*c) != 0:
+        EXIT("Length of array does not match the image dimensions "+str(tuple(dims)))
+    B = np.asarray(binArr).reshape(pixels,c,-1)
+    return [np.ascontiguousarray(B[:,i,:]).reshape(-1) for i in range(c)]
+
+
+def joinPlanes(planes,dims):
+    """
+    Join the binary arrays of the channel planes of an image of dimensions dims back into a
+    single binary array with the channels of each pixel interleaved, the inverse of splitPlanes.
+    """
+
+    pixels = int(np.prod(dims[:2]))
+    out = np.empty((pixels,len(planes),len(planes[0])//pixels),dtype=np.uint8)
+    for i, P in enumerate(planes):
+        out[:,i,:] = P.reshape(pixels,-1)
+    return out.reshape(-1)
+
+
+def cryptRing(C,mode,binArr,seed,hints=None,copy=True,progress=None):
+    """
+    Encrypt (mode "enc") or decrypt (mode "dec") a single ring of cells with the key of the CA
+    C and the noise seed seed, with hints the masked step hints needed to decrypt with a key
+    with encDir "forward". The noise seed of C is restored afterwards. If copy is False binArr
+    is overwritten, see CA.encryptArr. progress is as for CA.CAsteps.
+
+    RETURNS
+    =======
+    array
+        The encrypted or decrypted 1D binary array, a new array.
+    hints
+        The masked step hints when encrypting with a key with encDir "forward", else None.
+    """
+
+    old = C.noiseSeed
+    C.setNoiseSeed(seed)
+    try:
+        if mode == "enc":
+            out = np.array(C.encryptArr(binArr,copy=copy,progress=progress))
+            hints = C.getMaskedHints() if C.encDir == "forward" else None
+        else:
+            if C.encDir == "forward":
+                if hints is None:
+                    EXIT("Input does not contain the step hints needed by a forward encryption key")
+                C.setMaskedHints(hints)
+            out = np.array(C.decryptArr(binArr,copy=copy,progress=progress))
+            hints = None
+    finally:
+        C.noiseSeed = old
+    return out, hints
+
+
+def _planeJob(mode,packed,length,seed,hints):
+    """
+    Encrypt or decrypt a single channel plane with the CA of the worker (see initWorker),
+    passed and returned packed 8 cells per byte. Run with runJob.
+    """
+
+    out, hints = cryptRing(workerState(),mode,np.unpackbits(packed,count=length),seed,hints,copy=False)
+    return np.packbits(out), hints
+
+
+def cryptImage(C,mode,binArr,dims,noiseSeed=None,hints=None,workers=1,progress=None):
+    """
+    Encrypt (mode "enc") or decrypt (mode "dec") the binary array of an image of dimensions
+    dims with the key of the CA C, following the channelLayout of the key.
+
+    With channelLayout "interleaved", or an image with a single channel, the whole array is one
+    ring, exactly as C.encryptArr and C.decryptArr. With channelLayout "planar" each channel
+    plane (see splitPlanes) is its own ring, encrypted with the noise seed
+    planeSeed(noiseSeed,plane), and the planes are shared between a pool of workers processes.
+    The masked step hints of a key with encDir "forward" are those of each plane in turn.
+
+    INPUTS
+    ======
+    C
+        The CA holding the key.
+    mode
+        "enc" to encrypt or "dec" to decrypt.
+    binArr
+        The 1D binary array of the image, which is not changed.
+    dims
+        The dimensions of the image, as returned by readBWImage2BinArr.
+    noiseSeed
+        The noise seed, that of C if None.
+    hints
+        The masked step hints needed to decrypt with a key with encDir "forward".
+    workers
+        The number of worker processes the planes are shared between.
+    progress
+        An optional progressMonitor, see CA.CAsteps, used unless the planes are shared between
+        workers.
+
+    RETURNS
+    =======
+    array
+        The encrypted or decrypted 1D binary array.
+    hints
+        The masked step hints when encrypting with a key with encDir "forward", else None.
+    """
+
+    if noiseSeed is None:
+        noiseSeed = C.noiseSeed
+    c = numChannels(dims)
+    if C.channelLayout != "planar" or c == 1:
+        return cryptRing(C,mode,binArr,noiseSeed,hints,progress=progress)
+
+    planes = splitPlanes(binArr,dims)
+    planeHints = [None]*c
+    if mode == "dec" and C.encDir == "forward":
+        if hints is None or len(hints) != c*C.numSteps:
+            EXIT("Need one step hint for each of the "+str(C.numSteps)+" steps of each of the "+\
+                 str(c)+" channel planes")
+        planeHints = [list(hints[i*C.numSteps:(i+1)*C.numSteps]) for i in range(c)]
+
+    if workers<=1:
+        res = [cryptRing(C,mode,P,planeSeed(noiseSeed,i),planeHints[i],False,progress) \
+               for i, P in enumerate(planes)]
+    else:
+        from multiprocessing import Pool
+
+        jobs = [(_planeJob,mode,np.packbits(P),len(P),planeSeed(noiseSeed,i),planeHints[i]) \
+                for i, P in enumerate(planes)]
+        del planes
+        with Pool(min(workers,c),initializer=initWorker,initargs=(C,True)) as P:
+            res = []
+            for job, R in zip(jobs,P.starmap(runJob,jobs)):
+                packed, h = jobResult(R)
+                res.append((np.unpackbits(packed,count=job[3]),h))
+
+    out = joinPlanes([R[0] for R in res],dims)
+    if mode == "enc" and C.encDir == "forward":
+        return out, [h for R in res for h in R[1]]
+    return out, None
@@ -0,0 +1,163 @@
+import os
+import mmap
+import struct
+import time
+import numpy as np
+
+from CAencrypt.util import *
+
+
+class checkpointer:
+    """
+    Periodically checkpoint the state of a long multi-step CA run so it can be resumed.
+
+    Each checkpoint records the index of the last completed step, the CA state packed 8 cells
+    per byte, a fingerprint of the key, the noise seed and any step hints recorded so far (see
+    CA.stepHints). A checkpoint is written in full to a temporary file which then atomically
+    replaces the previous checkpoint, so a run killed part way through writing a checkpoint
+    always leaves the last complete checkpoint behind. Checkpoints are read back through a
+    memory map of the file.
+
+    To keep the cost of checkpointing small, the time taken to write each checkpoint is
+    measured and the next checkpoint is only written once enough time has been spent on CA
+    steps that the writes take at most a fraction maxOverhead of the total run time.
+
+    CHECKPOINT FILE LAYOUT
+    ======================
+
+        magic       8 bytes     b"CAckpt02"
+        mode        uint8       0 for encryption (reverse steps), 1 for decryption
+        step        uint32      the number of completed steps
+        numSteps    uint32      the total number of steps in the run
+        length      uint64      the number of cells in the CA state
+        noiseSeed   uint64      the noise seed used for the run
+        fingerprint 32 bytes    the key fingerprint, see CA.keyFingerprint
+        numHints    uint32      the number of step hints
+        hints       numHints uint64 step hints
+        state       ceil(length/8) bytes of packed CA state
+
+    All integers are little endian.
+    """
+
+    magic  = b"CAckpt02"
+    header = struct.Struct("<8sBIIQQ32sI")
+    modes  = {"enc":0, "dec":1}
+
+    def __init__(self,filename,mode,fingerprint,noiseSeed,numSteps,maxOverhead=0.03):
+
+        if mode not in self.modes:
+            EXIT("Checkpoint mode must be 'enc' or 'dec'")
+        if maxOverhead<=0:
+            EXIT("Checkpoint overhead fraction must be positive")
+
+        self.filename    = filename
+        self.mode        = mode
+        self.fingerprint = fingerprint
+        self.noiseSeed   = noiseSeed
+        self.numSteps    = numSteps
+        self.maxOverhead = maxOverhead
+
+        # Timings used to limit the checkpoint overhead
+        self.tLast    = time.time()
+        self.tWrite   = 0.0
+        self.numSaved = 0
+
+
+    def step(self,stepIndex,binArr,hints=None):
+        """
+        Called after each completed CA step, writing a checkpoint of binArr (and the step hints
+        if given) if sufficient time has passed since the last checkpoint. The final step is
+        never checkpointed as the run is then complete.
+        """
+
+        if stepIndex >= self.numSteps:
+            return
+        if (time.time()-self.tLast)*self.maxOverhead < self.tWrite:
+            return
+        self.save(stepIndex,binArr,hints)
+
+
+    def save(self,stepIndex,binArr,hints=None):
+        """
+        Atomically write a checkpoint of the state binArr after stepIndex completed steps.
+        """
+
+        t = time.time()
+        binArr = np.asarray(binArr)
+        if hints is None:
+            hints = []
+        head = self.header.pack(self.magic,self.modes[self.mode],stepIndex,self.numSteps,\
+                                len(binArr),self.noiseSeed,self.fingerprint,len(hints))
+        head += np.array(hints,dtype="<u8").tobytes()
+
+        tmpName = self.filename+".tmp"
+        with open(tmpName,"wb") as f:
+            f.write(head+np.packbits(binArr.astype(np.uint8,copy=False)).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpName,self.filename)
+
+        self.numSaved += 1
+        self.tLast  = time.time()
+        self.tWrite = self.tLast - t
+
+
+    def remove(self):
+        """
+        Remove the checkpoint file, called once the run has completed.
+        """
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def readCheckpoint(filename,mode,fingerprint):
+    """
+    Read a checkpoint written by checkpointer, checking it was written for the same key and
+    the same mode (encryption or decryption).
+
+    INPUTS
+    ======
+    filename
+        The checkpoint file to read.
+    mode
+        Either 'enc' or 'dec', the mode of the run being resumed.
+    fingerprint
+        The fingerprint of the key being used for the resumed run.
+
+    RETURNS
+    =======
+    step
+        The number of completed steps.
+    noise seed
+        The noise seed of the checkpointed run.
+    state
+        The CA state after step completed steps, as a 1D binary array.
+    hints
+        The list of step hints recorded up to step.
+    """
+
+    if not os.path.exists(filename):
+        EXIT("Checkpoint file '"+filename+"' does not exist")
+
+    H = checkpointer.header
+    with open(filename,"rb") as f:
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as M:
+            if len(M)<H.size:
+                EXIT("Checkpoint file '"+filename+"' is truncated")
+            magic, modeFlag, step, numSteps, length, noiseSeed, fp, numHints = H.unpack_from(M,0)
+            if magic != checkpointer.magic:
+                EXIT("'"+filename+"' is not a checkpoint file")
+            if modeFlag != checkpointer.modes[mode]:
+                EXIT("Checkpoint '"+filename+"' was not written in "+mode+" mode")
+            if fp != fingerprint:
+                EXIT("Checkpoint '"+filename+"' was written with a different key")
+            s = H.size+8*numHints
+            if len(M) != s+(length+7)//8:
+                EXIT("Checkpoint file '"+filename+"' is truncated")
+            hints = [int(h) for h in np.frombuffer(M,dtype="<u8",count=numHints,offset=H.size)]
+            packed = np.frombuffer(M,dtype=np.uint8,offset=s)
+            state = np.unpackbits(packed,count=length)
+            del packed
+
+    return step, noiseSeed, state, hints
@@ -0,0 +1,281 @@
+import socket
+import struct
+import socketserver
+import threading
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+
+
+# The header of a job sent to a cluster worker
+clusterMagic  = b"CAjb"
+clusterHeader = struct.Struct("<4sBI8sQQQB")
+
+# The flags of a job, XOR the segment with noise before or after the steps
+xorBefore = 1
+xorAfter  = 2
+
+
+def parseAddress(address):
+    """
+    Return the (host,port) of an address given as 'host:port' (or just 'port' for localhost).
+    """
+
+    host, sep, port = address.rpartition(":")
+    if host == "":
+        host = "localhost"
+    try:
+        port = int(port)
+    except ValueError:
+        EXIT("Cluster address '"+address+"' must be of the form host:port")
+    return host, port
+
+
+def sendMsg(sock,data):
+    """
+    Send a message, the bytes data preceded by their length as a little endian uint64.
+    """
+    sock.sendall(struct.pack("<Q",len(data))+data)
+
+
+def recvExact(sock,n):
+    """
+    Receive exactly n bytes, raising ConnectionError if the connection is closed first.
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got<n:
+        m = sock.recv_into(view[got:],n-got)
+        if m == 0:
+            raise ConnectionError("connection closed")
+        got += m
+    return buf
+
+
+def recvMsg(sock):
+    """
+    Receive a message sent with sendMsg.
+    """
+    return recvExact(sock,struct.unpack("<Q",recvExact(sock,8))[0])
+
+
+def runSegment(sock):
+    """
+    Run a job sent by clusterSteps to a worker over the connection sock.
+
+    The job holds the lut of the key, the number of steps and the segment of the ring of cells
+    assigned to the worker. The segment is held with (k-1)/2 halo cells either side. Before
+    each step the worker sends its (k-1)/2 edge cells either end of the segment, and receives
+    back the halos, the edge cells of its neighbours in the ring. The segment is then stepped
+    with stepKernel, the halos only being used as neighbours. The segment is XORed with the
+    noise from its offset in the ring before or after the steps (as set by the flags of the
+    job), then sent back packed 8 cells per byte.
+    """
+
+    job = recvMsg(sock)
+    magic, k, numSteps, gen, seed, offset, length, flags = clusterHeader.unpack_from(job,0)
+    if magic != clusterMagic:
+        raise ConnectionError("not a cluster job")
+    gen = gen.rstrip(b"\0").decode()
+    lut = np.frombuffer(job,dtype=np.uint8,count=2**k,offset=clusterHeader.size)
+    packed = np.frombuffer(job,dtype=np.uint8,offset=clusterHeader.size+2**k)
+
+    h = (k-1)//2
+    ext  = np.empty(length+2*h,dtype=np.uint8)
+    work = np.empty_like(ext)
+    ext[h:h+length] = np.unpackbits(packed,count=length)
+    del job, packed
+
+    if flags & xorBefore:
+        noiseKernel(gen,seed,ext[h:h+length],offset=offset)
+
+    for i in range(numSteps):
+        sendMsg(sock,np.concatenate((ext[h:2*h],ext[length:length+h])).tobytes())
+        halos = np.frombuffer(recvMsg(sock),dtype=np.uint8)
+        ext[:h] = halos[:h]
+        ext[h+length:] = halos[h:]
+        # The cells of the segment only depend on cells of ext, so the wrapping of ext at its
+        # ends only changes the halos of the result, which are replaced before the next step
+        stepKernel(lut,k,ext,work)
+        ext, work = work, ext
+
+    seg = ext[h:h+length]
+    if flags & xorAfter:
+        noiseKernel(gen,seed,seg,offset=offset)
+    sendMsg(sock,np.packbits(seg).tobytes())
+
+
+class clusterHandler(socketserver.BaseRequestHandler):
+    """
+    Handle a connection to a cluster worker, running the job sent over it.
+    """
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        try:
+            runSegment(self.request)
+        except ConnectionError:
+            # The coordinator stopped (or was cancelled), drop the job
+            pass
+
+
+class clusterServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def startClusterWorker(address="localhost:0"):
+    """
+    Start a cluster worker listening on address ('host:port', port 0 for any free port) in a
+    background thread, returning the server, whose address is server.server_address. Stop it
+    with server.shutdown().
+    """
+
+    server = clusterServer(parseAddress(address),clusterHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+
+def serveClusterWorker(address):
+    """
+    Run a cluster worker listening on address ('host:port') until interrupted. Each connection
+    from a coordinator runs one job, see runSegment.
+    """
+
+    with clusterServer(parseAddress(address),clusterHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def clusterSteps(workers,lut,k,numSteps,binArr,noiseGen,noiseSeed,flags,hints=None,progress=None,\
+                 label="cluster"):
+    """
+    Take numSteps forwards steps of the ring of cells binArr on a cluster of workers.
+
+    The ring is split into contiguous segments, one per worker, each sent to its worker with the
+    lut of the key. Each step only the (k-1)/2 edge cells of each segment are exchanged between
+    neighbouring segments (through the coordinator), and at the end the segments are gathered
+    back. The noise is XORed into each segment by its worker, from the offset of the segment.
+
+    INPUTS
+    ======
+    workers
+        The addresses ('host:port') of the workers, see serveClusterWorker.
+    lut, k
+        The forwards step lookup table (see CA.setRuleTables) and neighbourhood size.
+    numSteps
+        The number of forwards steps.
+    binArr
+        The 1D binary array of cells, which is not changed.
+    noiseGen, noiseSeed
+        The noise generator and seed of the noise XORed with the cells.
+    flags
+        xorBefore to XOR the noise before the steps, xorAfter to XOR it after.
+    hints
+        If a list, the step hint (see stepHintKernel) of the state before each step is appended.
+    progress
+        An optional progressMonitor, checked for cancellation between steps, with label the
+        name of the steps in its reports.
+
+    RETURNS
+    =======
+    array
+        The 1D binary array after the steps.
+    """
+
+    n = len(workers)
+    N = len(binArr)
+    h = (k-1)//2
+    if n<1:
+        EXIT("Cluster must have at least one worker")
+    if N//n < k:
+        EXIT("Cluster of "+str(n)+" workers too large for "+str(N)+" cells, each segment must "+\
+             "have at least k cells")
+
+    bounds = [N*i//n for i in range(n+1)]
+    gen = noiseGen.encode()
+
+    socks = []
+    try:
+        for i, w in enumerate(workers):
+            try:
+                s = socket.create_connection(parseAddress(w))
+            except OSError as e:
+                EXIT("Cannot connect to cluster worker '"+w+"': "+str(e))
+            s.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            socks.append(s)
+            a, b = bounds[i], bounds[i+1]
+            job = clusterHeader.pack(clusterMagic,k,numSteps,gen,noiseSeed,a,b-a,flags)
+            sendMsg(s,job+np.asarray(lut,dtype=np.uint8).tobytes()+np.packbits(binArr[a:b]).tobytes())
+
+        if progress is not None:
+            progress.begin(label,0,numSteps,N,1)
+        for i in range(numSteps):
+            if progress is not None:
+                progress.beginStep(i+1)
+            edges = [np.frombuffer(recvMsg(s),dtype=np.uint8) for s in socks]
+            if hints is not None:
+                # The cells -(k-1)/2 to (k-1)/2-1, the last cells of the last segment then
+                # the first cells of the first
+                hint = 0
+                for c in np.concatenate((edges[-1][h:],edges[0][:h])):
+                    hint = (hint << 1) | int(c)
+                hints.append(hint)
+            for j, s in enumerate(socks):
+                sendMsg(s,np.concatenate((edges[j-1][h:],edges[(j+1)%n][:h])).tobytes())
+            if progress is not None:
+                progress.tick(N)
+                progress.endStep()
+
+        out = np.empty(N,dtype=np.uint8)
+        for i, s in enumerate(socks):
+            a, b = bounds[i], bounds[i+1]
+            out[a:b] = np.unpackbits(np.frombuffer(recvMsg(s),dtype=np.uint8),count=b-a)
+    except ConnectionError:
+        EXIT("Cluster worker closed the connection")
+    finally:
+        for s in socks:
+            s.close()
+
+    if progress is not None:
+        progress.end()
+    return out
+
+
+def clusterEncrypt(workers,C,binArr,progress=None):
+    """
+    Encrypt binArr with the forwards steps of the key of C (which must have encDir "forward")
+    on a cluster of workers, giving the same result as C.encryptArr. The step hints are set in
+    C.stepHints, see C.getMaskedHints.
+    """
+
+    if C.encDir != "forward":
+        EXIT("Cluster encryption needs a key that encrypts with forwards steps")
+    if C.boundary != "periodic":
+        EXIT("Cluster steps need a key with a periodic boundary")
+    if C.lut is None:
+        C.setRuleTables()
+    C.stepHints = []
+    return clusterSteps(workers,C.lut,C.k,C.numSteps,asBinArr(binArr,"Array to encrypt",copy=False),\
+                        C.noiseGen,C.noiseSeed,xorBefore,hints=C.stepHints,progress=progress,
+                        label="encryption")
+
+
+def clusterDecrypt(workers,C,binArr,progress=None):
+    """
+    Decrypt binArr with the forwards steps of the key of C (which must have encDir "reverse")
+    on a cluster of workers, giving the same result as C.decryptArr.
+    """
+
+    if C.encDir != "reverse":
+        EXIT("Cluster decryption needs a key that decrypts with forwards steps")
+    if C.boundary != "periodic":
+        EXIT("Cluster steps need a key with a periodic boundary")
+    if C.lut is None:
+        C.setRuleTables()
+    return clusterSteps(workers,C.lut,C.k,C.numSteps,asBinArr(binArr,"Array to decrypt",copy=False),\
+                        C.noiseGen,C.noiseSeed,xorAfter,progress=progress,label="decryption")
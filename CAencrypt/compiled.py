@@ -0,0 +1,268 @@
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+
+
+class compiledKey:
+    """
+    An immutable key compiled from a CA, which can be shared between threads.
+
+    A CA holds both the key and the state of the message being encrypted or decrypted, so
+    one CA cannot encrypt or decrypt more than one message at a time. A compiledKey holds only
+    the key (k, T, the key options and the rule lookup tables, as read only arrays) and the
+    execution plan of the CA it was compiled from. The stateless functions encryptWithKey,
+    decryptWithKey, encryptBytesWithKey and decryptBytesWithKey take a compiledKey along with
+    the message, noise seed and optional output buffers, so any number of threads can encrypt
+    and decrypt messages with one compiledKey at once.
+
+    The forwards steps and noise are numpy operations on whole chunks, which release the GIL,
+    so threads decrypting messages with a key of encDir "reverse" (or encrypting with a key
+    of encDir "forward") run in parallel. The backwards steps are a python loop over the
+    cells, which holds the GIL.
+
+    USAGE
+    =====
+
+        C = CA()
+        C.readKey("key.shared")
+        K = compiledKey(C)
+        with ThreadPoolExecutor(8) as P:
+            plain = list(P.map(lambda m: decryptBytesWithKey(K,m,seed),messages))
+    """
+
+    __slots__ = ("k","numSteps","encDir","noiseGen","boundary","fingerprint","lut","revG","revNext",\
+                 "fixedCells","stepChunk","stepWorkers","revEngine","noiseChunk","noiseWorkers")
+
+    def __init__(self,C):
+
+        if C.g is None or C.k is None or C.numSteps is None:
+            EXIT("Key must have k, T and rules set to be compiled")
+        if C.lut is None:
+            C.setRuleTables()
+
+        def frozen(A):
+            A = np.array(A)
+            A.setflags(write=False)
+            return A
+
+        setattr_ = object.__setattr__
+        setattr_(self,"k",C.k)
+        setattr_(self,"numSteps",C.numSteps)
+        setattr_(self,"encDir",C.encDir)
+        setattr_(self,"noiseGen",C.noiseGen)
+        setattr_(self,"boundary",C.boundary)
+        setattr_(self,"fingerprint",C.keyFingerprint())
+        setattr_(self,"lut",frozen(C.lut))
+        setattr_(self,"revG",tuple(C.revG))
+        setattr_(self,"revNext",tuple([frozen(R) for R in C.revNext]))
+        setattr_(self,"fixedCells",frozen(C.fixedCells))
+        for name in ("stepChunk","stepWorkers","revEngine","noiseChunk","noiseWorkers"):
+            setattr_(self,name,getattr(C,name))
+
+
+    def __setattr__(self,name,val):
+        EXIT("compiledKey is immutable, cannot set "+name)
+
+
+    def __delattr__(self,name):
+        EXIT("compiledKey is immutable, cannot delete "+name)
+
+
+def readCompiledKey(filename="key.shared"):
+    """
+    Read a keyfile (see CA.readKey) and return it as a compiledKey.
+    """
+
+    C = CA()
+    C.readKey(filename)
+    return compiledKey(C)
+
+
+def keyBuffer(A,N,name):
+    """
+    Return A if it is a writable 1D uint8 array of length N, a new array if A is None, else
+    exit with an error.
+    """
+
+    if A is None:
+        return np.empty(N,dtype=np.uint8)
+    if not isinstance(A,np.ndarray) or A.dtype != np.uint8 or A.shape != (N,) or \
+       not A.flags.writeable or not A.flags.c_contiguous:
+        EXIT(name+" must be a writable contiguous 1D uint8 array of length "+str(N))
+    return A
+
+
+def runSteps(K,out,work,forward,hints=None,guesses=None,progress=None,label=""):
+    """
+    Take K.numSteps steps from the state in out, using work as the second buffer, leaving the
+    result in out. If forward is True forwards steps are taken, appending the step hint of
+    each state to hints if it is a list. Otherwise backwards steps are taken, with guesses the
+    list of step hints used as the guess of each step (all guesses are tried if None).
+
+    If progress (a progressMonitor) is given the progress is reported through it, and the
+    steps stop with CAcancelled if its token is cancelled.
+    """
+
+    if progress is not None:
+        if forward or guesses is not None or K.boundary == "fixed":
+            passes = 1
+        elif K.revEngine == "guess":
+            passes = 2
+        else:
+            passes = (2**(K.k-1)+1)/2
+        progress.begin(label,0,K.numSteps,len(out),passes)
+
+    boundary = K.fixedCells if K.boundary == "fixed" else None
+    cur, nxt = out, work
+    for i in range(K.numSteps):
+        if progress is not None:
+            progress.beginStep(i+1)
+        if forward:
+            if hints is not None:
+                hints.append(stepHintKernel(K.k,cur))
+            if boundary is not None and fixedStepMirrored(i):
+                stepKernel(K.lut,K.k,cur[::-1],nxt[::-1],K.stepChunk,K.stepWorkers,progress,boundary)
+            else:
+                stepKernel(K.lut,K.k,cur,nxt,K.stepChunk,K.stepWorkers,progress,boundary)
+        elif boundary is not None:
+            # The backwards step to the state after numSteps-1-i steps
+            if fixedStepMirrored(K.numSteps-1-i):
+                reverseFixedKernel(K.revG,K.k,cur[::-1],nxt[::-1],boundary,progress)
+            else:
+                reverseFixedKernel(K.revG,K.k,cur,nxt,boundary,progress)
+        else:
+            if guesses is not None:
+                g = [guesses[K.numSteps-1-i]]
+            elif K.revEngine == "guess":
+                g = reverseGuessKernel(K.revNext,cur,progress)
+                if g is None:
+                    EXIT("Cannot reverse CA step")
+                g = [g]
+            else:
+                g = range(0,2**(K.k-1))
+            if not reverseStepKernel(K.revG,K.k,cur,nxt,g,progress):
+                EXIT("Cannot reverse CA step")
+        if progress is not None:
+            progress.endStep()
+        cur, nxt = nxt, cur
+
+    if cur is not out:
+        np.copyto(out,cur)
+    if progress is not None:
+        progress.end()
+
+
+def encryptWithKey(K,binArr,noiseSeed,out=None,work=None,progress=None):
+    """
+    Encrypt a binary array with the compiledKey K and the noise seed noiseSeed, giving the
+    same result as CA.encryptArr. Nothing is shared between calls, so this may be called from
+    many threads at once.
+
+    INPUTS
+    ======
+    K
+        The compiledKey to encrypt with.
+    binArr
+        The 1D binary array to encrypt, which is not changed.
+    noiseSeed
+        The seed of the noise XORed with the message, reduced to 32 bits as by CA.setNoiseSeed.
+    out, work
+        Optional uint8 arrays of the same length as binArr, out for the encrypted array and
+        work used between steps. New arrays are used if not given.
+    progress
+        An optional progressMonitor, see runSteps. A progressMonitor must not be shared
+        between calls running at the same time.
+
+    RETURNS
+    =======
+    out
+        The encrypted array.
+    hints
+        The masked step hints (see CA.getMaskedHints) for a key with encDir "forward", else None.
+    """
+
+    noiseSeed = noiseSeed % 2**32
+    x = asBinArr(binArr,"Array to encrypt",copy=False)
+    if len(x)<K.k:
+        EXIT("Vector size must be at least that of neighbourhood size.")
+    out  = keyBuffer(out,len(x),"out")
+    work = keyBuffer(work,len(x),"work")
+    if np.shares_memory(out,work):
+        EXIT("out and work must not share memory")
+
+    np.copyto(out,x)
+    noiseKernel(K.noiseGen,noiseSeed,out,K.noiseChunk,K.noiseWorkers)
+
+    if K.encDir == "forward":
+        hints = []
+        runSteps(K,out,work,True,hints=hints,progress=progress,label="encryption")
+        masks = hintMasksKernel(K.fingerprint,noiseSeed,K.numSteps,K.k)
+        return out, [h ^ m for h, m in zip(hints,masks)]
+
+    runSteps(K,out,work,False,progress=progress,label="encryption")
+    return out, None
+
+
+def decryptWithKey(K,binArr,noiseSeed,hints=None,out=None,work=None,progress=None):
+    """
+    Decrypt a binary array with the compiledKey K and the noise seed noiseSeed, giving the
+    same result as CA.decryptArr. hints are the masked step hints, needed for a key with encDir
+    "forward". The other arguments are as for encryptWithKey.
+
+    RETURNS
+    =======
+    out
+        The decrypted array.
+    """
+
+    noiseSeed = noiseSeed % 2**32
+    x = asBinArr(binArr,"Array to decrypt",copy=False)
+    if len(x)<K.k:
+        EXIT("Vector size must be at least that of neighbourhood size.")
+    out  = keyBuffer(out,len(x),"out")
+    work = keyBuffer(work,len(x),"work")
+    if np.shares_memory(out,work):
+        EXIT("out and work must not share memory")
+
+    np.copyto(out,x)
+    if K.encDir == "forward":
+        if hints is None or len(hints) != K.numSteps:
+            EXIT("Need one step hint for each of the "+str(K.numSteps)+" steps")
+        masks = hintMasksKernel(K.fingerprint,noiseSeed,K.numSteps,K.k)
+        runSteps(K,out,work,False,guesses=[int(h) ^ m for h, m in zip(hints,masks)],\
+                 progress=progress,label="decryption")
+    else:
+        runSteps(K,out,work,True,progress=progress,label="decryption")
+
+    noiseKernel(K.noiseGen,noiseSeed,out,K.noiseChunk,K.noiseWorkers)
+    return out
+
+
+def encryptBytesWithKey(K,data,noiseSeed):
+    """
+    Encrypt bytes with the compiledKey K, giving the same bytes as CA.encryptBytes.
+    """
+
+    out, hints = encryptWithKey(K,bytes2BinArr(data),noiseSeed)
+    out = binArr2Bytes(out)
+    if hints is not None:
+        out = np.array(hints,dtype="<u8").tobytes() + out
+    return out
+
+
+def decryptBytesWithKey(K,data,noiseSeed):
+    """
+    Decrypt bytes encrypted with encryptBytesWithKey (or CA.encryptBytes) with the
+    compiledKey K.
+    """
+
+    hints = None
+    if K.encDir == "forward":
+        data = memoryview(data).cast("B")
+        nh = 8*K.numSteps
+        if len(data)<nh:
+            EXIT("Encrypted bytes too short to contain the step hints")
+        hints = np.frombuffer(data[:nh],dtype="<u8")
+        data = data[nh:]
+    return binArr2Bytes(decryptWithKey(K,bytes2BinArr(data),noiseSeed,hints=hints))
@@ -0,0 +1,245 @@
+import os
+import mmap
+import struct
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.compress import *
+
+
+# The header of a packed container
+packedMagic   = b"CApk"
+packedVersion = 3
+packedHeader  = struct.Struct("<4sHIIBBBIQI")
+
+# The headers of earlier versions, version 1 had no channels and version 2 no codec
+packedHeaders = {1:struct.Struct("<4sHIIBIQI"), 2:struct.Struct("<4sHIIBBIQI"), 3:packedHeader}
+
+# The output formats, and the extension of each used for the default output filenames
+outputFormats = {"png":".png", "packed":".cab"}
+
+
+def savePackedCipher(filename,binArr,dim,k=0,T=0,hints=None,codec=None):
+    """
+    Save a binary array as a packed container, a small header followed by the array packed 8
+    cells per byte (most significant bit first). Unlike a png there is no compression, which
+    cannot shrink ciphertext and only costs time, and the file is written with a single write.
+
+    PACKED FILE LAYOUT
+    ==================
+
+        magic       4 bytes     b"CApk"
+        version     uint16      the format version, currently 3
+        height      uint32      the image dimensions, so the array can be saved as an image
+        width       uint32
+        channels    uint8       the number of channels of each pixel (1 for greyscale)
+        codec       uint8       the codec the message was compressed with before it was
+                                encrypted (see compressCodecs), 0 if it was not compressed
+        k           uint8       the neighbourhood size of the key that encrypted the array,
+                                0 if the array is not encrypted
+        T           uint32      the number of steps of the key that encrypted the array
+        length      uint64      the number of cells in the array
+        numHints    uint32      the number of step hints, see CA.getMaskedHints
+        hints       numHints uint64 masked step hints
+        cells       ceil(length/8) bytes of packed cells
+
+    All integers are little endian. Version 1 containers (without channels or codec) and
+    version 2 containers (without codec) are still read. Unless the message is compressed, the
+    number of bits of each value of the image (8 or 16) is length over the product of the
+    dimensions, see saveBinArr2BWImage.
+
+    INPUTS
+    ======
+    filename
+        The filename to save the container to.
+    binArr
+        The 1D binary array to save.
+    dim
+        The dimensions of the image the array corresponds to, as returned by readBWImage2BinArr.
+    k, T
+        The neighbourhood size and number of steps of the key that encrypted binArr.
+    hints
+        The masked step hints of a key that encrypts with forwards steps.
+    codec
+        The name of the codec binArr was compressed with before it was encrypted, see
+        compressBinArr, None if it was not compressed.
+    """
+
+    binArr = np.asarray(binArr)
+    if len(binArr.shape) != 1:
+        EXIT("Array to save as a packed container must be 1D")
+    if len(dim) not in (2,3):
+        EXIT("Dimensions of a packed container must be 2D, or 3D with the channels last")
+    channels = dim[2] if len(dim) == 3 else 1
+    if hints is None:
+        hints = []
+
+    head = packedHeader.pack(packedMagic,packedVersion,dim[0],dim[1],channels,codecId(codec),k,T,\
+                             len(binArr),len(hints))
+    head += np.array(hints,dtype="<u8").tobytes()
+
+    with open(filename,"wb") as f:
+        f.write(head+np.packbits(binArr.astype(np.uint8,copy=False)).tobytes())
+
+
+def isPackedCipher(filename):
+    """
+    Return True if filename is a packed container, from the magic at the start of the file.
+    """
+
+    with open(filename,"rb") as f:
+        return f.read(len(packedMagic)) == packedMagic
+
+
+def readPackedHeader(M,filename):
+    """
+    Read the header and step hints of the packed container filename, whose contents are the
+    buffer M (e.g. a memory map of the file).
+
+    RETURNS
+    =======
+    dims, k, T, hints, codec
+        As returned by readPackedCipher.
+    offset
+        The offset in bytes of the packed cells in M.
+    length
+        The number of cells.
+    """
+
+    if len(M)<6:
+        EXIT("Packed container '"+filename+"' is truncated")
+    magic, version = struct.unpack_from("<4sH",M,0)
+    if magic != packedMagic:
+        EXIT("'"+filename+"' is not a packed container")
+    if version not in packedHeaders:
+        EXIT("Packed container '"+filename+"' has unsupported version "+str(version))
+    H = packedHeaders[version]
+    if len(M)<H.size:
+        EXIT("Packed container '"+filename+"' is truncated")
+    channels, codec = 1, 0
+    if version == 1:
+        magic, version, height, width, k, T, length, numHints = H.unpack_from(M,0)
+    elif version == 2:
+        magic, version, height, width, channels, k, T, length, numHints = H.unpack_from(M,0)
+    else:
+        magic, version, height, width, channels, codec, k, T, length, numHints = H.unpack_from(M,0)
+    s = H.size+8*numHints
+    if len(M) != s+(length+7)//8:
+        EXIT("Packed container '"+filename+"' is truncated")
+    hints = None
+    if numHints>0:
+        hints = [int(h) for h in np.frombuffer(M,dtype="<u8",count=numHints,offset=H.size)]
+
+    dims = (height,width) if channels == 1 else (height,width,channels)
+    return dims, k, T, hints, codecName(codec), s, length
+
+
+def readPackedCipher(filename):
+    """
+    Read a packed container written by savePackedCipher through a memory map of the file.
+
+    RETURNS
+    =======
+    array
+        The 1D binary (uint8) array of cells.
+    dims
+        The dimensions of the image the array corresponds to, (height,width) or
+        (height,width,channels).
+    k, T
+        The neighbourhood size and number of steps of the key that encrypted the array, or 0
+        if the array is not encrypted.
+    hints
+        The list of masked step hints, None if there are none.
+    codec
+        The name of the codec the message was compressed with before it was encrypted, None if
+        it was not compressed.
+    """
+
+    if not os.path.exists(filename):
+        EXIT("Packed container "+filename+" does not exist")
+
+    with open(filename,"rb") as f:
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as M:
+            dims, k, T, hints, codec, s, length = readPackedHeader(M,filename)
+            packed = np.frombuffer(M,dtype=np.uint8,offset=s)
+            binArr = np.unpackbits(packed,count=length)
+            del packed
+
+    return binArr, dims, k, T, hints, codec
+
+
+def readCipherInput(filename,k=None,T=None):
+    """
+    Read an image or packed container to a binary array, detecting which from the file.
+
+    If k and T are given (when decrypting), a packed container recorded as encrypted with a
+    different k or T is rejected.
+
+    RETURNS
+    =======
+    array
+        The 1D binary (uint8) array of cells.
+    dims
+        The dimensions of the image the array corresponds to.
+    hints
+        The list of masked step hints stored with the array (from the 'CA step hints' text
+        chunk of an image), None if there are none.
+    format
+        The format of the file, "png" for an image or "packed" for a packed container.
+    codec
+        The name of the codec the message was compressed with before it was encrypted (only
+        recorded in packed containers), None if it was not compressed.
+    """
+
+    if not os.path.exists(filename):
+        EXIT("Input file '"+filename+"' does not exist.")
+
+    if isPackedCipher(filename):
+        binArr, dims, kIn, TIn, hints, codec = readPackedCipher(filename)
+        if k is not None and kIn != 0 and (kIn,TIn) != (k,T):
+            EXIT("Packed container '"+filename+"' was encrypted with k="+str(kIn)+" and T="+\
+                 str(TIn)+", not the k="+str(k)+" and T="+str(T)+" of the key")
+        return binArr, dims, hints, "packed", codec
+
+    binArr, dims = readBWImage2BinArr(filename)
+    hints = None
+    meta = readImageMeta(filename)
+    if "CA step hints" in meta:
+        hints = [int(h) for h in meta["CA step hints"].split()]
+    return binArr, dims, hints, "png", None
+
+
+def saveCipherOutput(filename,binArr,dim,fmt="png",k=0,T=0,hints=None,codec=None):
+    """
+    Save a binary array either as a png image (fmt "png") with saveBinArr2BWImage, or as a
+    packed container (fmt "packed") with savePackedCipher. k, T and the masked step hints
+    hints are those of the key that encrypted binArr, and codec that the message was
+    compressed with, which can only be recorded in a packed container.
+    """
+
+    if fmt == "packed":
+        savePackedCipher(filename,binArr,dim,k,T,hints,codec)
+    elif fmt == "png":
+        if codec is not None:
+            EXIT("A compressed message can only be saved as a packed container")
+        meta = None
+        if hints is not None:
+            meta = {"CA step hints":" ".join([str(h) for h in hints])}
+        saveBinArr2BWImage(filename,binArr,dim,meta=meta)
+    else:
+        EXIT("Unknown output format '"+str(fmt)+"', use one of "+", ".join(outputFormats))
+
+
+def chooseOutputFormat(fmt,inFormat,filename=None):
+    """
+    Return the output format fmt, unless fmt is "auto" in which case the format is that of the
+    extension of the output filename (if given and one of outputFormats), else inFormat.
+    """
+
+    if fmt != "auto":
+        return fmt
+    if filename is not None:
+        for name, ext in outputFormats.items():
+            if filename.lower().endswith(ext):
+                return name
+    return inFormat
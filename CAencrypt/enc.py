@@ -1,10 +1,294 @@
 import random as r
 import numpy as np
 import time
+import hashlib
 from os.path import exists
 
 from CAencrypt.util import *
 from CAencrypt.rand import *
+from CAencrypt.progress import *
+
+
+def stepKernel(lut,k,x,out,chunk=65536,workers=1,progress=None,boundary=None):
+    """
+    Write the state after a single forwards CA step from the binary (uint8) array x to out,
+    for the rules with lookup table lut (see CA.setRuleTables) and neighbourhood size k.
+
+    The cells are processed chunk cells at a time. For each chunk the integer value of
+    every neighbourhood is built with k vectorised shift/or operations over the cells of
+    the chunk (plus the (k-1)/2 cells either side, wrapping around the periodic boundary),
+    and the next state of each cell is then looked up in lut.
+
+    If boundary (an array of k-1 cells) is given the boundary is fixed rather than periodic.
+    The neighbourhood of each cell is then the k-1 cells before it and itself, with the cells
+    of boundary before cell 0, see reverseFixedKernel.
+
+    The chunks are independent, so are shared between workers threads if workers>1. Only x
+    and out are used, and all the work is numpy operations on whole chunks (which release
+    the GIL), so separate threads can step separate states at the same time.
+
+    If progress (a progressMonitor) is given it is ticked after each chunk.
+    """
+
+    N = len(x)
+    kOffset = (k-1)//2
+
+    def stepCells(a,idx):
+        b = min(a+chunk,N)
+        m = b-a
+        # The cells in the chunk along with the neighbourhoods of the cells at either end
+        if boundary is not None:
+            if a-k+1>=0:
+                W = x[a-k+1:b]
+            else:
+                W = np.concatenate((boundary[a:],x[:b]))
+        elif a-kOffset>=0 and b+kOffset<=N:
+            W = x[a-kOffset:b+kOffset]
+        else:
+            W = np.take(x,np.arange(a-kOffset,b+kOffset),mode="wrap")
+
+        # Build the integer value of each neighbourhood, leftmost cell most significant
+        I = idx[:m]
+        I[:] = W[0:m]
+        for j in range(1,k):
+            np.left_shift(I,1,out=I)
+            np.bitwise_or(I,W[j:j+m],out=I)
+
+        np.take(lut,I,out=out[a:b])
+        return m
+
+    starts = range(0,N,chunk)
+    if workers>1 and len(starts)>1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers) as P:
+            for m in P.map(lambda a: stepCells(a,np.empty(chunk,dtype=np.intp)),starts):
+                if progress is not None:
+                    progress.tick(m)
+    else:
+        idx = np.empty(min(chunk,N),dtype=np.intp)
+        for a in starts:
+            m = stepCells(a,idx)
+            if progress is not None:
+                progress.tick(m)
+
+
+def reverseStepKernel(g,k,y,out,guesses,progress=None):
+    """
+    Write a backwards CA step of the binary (uint8) array y to out, for the rules with the
+    chain-rule table g (as a list, see CA.setRuleTables) and neighbourhood size k, trying each
+    guess of the first k-1 bits in guesses in turn. See CA.singleCAstepReverseL for the method.
+
+    If progress (a progressMonitor) is given it is ticked after every 65536 cells.
+
+    Returns True if a backwards step was found, else False (and out holds no valid step).
+    """
+
+    N = len(y)
+    kOffset = (k-1)//2
+    mask = 2**(k-1)-1
+    chunk = N if progress is None else 65536
+
+    # The cells at time t_i and the array the cells at t_{i-1} are written to
+    Y = memoryview(np.ascontiguousarray(y))
+    O = memoryview(out)
+
+    for b in guesses:
+
+        # The guess of the first k-1 bits, held as the integer prev where the leftmost
+        # bit is the most significant. The last (k-1)/2 of these are the first cells of
+        # the previous timestep
+        prev = b
+        for l in range(kOffset):
+            O[l] = (b>>(kOffset-1-l)) & 1
+
+        # Run from the last k-1 cells from the current timestep over a periodic boundary
+        # to the last element of the current time step cells. As the rule output is
+        # g(prev) XOR bit, the appended bit giving the required cell value v is g(prev) XOR v
+        c = kOffset
+        for a in range(0,N-kOffset,chunk):
+            for v in Y[a:min(a+chunk,N-kOffset)]:
+                bit = g[prev] ^ v
+                prev = ((prev<<1)|bit) & mask
+                O[c] = bit
+                c += 1
+            if progress is not None:
+                progress.tick(min(chunk,N-kOffset-a))
+
+        # The final (k-1)/2 cells wrap around the periodic boundary, so are only needed
+        # for the periodicity check
+        for v in Y[N-kOffset:]:
+            prev = ((prev<<1)|(g[prev]^v)) & mask
+        if progress is not None:
+            progress.tick(kOffset,guesses=1)
+
+        # Now check that the periodicity condition is also satisfied, i.e. the last k-1
+        # cells calculated are the same as the guessed first k-1 cells
+        if prev == b:
+            return True
+
+    return False
+
+
+def reverseFixedKernel(g,k,y,out,boundary,progress=None):
+    """
+    Write a backwards CA step of the binary (uint8) array y to out for a fixed boundary (see
+    stepKernel), for the rules with the chain-rule table g (as a list, see CA.setRuleTables)
+    and neighbourhood size k, where boundary is the array of the k-1 cells before cell 0.
+
+    The first k-1 cells of the neighbourhood of cell 0 are the known boundary cells, so
+    unlike reverseStepKernel nothing is guessed. Each cell is g(prev) XOR the cell of y,
+    where prev is the k-1 cells before it, giving the backwards step in a single pass with
+    no check at the end (every state has exactly one predecessor).
+
+    If progress (a progressMonitor) is given it is ticked after every 65536 cells.
+    """
+
+    N = len(y)
+    mask = 2**(k-1)-1
+    chunk = N if progress is None else 65536
+
+    Y = memoryview(np.ascontiguousarray(y))
+    O = memoryview(out)
+
+    prev = 0
+    for c in boundary:
+        prev = (prev<<1) | int(c)
+
+    c = 0
+    for a in range(0,N,chunk):
+        for v in Y[a:a+chunk]:
+            bit = g[prev] ^ v
+            prev = ((prev<<1)|bit) & mask
+            O[c] = bit
+            c += 1
+        if progress is not None:
+            progress.tick(min(chunk,N-a),guesses=1 if a+chunk>=N else 0)
+
+
+def fixedBoundaryKernel(k,g):
+    """
+    Return the k-1 cells (as a uint8 array) before cell 0 of a key with a fixed boundary, a
+    constant derived from the key with a sha256 hash of k and the chain-rule table g.
+    """
+
+    h = hashlib.sha256(b"CAboundary"+bytes([k])+np.packbits(np.asarray(g,dtype=np.uint8)).tobytes())
+    return np.unpackbits(np.frombuffer(h.digest(),dtype=np.uint8))[:k-1].copy()
+
+
+def fixedStepMirrored(t):
+    """
+    Return True if the forwards step from the state after t steps of a key with a fixed
+    boundary (and so the backwards step back to that state) is taken on the mirrored array,
+    i.e. with the boundary after the last cell and the neighbourhood of each cell the k-1
+    cells after it.
+
+    With a fixed boundary nothing wraps around, so a step only spreads a change towards the
+    end of the array, and a change near the end of the message spreads to almost no cells.
+    Mirroring every other step spreads changes towards the start as well, so the cells at
+    either end get about the same diffusion as those of a periodic key.
+    """
+
+    return t%2 == 1
+
+
+def reverseGuessKernel(revNext,y,progress=None):
+    """
+    Return the smallest guess of the first k-1 bits for which reverseStepKernel finds a
+    backwards step of the binary array y, or None if there is no backwards step, where
+    revNext is as in CA.setRuleTables.
+
+    Rather than a pass over the cells for each guess in turn, all 2^(k-1) guesses are run
+    together as an array of the k-1 bit states of reverseStepKernel, with every state
+    updated for each cell by a single lookup in revNext. A guess is valid if its state
+    after the last cell is the guess itself. This is a single (vectorised) pass over the
+    cells, rather than about 2^(k-2) passes for the scan over the guesses.
+
+    If progress (a progressMonitor) is given it is ticked after every 65536 cells.
+    """
+
+    N = len(y)
+    chunk = N if progress is None else 65536
+    guesses = np.arange(len(revNext[0]),dtype=np.intp)
+    P = guesses.copy()
+    Q = np.empty_like(P)
+    Y = memoryview(np.ascontiguousarray(y))
+    for a in range(0,N,chunk):
+        for v in Y[a:a+chunk]:
+            np.take(revNext[v],P,out=Q)
+            P, Q = Q, P
+        if progress is not None:
+            progress.tick(min(chunk,N-a),guesses=len(guesses) if a+chunk>=N else 0)
+
+    valid = np.flatnonzero(P == guesses)
+    if len(valid) == 0:
+        return None
+    return int(valid[0])
+
+
+def stepHintKernel(k,x):
+    """
+    Return the first k-1 cells of the neighbourhood of cell 0 of the binary array x, i.e. the
+    cells -(k-1)/2 to (k-1)/2-1 wrapping around the periodic boundary, as an integer with the
+    leftmost cell the most significant bit.
+
+    This is the guess with which reverseStepKernel recovers x from the result of a forwards
+    step from x.
+    """
+
+    kOffset = (k-1)//2
+    h = 0
+    for c in range(-kOffset,kOffset):
+        h = (h<<1) | int(x[c])
+    return h
+
+
+def noiseKernel(noiseGen,noiseSeed,binArr,chunk=1048576,workers=1,offset=0):
+    """
+    XOR the binary array binArr in place with the noise array generated with the noise
+    random seed noiseSeed and the noise generator named noiseGen (see noiseGens). If offset is
+    given binArr is XORed with the noise from bit offset, i.e. binArr is the segment of the
+    message from cell offset.
+
+    The noise is generated a chunk at a time. For the sequential 'Even Quicker and Dirtier
+    Generator' the generator continues the same sequence of bits from one chunk to the
+    next, while for a counter based generator each chunk is generated directly from its
+    offset, so the chunks are shared between workers threads.
+    """
+
+    R = noiseGens[noiseGen](noiseSeed)
+    starts = range(0,len(binArr),chunk)
+
+    if hasattr(R,"bitsAt"):
+        def XORchunk(a):
+            b = min(a+chunk,len(binArr))
+            np.bitwise_xor(binArr[a:b],R.bitsAt(offset+a,b-a),out=binArr[a:b])
+        if workers>1 and len(starts)>1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as P:
+                list(P.map(XORchunk,starts))
+        else:
+            for a in starts:
+                XORchunk(a)
+    else:
+        R.skip(offset)
+        for a in starts:
+            b = min(a+chunk,len(binArr))
+            R.EQaDGbA(b-a)
+            np.bitwise_xor(binArr[a:b],R.randBitArr,out=binArr[a:b])
+
+
+def hintMasksKernel(fingerprint,noiseSeed,numSteps,k):
+    """
+    Return a list of numSteps masks for the step hints, each k-1 bits from a SHA-256 hash of
+    the key fingerprint, the noise seed and the step number.
+    """
+
+    masks = []
+    for i in range(numSteps):
+        h = hashlib.sha256(fingerprint+int(noiseSeed).to_bytes(8,"little")+i.to_bytes(4,"little"))
+        masks.append(int.from_bytes(h.digest()[:8],"little") & (2**(k-1)-1))
+    return masks
+
 
 class CA:
     """
@@ -19,10 +303,20 @@ class CA:
     NOTABLE VARIABLES
     =================
 
+    g:
+        The chain-rule table holding the rules for the CA. All rules have Zleft=1, so the two
+        neighbourhoods with the same k-1 leftmost bits give different outputs, and the output
+        of a neighbourhood is g[s] XOR x, where s is the integer value of the k-1 leftmost
+        bits and x the rightmost bit. g is a uint8 array of 2^(k-1) values.
+
     rules:
-        A dictionary containing the rules for the CA. The key is the k bits from time t_i and the
+        The rules as a dictionary, derived from g. The key is the k bits from time t_i and the
         value is a 1 or zero corresponding to that neighbourhood.
 
+    lut, revG, revNext:
+        The rules as lookup tables, used by the forwards and backwards steps respectively, see
+        setRuleTables.
+
     start:
         The array of cells at the initial timestep from which each forwards step is taken from.
         The final array of cells if we take multiple steps backwards (from end).
@@ -34,6 +328,51 @@ class CA:
     CAts:
         The working array of CA cells.
 
+    encDir:
+        The direction of the CA steps used for encryption, part of the key. Either "reverse"
+        (the default, following [1]) where encryption takes backwards steps and decryption the
+        cheaper forwards steps, or "forward" where the roles are swapped.
+
+    noiseGen:
+        The name of the generator of the noise XORed with the message, part of the key. Either
+        "EQaDG" (the default, see randEQaDG) or the counter based "philox" (see randPhilox).
+
+    boundary:
+        The boundary of the CA, part of the key. Either "periodic" (the default, following [1])
+        where the cells form a ring, or "fixed" where the neighbourhood of each cell is the
+        k-1 cells before it and itself, with the k-1 cells before cell 0 a constant derived
+        from the key (fixedCells, see fixedBoundaryKernel). A fixed boundary makes each
+        backwards step a single pass with no guessing, see reverseFixedKernel, so encryption
+        costs about the same as decryption. As nothing wraps around the boundary, every other
+        step is taken on the mirrored array (see fixedStepMirrored), so changes to the message
+        spread in both directions rather than only to the cells after them.
+
+    channelLayout:
+        How the channels of a multi-channel image are encrypted, part of the key. Either
+        "interleaved" (the default) where the values of all channels are encrypted as one ring
+        in the order they are stored, or "planar" where each channel plane is encrypted as its
+        own ring, see channels.cryptImage.
+
+    stepChunk, stepWorkers, revEngine, noiseChunk, noiseWorkers:
+        The execution plan of the steps and the noise, which only changes how fast the results
+        are found and never the results, see setPlan.
+
+    stepHints:
+        For keys with encDir "forward", the first k-1 cells (about cell 0) of the state before
+        each forwards encryption step. As a state can have more than one predecessor these are
+        needed to reverse the forwards steps to the original message, and they also let each
+        backwards step be taken in a single pass with no guessing. They are stored with the
+        ciphertext masked with a key derived hash, see getMaskedHints.
+
+    CAwork:
+        A second array of the same size as CAts. Each step writes the next state into CAwork
+        and then swaps CAts and CAwork, so no arrays are allocated while stepping.
+
+    All the cell arrays are uint8 arrays, validated as binary once when set through
+    setBinStartVec or setBinEndVec. Note start and end are views of the two buffers CAts and
+    CAwork, rather than copies, so start is overwritten when stepping forwards from start
+    (and end when stepping backwards from end).
+
     REFERENCES
     ==========
     [1] Wuensche A. Encryption using cellular automata chain-rules. 
@@ -51,8 +390,16 @@ class CA:
         # Maximum chances to generate a valid rulest
         self.ruleGenCutoff = 100
         
-        # An empty value to hold the CA rules (as a dict)
-        self.rules = None
+        # An empty value to hold the CA rules (as the chain-rule table g)
+        self.g = None
+
+        # The CA rules as lookup tables for the forwards and backwards steps
+        self.lut     = None
+        self.revG    = None
+        self.revNext = None
+
+        # The cells before cell 0 for a fixed boundary, derived from the rules
+        self.fixedCells = None
 
         # The size of the neighbourhood
         self.k = k
@@ -89,6 +436,9 @@ class CA:
         # Temporary vector to use for each time step
         self.CAts = None
 
+        # Second buffer for each time step to be written to
+        self.CAwork = None
+
         # Final value of the CA
         self.end = None
 
@@ -102,6 +452,26 @@ class CA:
         # The seed to be used for the noise array to XOR with
         self.noiseSeed = noiseSeed
 
+        # The direction of the encryption steps, and the step hints for forwards encryption
+        self.encDir    = "reverse"
+        self.stepHints = None
+
+        # The generator used for the noise array
+        self.noiseGen = "EQaDG"
+
+        # The boundary of the CA
+        self.boundary = "periodic"
+
+        # How the channels of multi-channel images are encrypted
+        self.channelLayout = "interleaved"
+
+        # The execution plan, see setPlan
+        self.stepChunk    = 65536
+        self.stepWorkers  = 1
+        self.revEngine    = "scan"
+        self.noiseChunk   = 1048576
+        self.noiseWorkers = 1
+
         
     def setRandSeed(self):
         """
@@ -162,6 +532,138 @@ class CA:
         self.noiseSeed = S % 0b100000000000000000000000000000000
 
 
+    def setEncDir(self,D):
+        """
+        Set the direction of the CA steps used for encryption, either "reverse" or "forward".
+        """
+
+        if D not in ("reverse","forward"):
+            EXIT("Encryption direction must be 'reverse' or 'forward'")
+        if D == "forward" and self.boundary == "fixed":
+            EXIT("Keys with a fixed boundary encrypt with backwards steps, as these need no "+\
+                 "guessing, so cannot have encryption direction 'forward'")
+
+        self.encDir = D
+
+
+    def setNoiseGen(self,G):
+        """
+        Set the generator used for the noise array, one of the names in noiseGens.
+        """
+
+        if G not in noiseGens:
+            EXIT("Unknown noise generator '"+str(G)+"', use one of "+", ".join(noiseGens))
+
+        self.noiseGen = G
+
+
+    def setBoundary(self,B):
+        """
+        Set the boundary of the CA, either "periodic" or "fixed". A fixed boundary is only
+        used with encryption direction "reverse".
+
+        With a fixed boundary a single step only spreads a change to the cells after it, as
+        nothing wraps around the boundary. Every other step is therefore taken on the mirrored
+        array (see fixedStepMirrored), so from the second step on changes spread in both
+        directions. A key with a fixed boundary and a single step still gives the last cells
+        of the message almost no diffusion.
+        """
+
+        if B not in ("periodic","fixed"):
+            EXIT("Boundary must be 'periodic' or 'fixed'")
+        if B == "fixed" and self.encDir == "forward":
+            EXIT("Keys with a fixed boundary encrypt with backwards steps, as these need no "+\
+                 "guessing, so cannot have encryption direction 'forward'")
+
+        self.boundary = B
+
+
+    def setChannelLayout(self,L):
+        """
+        Set how the channels of multi-channel images are encrypted, either "interleaved" or
+        "planar".
+        """
+
+        if L not in ("interleaved","planar"):
+            EXIT("Channel layout must be 'interleaved' or 'planar'")
+
+        self.channelLayout = L
+
+
+    def setPlan(self,plan):
+        """
+        Set the execution plan from a dictionary (e.g. as chosen by plan.planSteps), where any
+        of the following not in the dictionary are left unchanged.
+
+        stepChunk:
+            The number of cells processed at a time in each forwards step, see singleCAstep.
+        stepWorkers:
+            The number of threads the chunks of each forwards step are shared between.
+        revEngine:
+            How backwards steps find their guess of the first k-1 bits, either "scan" (try
+            each guess in turn) or "guess" (run all the guesses together, see findReverseGuess).
+        noiseChunk:
+            The number of noise bits generated at a time, see XORnoise.
+        noiseWorkers:
+            The number of threads used to generate the noise with a counter based noise
+            generator, see XORnoise.
+        """
+
+        for name in plan:
+            if name in ("stepChunk","stepWorkers","noiseChunk","noiseWorkers"):
+                if not isinstance(plan[name], int) or plan[name]<1:
+                    EXIT("Plan value "+name+" must be a positive integer")
+            elif name == "revEngine":
+                if plan[name] not in ("scan","guess"):
+                    EXIT("Plan revEngine must be 'scan' or 'guess'")
+            else:
+                continue
+            setattr(self,name,plan[name])
+
+
+    def getKeyOptions(self):
+        """
+        Return a dictionary of the key options that are not set to their default values, keyed
+        by the name used in the keyfile.
+
+        D:
+            The encryption direction, see setEncDir.
+        G:
+            The noise generator, see setNoiseGen.
+        B:
+            The boundary, see setBoundary.
+        C:
+            The channel layout, see setChannelLayout.
+        """
+
+        opts = {}
+        if self.encDir != "reverse":
+            opts["D"] = self.encDir
+        if self.noiseGen != "EQaDG":
+            opts["G"] = self.noiseGen
+        if self.boundary != "periodic":
+            opts["B"] = self.boundary
+        if self.channelLayout != "interleaved":
+            opts["C"] = self.channelLayout
+        return opts
+
+
+    def setKeyOptions(self,opts):
+        """
+        Set the key options from a dictionary as returned by getKeyOptions, with any option
+        not in the dictionary set to its default value.
+        """
+
+        for name in opts:
+            if name not in ("D","G","B","C"):
+                EXIT("Unknown key option '"+str(name)+"'")
+        self.boundary = "periodic"
+        self.setEncDir(opts.get("D","reverse"))
+        self.setBoundary(opts.get("B","periodic"))
+        self.setNoiseGen(opts.get("G","EQaDG"))
+        self.setChannelLayout(opts.get("C","interleaved"))
+
+
     def setRandNoiseSeed(self):
         """
         Set the noise seed to a random value.
@@ -171,12 +673,28 @@ class CA:
                           (0b010000000000000000000000000000000,0b100000000000000000000000000000000))
 
         
+    @property
+    def rules(self):
+        """
+        The rules as a dictionary keyed by the k bits of each neighbourhood, None if no rules
+        are set. This is built from g on each access, so is only for inspecting the rules.
+        """
+
+        if self.g is None:
+            return None
+        if self.lut is None:
+            self.setRuleTables()
+        return dict([(padLeftZeros("{0:b}".format(n),self.k),int(self.lut[n])) \
+                     for n in range(self.numk)])
+
+
     def genRulesLeft(self):
         """
-        Generate a dictionary of rules such that Z_left = 1 following [1]
+        Generate a set of rules such that Z_left = 1 following [1]
 
         i.e. a rule that we can reverse by moving from left to right where all pairs of
-        k-1 leftmost bits result in distinct outputs.
+        k-1 leftmost bits result in distinct outputs. Each such pair is one entry of g, the
+        output of the pair ending in 0.
 
         REFERENCES
         ==========
@@ -184,47 +702,97 @@ class CA:
             In: Automata. Luniver Press; 2008. p. 126--138.
         """
 
-        # Initialise rules dictionary
-        self.rules = {}
-        # Generate the left most k-1 bytes by converting the integers in [0,2^(k-1)-1]
+        # For each of the left most k-1 bits, i.e. the integers in [0,2^(k-1)-1], use the RNG
+        # to decide whether the pair ending in 0 gives 0 (and that ending in 1 gives 1), or
+        # the other way around
+        self.g = np.zeros(self.numkM1,dtype=np.uint8)
         for b in range(0,self.numkM1):
-            # Start with just the left most bits, i.e. that we use to create a pair, one
-            # ending in 1 the other in 0. But these must be distinct, so cant both result
-            # in a 0 or 1
-            leftMostBits = padLeftZeros("{0:b}".format(b),self.k-1)
-            # Use RNG to decide which is 1 and which is zero
-            if r.randint(0,1) == 0:
-                self.rules[leftMostBits+"0"] = 0
-                self.rules[leftMostBits+"1"] = 1
-            else:
-                self.rules[leftMostBits+"0"] = 1
-                self.rules[leftMostBits+"1"] = 0
+            self.g[b] = r.randint(0,1)
 
         # We have constructed the rules with Zleft = 1
+        self.setRuleTables()
         self.Zleft = 1.0
         # But we must calcualte the Cright value
         self.Zright = self.calcZright()
 
 
+    def setRuleTables(self):
+        """
+        Derive the lookup tables used when stepping the CA from the chain-rule table g.
+
+        lut is a uint8 array with lut[n] the rule output for the neighbourhood whose k bits
+        are the binary digits of n (most significant bit leftmost), i.e. lut[2*s+x] = g[s]^x.
+
+        revG is g as a list, used for the backwards step with Zleft=1. For the k-1 leftmost
+        bits of a neighbourhood with integer value s, and the known output y of that
+        neighbourhood, revG[s]^y is the rightmost bit of the neighbourhood giving that output.
+
+        revNext is a pair of arrays, where revNext[y][s] is the k-1 rightmost bits of that
+        neighbourhood, i.e. the k-1 leftmost bits of the next neighbourhood of the backwards
+        step, see findReverseGuess.
+
+        fixedCells is the k-1 cells before cell 0 with a fixed boundary, see
+        fixedBoundaryKernel.
+        """
+
+        if self.g is None:
+            EXIT("rules not set, so rule tables cannot be calculated.")
+
+        self.lut = np.empty(self.numk,dtype=np.uint8)
+        self.lut[0::2] = self.g
+        self.lut[1::2] = self.g ^ 1
+
+        # A list, as indexing a list with python ints is faster than indexing an array
+        self.revG = self.g.tolist()
+
+        s = np.arange(self.numkM1,dtype=np.intp)
+        G = self.g.astype(np.intp)
+        self.revNext = [((s<<1)|(G^y)) & (self.numkM1-1) for y in range(2)]
+
+        self.fixedCells = fixedBoundaryKernel(self.k,self.g)
+
+
+    def getWorkArr(self):
+        """
+        Return a uint8 array the same size as self.CAts, that is not self.CAts, for the next
+        step of the CA to be written to. self.CAwork is reused if possible.
+        """
+
+        if self.CAwork is None or self.CAwork.shape != self.CAts.shape \
+           or self.CAwork.dtype != np.uint8 or np.shares_memory(self.CAwork,self.CAts):
+            self.CAwork = np.empty(len(self.CAts),dtype=np.uint8)
+        return self.CAwork
+
+
+    def swapWorkArr(self):
+        """
+        Make the work array (the state just written) the current state self.CAts, and keep the
+        previous state as the next work array if it is a suitable buffer.
+        """
+
+        prev = self.CAts
+        self.CAts = self.CAwork
+        if isinstance(prev,np.ndarray) and prev.dtype == np.uint8 and prev.flags.c_contiguous \
+           and prev.flags.writeable:
+            self.CAwork = prev
+        else:
+            self.CAwork = None
+
+
     def calcZright(self):
         """
         Calculate Zright value from a full CA rule set.
         """
 
-        if self.rules is None:
+        if self.g is None:
             EXIT("rules not set, so Z_right cannot be calcualted.")
+        if self.lut is None:
+            self.setRuleTables()
 
-        totDistinct = 0
-        # Generate the right most k-1 bytes by converting the integers in [0,2^(k-1)-1]
-        for b in range(0,self.numkM1):
-            # Start with just the rigt most bits, i.e. that we use to create a pair
-            # Use all possible binary numbers to achieve this
-            rightMostBits = padLeftZeros("{0:b}".format(b),self.k-1)
-
-            # If each pair, i.e. the two rightMostBits padded with a 1 and a 0 result
-            # in a different value then add 1 to the running total of distinct
-            if self.rules["1"+rightMostBits] != self.rules["0"+rightMostBits]:
-                totDistinct += 2
+        # Each pair of neighbourhoods with the same right most k-1 bits, i.e. padded on the
+        # left with a 0 and a 1, that result in a different value counts 2 towards the
+        # running total of distinct
+        totDistinct = 2*int(np.count_nonzero(self.lut[:self.numkM1] != self.lut[self.numkM1:]))
 
         # Now we can scale to find the final Zright value
         return totDistinct/self.numk
@@ -248,69 +816,123 @@ class CA:
         EXIT("failed to generate valid ruleset after "+str(self.ruleGenCutoff)+" tries.")
     
 
-    def singleCAstep(self):
+    def singleCAstep(self,chunk=None,workers=None,progress=None,mirror=False):
         """
         Take a single CA step taking self.CAts as the state at timestep t_{i} and then
-        overwriting it with the state at time t_{i+1}
+        overwriting it with the state at time t_{i+1}, see stepKernel.
+
+        chunk and workers default to self.stepChunk and self.stepWorkers. With a fixed boundary,
+        if mirror is True the step is taken on the mirrored array, see fixedStepMirrored.
         """
 
         # Check that everything is set correctly
         if self.CAts is None:
             EXIT("CAts not set, so a step cannot be taken.")
-        if self.rules is None:
+        if self.g is None:
             EXIT("rules not set, so a step cannot be taken.")
-            
-        # Loop over each cell, populating the tmp next cell
-        tmpArr = []
-        kOffset = (self.k-1)//2
-        # Find the first k-1 cells of the first neighbourhood with a dummy first bit
-        # that will be removed on the first loop
-        tmpStr = "B"
-        for S in range(-kOffset,kOffset):
-            tmpStr += str(self.CAts[S])
-
-        for C in range(self.CAS):
-            # Append the final cell in the current neighbourhood to the full neighbourhood
-            tmpStr = tmpStr[1:] + str(self.CAts[(C+kOffset)%self.CAS])
-            
-            # Append the resultant cell from the neighbourhood and the rules to a temp array
-            tmpArr.append(int(self.rules[tmpStr]))
+        if self.lut is None:
+            self.setRuleTables()
+
+        if chunk is None:
+            chunk = self.stepChunk
+        if workers is None:
+            workers = self.stepWorkers
+
+        x, out = self.CAts, self.getWorkArr()
+        boundary = None
+        if self.boundary == "fixed":
+            boundary = self.fixedCells
+            if mirror:
+                x, out = x[::-1], out[::-1]
+        stepKernel(self.lut,self.k,x,out,chunk,workers,progress,boundary)
 
-        # Now overwrite the working array with the current timestep
-        self.CAts = np.array(tmpArr)
+        # Now make the newly written array the current timestep
+        self.swapWorkArr()
 
 
-    def CAsteps(self,numSteps=None,verbose=False):
+    def CAsteps(self,numSteps=None,verbose=False,firstStep=0,checkpoint=None,callback=None,\
+                hints=None,label="decryption",progress=None):
         """
         Run the CA for a set number of timesteps and set the result as the final timestep.
 
         This starts from the array self.start, using the array self.CAts as a work array saving
         the result of the steps forwards as self.end.
+
+        When resuming a run self.start is the state after firstStep completed steps, and only
+        the remaining steps are taken. If checkpoint (a checkpointer) is given it is passed the
+        state after every step, as is callback (called with the step number and the state).
+
+        If hints is a list, the step hint (see stepHint) of the state before each step is
+        appended to it. label is the name given to each step in the verbose output.
+
+        If progress (a progressMonitor) is given the progress is reported through it, and the
+        steps stop with CAcancelled if its token is cancelled. self.CAts is then the state
+        after the completed steps, and hints only holds the hints of the completed steps.
         """
 
         # Error checks
         if self.k is None:
             EXIT("k not set before calling CAsteps")
-        if self.rules is None:
+        if self.g is None:
             EXIT("rules not set before calling CAsteps")
 
         if numSteps is None:
             numSteps = self.numSteps
             
         self.CAts = self.start
-        for i in range(numSteps):
+        if progress is not None:
+            progress.begin(label,firstStep,numSteps,len(self.CAts),1)
+        for i in range(firstStep,numSteps):
             if verbose:
                 t = time.time()
-            self.singleCAstep()
+            if progress is not None:
+                progress.beginStep(i+1)
+            if hints is not None:
+                hints.append(self.stepHint())
+            try:
+                self.singleCAstep(progress=progress,mirror=fixedStepMirrored(i))
+            except CAcancelled:
+                if hints is not None:
+                    hints.pop()
+                raise
+            if progress is not None:
+                progress.endStep()
             if verbose:
-                print("    + decryption step : "+str(i+1)," took : "+str('%.3f'%(time.time()-t))+" seconds")
+                print("    + "+label+" step : "+str(i+1)," took : "+str('%.3f'%(time.time()-t))+" seconds")
+            if callback is not None:
+                callback(i+1,self.CAts)
+            if checkpoint is not None:
+                checkpoint.step(i+1,self.CAts,hints)
         self.end = self.CAts
+        if progress is not None:
+            progress.end()
+
 
+    def stepHint(self):
+        """
+        Return the first k-1 cells of the neighbourhood of cell 0 of self.CAts, i.e. the cells
+        -(k-1)/2 to (k-1)/2-1 wrapping around the periodic boundary, as an integer with the
+        leftmost cell the most significant bit.
 
-    def singleCAstepReverseL(self):
+        This is the guess with which singleCAstepReverseL recovers self.CAts from the result
+        of a forwards step from self.CAts.
+        """
+
+        return stepHintKernel(self.k,self.CAts)
+
+
+    def singleCAstepReverseL(self,guess=None,progress=None,mirror=False):
         """
         Perform a step backwards in the CA using the current rules assuming Z_left=1 following [1,2]
 
+        If progress (a progressMonitor) is given it is ticked as the cells are processed.
+
+        If guess is given only that guess of the first k-1 bits is tried (see stepHint),
+        otherwise all possible guesses are tried in turn, or with self.revEngine "guess" the
+        guess is found first by findReverseGuess. With a fixed boundary there is nothing to
+        guess, and the step is a single pass, see reverseFixedKernel, taken on the mirrored
+        array if mirror is True (see fixedStepMirrored).
+
         
         I.e. take a single CA step taking self.CAts as the state at timestep t_{i} and then
         overwriting it with the state at time t_{i-1}
@@ -362,115 +984,149 @@ class CA:
             1st ed. Reading, Massachusetts, USA: Addison Wesley Publishing Company; 1992.
         """
         
+        # Check that everything is set correctly
+        if self.CAts is None:
+            EXIT("CAts not set, so a step cannot be taken.")
+        if self.g is None:
+            EXIT("rules not set, so a step cannot be taken.")
+        if self.revG is None:
+            self.setRuleTables()
+
+        if self.boundary == "fixed":
+            y, out = self.CAts, self.getWorkArr()
+            if mirror:
+                y, out = y[::-1], out[::-1]
+            reverseFixedKernel(self.revG,self.k,y,out,self.fixedCells,progress)
+            self.swapWorkArr()
+            return
+
+        if guess is None and self.revEngine == "guess":
+            guess = self.findReverseGuess(progress)
+            if guess is None:
+                EXIT("Cannot reverse CA step")
+
         # Try for all the possible combinations of the first k-1 bits
-        for b in range(0,self.numkM1):
-            
-            # We have a temporary array to save the attempt at the previous timestep cells to
-            CAtmp = []
-
-            # Guess the first k-1 bits
-            prevBits = padLeftZeros("{0:b}".format(b),self.k-1)
-
-            # Add these to the CAtmp array
-            for l in range(self.k-1):
-                CAtmp.append(int(prevBits[l]))
-
-            # Run from the last k-1 cells from the current timestep over a periodic boundary
-            # to the last element of the current time step cells
-            # for c in range(-((self.k-1)//2),len(self.CAts)-((self.k-1)//2)):
-            for c in range(0,len(self.CAts)):
-                
-                # As we have a binary choice, we only need check if the result of appending the
-                # previous bits with a 1 gives the required cell value, otherwise the correct
-                # appended bit is a zero
-                if self.rules[prevBits+"1"]==self.CAts[c]:
-                    appendBit = "1"
-                else:
-                    appendBit = "0"
-
-                # Add the correct cell to the tmp array for the previous timestep
-                CAtmp.append(int(appendBit))
-
-                # Update the previous bits for the next step
-                prevBits = prevBits[1:] + appendBit
-                
-            # Now check that the periodicity condition is also satisfied
-            correctGuess = True
-            for c in range((self.k-1)//2):
-                if (CAtmp[c] != CAtmp[-(self.k-1)+c]) \
-                   or (CAtmp[c+(self.k-1)//2] != CAtmp[-(self.k-1)//2+c]):
-                    correctGuess = False
-            if correctGuess == True:
-                self.CAts = np.array(CAtmp[(self.k-1)//2:len(CAtmp)-(self.k-1)//2],dtype=int)
-                return
+        if guess is None:
+            guesses = range(0,self.numkM1)
+        else:
+            guesses = [guess]
+        if reverseStepKernel(self.revG,self.k,self.CAts,self.getWorkArr(),guesses,progress):
+            self.swapWorkArr()
+            return
 
         # If we have got this far something has gone wrong
         EXIT("Cannot reverse CA step")
 
 
-    def CAstepsReverse(self,numSteps=None,verbose=False):
+    def findReverseGuess(self,progress=None):
+        """
+        Return the smallest guess of the first k-1 bits for which singleCAstepReverseL finds a
+        backwards step of self.CAts, or None if there is no backwards step, see
+        reverseGuessKernel.
+        """
+
+        if self.CAts is None:
+            EXIT("CAts not set, so a step cannot be taken.")
+        if self.revNext is None:
+            self.setRuleTables()
+
+        return reverseGuessKernel(self.revNext,self.CAts,progress)
+
+
+    def CAstepsReverse(self,numSteps=None,verbose=False,firstStep=0,checkpoint=None,callback=None,\
+                       hints=None,label="encryption",progress=None):
         """
         Run the CA backwards a set number of timesteps from the array self.end and then set the
         resultant array to self.start.
 
         The initial cell array to move backwards from is self.end, with self.CAts used as a work
         array, eventually overwriting self.start with self.end evolved backwards by numSteps time steps.
+
+        When resuming a run self.end is the state after firstStep completed steps, and only
+        the remaining steps are taken. If checkpoint (a checkpointer) is given it is passed the
+        state after every step, as is callback (called with the step number and the state).
+
+        If hints is given, the list of step hints recorded by CAsteps when taking numSteps
+        forwards steps, then each backwards step uses the matching hint as its only guess.
+        label is the name given to each step in the verbose output.
+
+        progress is as for CAsteps.
         """
 
         # Error checks
         if self.k is None:
             EXIT("k not set before calling CAstepsReverse")
-        if self.rules is None:
+        if self.g is None:
             EXIT("rules not set before calling CAstepsReverse")
 
         if numSteps is None:
             numSteps = self.numSteps
 
+        if hints is not None and len(hints) != numSteps:
+            EXIT("Need one step hint for each of the "+str(numSteps)+" steps")
+
         # Need to initially set the CAts from the end point
         self.CAts = self.end
-        for i in range(numSteps):
+        if progress is not None:
+            if hints is not None or self.boundary == "fixed":
+                passes = 1
+            elif self.revEngine == "guess":
+                passes = 2
+            else:
+                passes = (int(self.numkM1)+1)/2
+            progress.begin(label,firstStep,numSteps,len(self.CAts),passes)
+        for i in range(firstStep,numSteps):
             if verbose:
                 t = time.time()
-            self.singleCAstepReverseL()
+            if progress is not None:
+                progress.beginStep(i+1)
+            if hints is not None:
+                self.singleCAstepReverseL(guess=hints[numSteps-1-i],progress=progress)
+            else:
+                self.singleCAstepReverseL(progress=progress,mirror=fixedStepMirrored(numSteps-1-i))
+            if progress is not None:
+                progress.endStep()
             if verbose:
-                print("    + encryption step : "+str(i+1)," took : "+str('%.3f'%(time.time()-t))+" seconds")
+                print("    + "+label+" step : "+str(i+1)," took : "+str('%.3f'%(time.time()-t))+" seconds")
+            if callback is not None:
+                callback(i+1,self.CAts)
+            if checkpoint is not None:
+                checkpoint.step(i+1,self.CAts)
         self.start = self.CAts
+        if progress is not None:
+            progress.end()
 
         
-    def setBinStartVec(self,startVec):
+    def setBinStartVec(self,startVec,copy=True):
         """
         Initialise a starting vector for the CA as a binary array
-        """
 
-        # First make sure the array contains only ones and zeros
-        if np.amax(startVec)>1:
-            EXIT("Staring vector should be binary, contains values > 1.")
-        if np.amin(startVec)<0:
-            EXIT("Staring vector should be binary, contains values < 0.")
+        If copy is False and startVec is already a 1D uint8 array then it is used as the CA
+        state directly (and so will be overwritten), rather than being copied.
+        """
 
         # Check that the vector space is sufficiently large
-        if len(startVec)<self.k:
+        if self.k is not None and len(startVec)<self.k:
             EXIT("Vector size must be at least that of neighbourhood size.")
 
-        # If it only contains acceptable values then set the class array as a numpy array (for ease)
-        self.start = np.array(startVec,dtype=int)
+        # Make sure the array contains only ones and zeros, this is the only time the array is
+        # checked, then set the class array as a uint8 numpy array
+        self.start = asBinArr(startVec,"Staring vector",copy=copy)
 
         # Also set the other arrays as the vector size will always remain the same
-        self.CAts = np.array(startVec,dtype=int)
-        self.end  = np.array(startVec,dtype=int)
-        self.CAS  = len(self.end)
+        self.CAts   = self.start
+        self.end    = self.start
+        self.CAwork = np.empty(len(self.start),dtype=np.uint8)
+        self.CAS    = len(self.end)
 
 
-    def setBinEndVec(self,endVec):
+    def setBinEndVec(self,endVec,copy=True):
         """
         Initialise an ending vector for the CA as a binary array
-        """
 
-        # First make sure the array contains only ones and zeros
-        if np.amax(endVec)>1:
-            EXIT("Ending vector should be binary, contains values > 1.")
-        if np.amin(endVec)<0:
-            EXIT("Ending vector should be binary, contains values < 0.")
+        If copy is False and endVec is already a 1D uint8 array then it is used as the CA
+        state directly (and so will be overwritten), rather than being copied.
+        """
 
         # Check that the k value has been set
         if self.k is None:
@@ -480,125 +1136,372 @@ class CA:
         if len(endVec)<self.k:
             EXIT("Vector size must be at least that of neighbourhood size.")
 
-        # If it only contains acceptable values then set the class array as a numpy array (for ease)
-        self.start = np.array(endVec,dtype=int)
+        # Make sure the array contains only ones and zeros, this is the only time the array is
+        # checked, then set the class array as a uint8 numpy array
+        self.end = asBinArr(endVec,"Ending vector",copy=copy)
 
         # Also set the other arrays as the vector size will always remain the same
-        self.CAts = np.array(endVec,dtype=int)
-        self.end  = np.array(endVec,dtype=int)
-        self.CAS  = len(self.end)
+        self.CAts   = self.end
+        self.start  = self.end
+        self.CAwork = np.empty(len(self.end),dtype=np.uint8)
+        self.CAS    = len(self.end)
+
+
+    def setEncArr(self,binArr,copy=True,xor=True):
+        """
+        Set the message to be encrypted and XOR it with the noise, ready for encSteps.
+
+        The message is set as the end array for keys with encDir "reverse" and the start array
+        for "forward". If xor is False the noise is not added, e.g. when resuming from a state
+        part way through the encryption steps.
+        """
+
+        if self.encDir == "forward":
+            self.setBinStartVec(binArr,copy=copy)
+            if xor:
+                self.XORstartArr()
+            self.stepHints = []
+        else:
+            self.setBinEndVec(binArr,copy=copy)
+            if xor:
+                self.XORendArr()
+
+
+    def encSteps(self,numSteps=None,verbose=False,firstStep=0,checkpoint=None,callback=None,\
+                 progress=None):
+        """
+        Take the encryption steps, in the direction given by encDir, from the array set by
+        setEncArr. The arguments are as for CAsteps and CAstepsReverse.
+        """
+
+        if self.encDir == "forward":
+            self.CAsteps(numSteps=numSteps,verbose=verbose,firstStep=firstStep,checkpoint=checkpoint,\
+                         callback=callback,hints=self.stepHints,label="encryption",progress=progress)
+        else:
+            self.CAstepsReverse(numSteps=numSteps,verbose=verbose,firstStep=firstStep,\
+                                checkpoint=checkpoint,callback=callback,label="encryption",\
+                                progress=progress)
+
+
+    def getEncArr(self):
+        """
+        Return the encrypted array after encSteps.
+        """
+
+        if self.encDir == "forward":
+            return self.end
+        return self.start
+
+
+    def setDecArr(self,binArr,copy=True):
+        """
+        Set the encrypted message to be decrypted, ready for decSteps. For keys with encDir
+        "forward" the step hints must also be set, see setMaskedHints.
+        """
+
+        if self.encDir == "forward":
+            self.setBinEndVec(binArr,copy=copy)
+        else:
+            self.setBinStartVec(binArr,copy=copy)
+
+
+    def decSteps(self,numSteps=None,verbose=False,firstStep=0,checkpoint=None,callback=None,\
+                 progress=None):
+        """
+        Take the decryption steps, in the opposite direction to encDir, from the array set by
+        setDecArr. The arguments are as for CAsteps and CAstepsReverse.
+        """
+
+        if self.encDir == "forward":
+            if self.stepHints is None:
+                EXIT("Step hints not set, so cannot decrypt with a forward encryption key")
+            self.CAstepsReverse(numSteps=numSteps,verbose=verbose,firstStep=firstStep,\
+                                checkpoint=checkpoint,callback=callback,hints=self.stepHints,\
+                                label="decryption",progress=progress)
+        else:
+            self.CAsteps(numSteps=numSteps,verbose=verbose,firstStep=firstStep,checkpoint=checkpoint,\
+                         callback=callback,label="decryption",progress=progress)
+
+
+    def XORdecArr(self):
+        """
+        XOR the result of decSteps with the noise, returning the decrypted array.
+        """
+
+        if self.encDir == "forward":
+            self.XORstartArr()
+            return self.start
+        self.XORendArr()
+        return self.end
+
+
+    def hintMasks(self):
+        """
+        Return a list of numSteps masks for the step hints, each k-1 bits from a SHA-256 hash of
+        the key fingerprint, the noise seed and the step number.
+        """
+
+        if self.noiseSeed is None:
+            EXIT("Noise seed not set, so cannot mask step hints")
+
+        return hintMasksKernel(self.keyFingerprint(),self.noiseSeed,self.numSteps,self.k)
+
+
+    def getMaskedHints(self):
+        """
+        Return the step hints of a forwards encryption masked with hintMasks, so they can be
+        stored alongside the ciphertext without revealing any of the cells.
+        """
+
+        if self.stepHints is None or len(self.stepHints) != self.numSteps:
+            EXIT("Step hints not recorded for every encryption step")
+        return [h ^ m for h, m in zip(self.stepHints,self.hintMasks())]
+
+
+    def setMaskedHints(self,hints):
+        """
+        Set the step hints from the masked step hints returned by getMaskedHints.
+        """
+
+        if len(hints) != self.numSteps:
+            EXIT("Need one step hint for each of the "+str(self.numSteps)+" steps")
+        self.stepHints = [int(h) ^ m for h, m in zip(hints,self.hintMasks())]
+
+
+    def encryptArr(self,binArr,copy=True,verbose=False,progress=None):
+        """
+        Encrypt a binary array in memory with the current key and noise seed, i.e. XOR with the
+        noise and then take numSteps encryption steps (backwards steps unless encDir is
+        "forward", in which case the step hints are recorded in self.stepHints).
+
+        If copy is False and binArr is a uint8 array it is used as the CA state, and so
+        overwritten. The returned array is a view of the CA state, so is overwritten by the next
+        use of this CA. progress is as for CAsteps.
+        """
+
+        self.setEncArr(binArr,copy=copy)
+        self.encSteps(numSteps=self.numSteps,verbose=verbose,progress=progress)
+        return self.getEncArr()
+
+
+    def decryptArr(self,binArr,copy=True,verbose=False,progress=None):
+        """
+        Decrypt a binary array in memory with the current key and noise seed, i.e. take numSteps
+        decryption steps (forwards steps unless encDir is "forward", in which case the step
+        hints must be set) and then XOR with the noise.
+
+        If copy is False and binArr is a uint8 array it is used as the CA state, and so
+        overwritten. The returned array is a view of the CA state, so is overwritten by the next
+        use of this CA. progress is as for CAsteps.
+        """
+
+        self.setDecArr(binArr,copy=copy)
+        self.decSteps(numSteps=self.numSteps,verbose=verbose,progress=progress)
+        return self.XORdecArr()
+
+
+    def encryptBytes(self,data,verbose=False,progress=None):
+        """
+        Encrypt bytes (bytes, a bytearray, a memoryview or a numpy uint8 array) in memory with
+        the current key and noise seed, returning the encrypted bytes.
+
+        For keys with encDir "forward" the encrypted bytes start with the numSteps masked step
+        hints, each as a little endian uint64.
+        """
+
+        out = binArr2Bytes(self.encryptArr(bytes2BinArr(data),copy=False,verbose=verbose,\
+                                           progress=progress))
+        if self.encDir == "forward":
+            out = np.array(self.getMaskedHints(),dtype="<u8").tobytes() + out
+        return out
+
+
+    def decryptBytes(self,data,verbose=False,progress=None):
+        """
+        Decrypt bytes (bytes, a bytearray, a memoryview or a numpy uint8 array) in memory with
+        the current key and noise seed, returning the decrypted bytes.
+        """
+
+        if self.encDir == "forward":
+            data = memoryview(data).cast("B")
+            nh = 8*self.numSteps
+            if len(data)<nh:
+                EXIT("Encrypted bytes too short to contain the step hints")
+            self.setMaskedHints(np.frombuffer(data[:nh],dtype="<u8"))
+            data = data[nh:]
+        return binArr2Bytes(self.decryptArr(bytes2BinArr(data),copy=False,verbose=verbose,\
+                                            progress=progress))
 
 
     def saveKey(self,filename="key.shared"):
         """
-        Save the ruleset by iterating through each pair of integers in [0,k-1] saving output for appending
-        0 then the output for appending 1.
+        Save the ruleset as the chain-rule table g, i.e. for each integer in [0,2^(k-1)) the
+        output for appending 0, the output for appending 1 being the opposite.
         """
 
-        if self.rules is None:
+        if self.g is None:
             EXIT("No rules set, so nothing to save")
         if self.k is None:
             EXIT("k not set, so nothing to save")
         if self.numSteps is None:
             EXIT("Number of steps not set, so nothing to save")
 
-        outputArr = []
-        for b in range(0,self.numkM1):
-            if self.rules[padLeftZeros("{0:b}".format(b),self.k-1)+"0"] == 0:
-                outputArr.append(0)
-                outputArr.append(1)
-            else:
-                outputArr.append(1)
-                outputArr.append(0)
+        outputArr = self.g
 
-        # Save the data out
-        keyHead = "k ::: " + str(self.k) + "\nT ::: " + str(self.numSteps) + "\nR :::"
+        # Save the data out, with any non-default key options between T and the rules
+        keyHead = "k ::: " + str(self.k) + "\nT ::: " + str(self.numSteps) + "\n"
+        for name, val in self.getKeyOptions().items():
+            keyHead += name + " ::: " + str(val) + "\n"
+        keyHead += "R :::"
         np.savetxt(filename, np.array(outputArr,dtype=int), newline=" ", fmt="%s", header=keyHead)
-        
 
-    def readKey(self,filename="key.shared"):
+
+    def getRuleArr(self):
         """
-        Read the ruleset by iterating through each pair of integers in [0,k-1] saving output for appending
-        0 then the output for appending 1.
+        Return the full ruleset as a uint8 array. For each integer b in [0,2^(k-1)) the array
+        holds the output for the k-1 bits of b appended with 0 followed by the output for b
+        appended with 1, i.e. the array is lut.
         """
 
-        # Make sure the keyfile exists
-        if not exists(filename):
-            EXIT("Keyfile '"+filename+"' does not exist")
-            
-        # Read the data in from the output file
-        with open(filename,"r") as f:
-            self.k         = int(f.readline().split(" ")[-1])
-            self.numSteps  = int(f.readline().split(" ")[-1])
-            inputArr       = np.array(f.readline().split(" ")[3:])
+        if self.g is None:
+            EXIT("No rules set, so no rule array")
+        if self.lut is None:
+            self.setRuleTables()
+        return self.lut.copy()
+
+
+    def setRuleArr(self,k,numSteps,ruleArr):
+        """
+        Set k, the number of steps and the ruleset from an array of rule outputs, e.g. as read
+        from a keyfile. The array is either the chain-rule table g of 2^(k-1) outputs, or the
+        full ruleset of 2^k outputs ordered as returned by getRuleArr (as saved in keyfiles
+        before g was used), which must have Zleft=1.
+
+        Any CA cell arrays are emptied, as these may no longer be valid for the new key.
+        """
+
+        self.k        = int(k)
+        self.numSteps = int(numSteps)
 
         # Set all the values related to k
         self.numkM1 = np.power(2,self.k-1)
         self.numk = self.numkM1 * 2
 
+        ruleArr = np.array(ruleArr,dtype=int)
+        if len(ruleArr) == self.numk:
+            if np.any(ruleArr[0::2] == ruleArr[1::2]):
+                EXIT("Ruleset for k="+str(self.k)+" does not have Zleft=1")
+            ruleArr = ruleArr[0::2]
+        elif len(ruleArr) != self.numkM1:
+            EXIT("Ruleset for k="+str(self.k)+" must contain "+str(self.numkM1)+" (or "+\
+                 str(self.numk)+") rules")
+        if np.any((ruleArr != 0) & (ruleArr != 1)):
+            EXIT("Ruleset must only contain 0s and 1s")
+
         # Empty out all the VA vectors (just in case)
         self.start = None
         self.CAts = None
+        self.CAwork = None
         self.end = None
         self.CAS = None
         
         # Then save the input ruleset to the class variable
-        self.rules = {}
-        i = 0
-        for b in range(0,self.numkM1):
-            self.rules[padLeftZeros("{0:b}".format(b),self.k-1)+"0"] = int(inputArr[i])
-            i+=1
-            self.rules[padLeftZeros("{0:b}".format(b),self.k-1)+"1"] = int(inputArr[i])
-            i+=1
+        self.g = ruleArr.astype(np.uint8)
+        self.setRuleTables()
         
         # We currently only use Zleft=1 rulesets, so set/calcualte both Z values
         self.Zleft  = 1.0
-        self.Zright = self.calcZright()            
+        self.Zright = self.calcZright()
         
 
-    def XORstartArr(self):
+    def keyFingerprint(self):
         """
-        XOR the start array with a pseudo random array generated with the noise random seed
-        and the 'Even Quicker and Dirtier Generator'
+        Return a SHA-256 digest (as 32 bytes) of the key, i.e. k, T and the ruleset.
+
+        This identifies the key without revealing it, e.g. to check a checkpoint is resumed
+        with the same key it was written with.
         """
 
-        if self.start is None:
-            EXIT("Start array not set, so cannot XOR with noise")
+        if self.g is None:
+            EXIT("No rules set, so no key fingerprint")
+        if self.k is None:
+            EXIT("k not set, so no key fingerprint")
+
+        h = hashlib.sha256()
+        h.update(("k ::: "+str(self.k)+"\nT ::: "+str(self.numSteps)+"\n").encode())
+        for name, val in self.getKeyOptions().items():
+            h.update((name+" ::: "+str(val)+"\n").encode())
+        h.update("R :::".encode())
+        h.update("".join([str(v) for v in self.g.tolist()]).encode())
+        return h.digest()
+        
+
+    def readKey(self,filename="key.shared"):
+        """
+        Read a keyfile saved by saveKey, holding either the chain-rule table g or (for keys
+        saved before g was used) the full ruleset, see setRuleArr.
+        """
+
+        # Make sure the keyfile exists
+        if not exists(filename):
+            EXIT("Keyfile '"+filename+"' does not exist")
+            
+        # Read the data in from the output file, each line is '# name ::: value' with the
+        # rules on the final line
+        opts = {}
+        with open(filename,"r") as f:
+            k         = int(f.readline().split(" ")[-1])
+            numSteps  = int(f.readline().split(" ")[-1])
+            line      = f.readline()
+            while line.startswith("#") and not line.startswith("# R :::"):
+                name, val = line[1:].split(":::",1)
+                opts[name.strip()] = val.strip()
+                line = f.readline()
+            inputArr  = [s for s in line.split(" ")[3:] if s.strip()]
+
+        self.setRuleArr(k,numSteps,inputArr)
+        self.setKeyOptions(opts)
+        
+
+    def XORnoise(self,binArr,chunk=None):
+        """
+        XOR the binary array binArr in place with the noise array generated with the noise
+        random seed and the noise generator of the key (see noiseGen and noiseKernel).
+
+        chunk defaults to self.noiseChunk, and the chunks of a counter based generator are
+        shared between self.noiseWorkers threads.
+        """
+
+        if chunk is None:
+            chunk = self.noiseChunk
+
         if self.noiseSeed is None:
             EXIT("Noise seed not set, so cannot XOR with noise")
 
-        # Initialise a random number generator class (with the `Even Quicker and Dirtier
-        # Generator' for now
-        R = randEQaDG(self.noiseSeed)
+        noiseKernel(self.noiseGen,self.noiseSeed,binArr,chunk,self.noiseWorkers)
 
-        # Generate an array of random bits of the requisite length
-        R.EQaDGbA(len(self.start))
-        randBitsforXOR = R.randBitArr
-        
-        # And XOR the start array with this `random' array
-        self.start = xorArrays(self.start,randBitsforXOR)
+
+    def XORstartArr(self,chunk=None):
+        """
+        XOR the start array with a pseudo random array generated with the noise random seed
+        and the noise generator of the key, see XORnoise.
+        """
+
+        if self.start is None:
+            EXIT("Start array not set, so cannot XOR with noise")
+
+        self.XORnoise(self.start,chunk)
 
         
-    def XORendArr(self):
+    def XORendArr(self,chunk=None):
         """
         XOR the end array with a pseudo random array generated with the noise random seed
-        and the 'Even Quicker and Dirtier Generator'
+        and the noise generator of the key, see XORnoise.
         """
 
         if self.end is None:
             EXIT("End array not set, so cannot XOR with noise")
-        if self.noiseSeed is None:
-            EXIT("Noise seed not set, so cannot XOR with noise")
 
-        # Initialise a random number generator class (with the `Even Quicker and Dirtier
-        # Generator' for now
-        R = randEQaDG(self.noiseSeed)
-
-        # Generate an array of random bits of the requisite length
-        R.EQaDGbA(len(self.end))
-        randBitsforXOR = R.randBitArr
-        
-        # And XOR the start array with this `random' array
-        self.end = xorArrays(self.end,randBitsforXOR)
+        self.XORnoise(self.end,chunk)
 
 
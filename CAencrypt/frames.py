@@ -0,0 +1,198 @@
+import os
+import hashlib
+from collections import deque
+import numpy as np
+from PIL import Image
+from PIL.TiffImagePlugin import AppendingTiffWriter
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+from CAencrypt.container import *
+from CAencrypt.progress import *
+from CAencrypt.channels import *
+
+
+# The extensions of the files read as frames from a directory, and of multi-page tiff output
+frameExts = (".png",".cab")
+tiffExts  = (".tif",".tiff")
+
+
+def frameSeed(noiseSeed,index):
+    """
+    Return the noise seed of frame index of a multi-frame image encrypted with the base noise
+    seed noiseSeed, so no two frames are XORed with the same noise. The seed is taken from a
+    sha256 hash of the base seed and index, and is never 0.
+    """
+
+    h = hashlib.sha256(b"CAframe"+int(noiseSeed).to_bytes(8,"little")+int(index).to_bytes(8,"little"))
+    return int.from_bytes(h.digest()[:4],"little") or 1
+
+
+def frameFiles(dirname):
+    """
+    Return the sorted list of the frame files (see frameExts) in the directory dirname.
+    """
+
+    return [os.path.join(dirname,f) for f in sorted(os.listdir(dirname)) if f.lower().endswith(frameExts)]
+
+
+def numFrames(filename):
+    """
+    Return the number of frames of a multi-frame image (e.g. an animated gif or multi-page
+    tiff) or a directory of frames, 1 for a single image.
+    """
+
+    if os.path.isdir(filename):
+        return len(frameFiles(filename))
+    if not os.path.exists(filename) or isPackedCipher(filename):
+        return 1
+    try:
+        with Image.open(filename) as im:
+            return getattr(im,"n_frames",1)
+    except OSError:
+        return 1
+
+
+def isMultiFrame(filename):
+    """
+    Return True if filename is a directory of frames or an image with more than one frame.
+    """
+
+    return os.path.isdir(filename) or numFrames(filename)>1
+
+
+def readFrames(filename):
+    """
+    Lazily read the frames of a multi-frame image or directory of frames, one at a time, so only
+    the frames being worked on are held in memory.
+
+    Frames of a multi-frame image keep their channels and bit depth, see imageArray. Frames in
+    a directory are read with readCipherInput, so may be images or packed containers holding step
+    hints.
+
+    YIELDS
+    ======
+    array
+        The 1D binary (uint8) array of the frame.
+    dims
+        The dimensions of the frame.
+    hints
+        The masked step hints stored with the frame, None if there are none.
+    """
+
+    if os.path.isdir(filename):
+        for f in frameFiles(filename):
+            binArr, dims, hints, fmt, codec = readCipherInput(f)
+            if codec is not None:
+                EXIT("Frame '"+f+"' holds a compressed message, which multi-frame input does not support")
+            yield binArr, dims, hints
+        return
+
+    with Image.open(filename) as im:
+        for i in range(getattr(im,"n_frames",1)):
+            im.seek(i)
+            F = imageArray(im,"Frame "+str(i)+" of "+filename)
+            yield image2BinArr(F), F.shape, None
+
+
+class frameSink:
+    """
+    Write the frames of a multi-frame output in order, either each to its own file in the
+    directory filename (named frame00000 etc, as images or packed containers by fmt, see
+    saveCipherOutput) or, if filename ends with a tiff extension, as the pages of a single
+    multi-page tiff image. Tiff pages cannot hold step hints.
+    """
+
+    def __init__(self,filename,fmt="png",k=0,T=0):
+
+        self.filename = filename
+        self.fmt      = fmt
+        self.k        = k
+        self.T        = T
+        self.count    = 0
+        self.tiff     = filename.lower().endswith(tiffExts)
+        self.pages    = None
+        if self.tiff:
+            self.pages = AppendingTiffWriter(filename,new=True)
+        else:
+            os.makedirs(filename,exist_ok=True)
+
+
+    def write(self,binArr,dim,hints=None):
+
+        if self.tiff:
+            if hints is not None:
+                EXIT("Multi-page tiff output cannot hold step hints, output to a directory instead")
+            Image.fromarray(binArr2Image(binArr,dim)).save(self.pages,format="TIFF")
+            self.pages.newFrame()
+        else:
+            name = os.path.join(self.filename,"frame"+str(self.count).zfill(5)+outputFormats[self.fmt])
+            saveCipherOutput(name,binArr,dim,self.fmt,self.k,self.T,hints)
+        self.count += 1
+
+
+    def close(self):
+        if self.pages is not None:
+            self.pages.close()
+            self.pages = None
+
+
+def _frameJob(mode,packed,length,dims,seed,hints):
+    """
+    Encrypt (mode "enc") or decrypt (mode "dec") a single frame with the CA of the worker (see
+    initWorker) and cryptImage, the planes of a frame being taken in turn by the worker. The
+    frame is passed and returned packed 8 cells per byte to cut the cost of sending it between
+    processes. Run with runJob.
+    """
+
+    out, hints = cryptImage(workerState(),mode,np.unpackbits(packed,count=length),dims,seed,hints)
+    return np.packbits(out), hints
+
+
+def mapFrames(C,mode,frames,noiseSeed,workers=1):
+    """
+    Encrypt or decrypt a sequence of frames with the key of the CA C, each with the noise seed
+    frameSeed(noiseSeed,index), on a pool of workers processes.
+
+    Frames are taken from the iterator frames (see readFrames) only as workers become free, with
+    at most two frames per worker queued, and the results are yielded in the order of the
+    frames, so memory stays bounded however long the sequence.
+
+    YIELDS
+    ======
+    array
+        The encrypted or decrypted 1D binary array of the frame.
+    dims
+        The dimensions of the frame.
+    hints
+        The masked step hints of the frame when encrypting with a key with encDir "forward",
+        else None.
+    """
+
+    def jobs():
+        for i, (binArr, dims, hints) in enumerate(frames):
+            job = (_frameJob,mode,np.packbits(binArr),len(binArr),dims,frameSeed(noiseSeed,i),hints)
+            yield dims, len(binArr), job
+
+    def result(dims,length,res):
+        packed, hints = jobResult(res)
+        return np.unpackbits(packed,count=length), dims, hints
+
+    if workers<=1:
+        initWorker(C)
+        for dims, length, job in jobs():
+            yield result(dims,length,runJob(*job))
+        return
+
+    from multiprocessing import Pool
+
+    with Pool(workers,initializer=initWorker,initargs=(C,True)) as P:
+        pending = deque()
+        for dims, length, job in jobs():
+            pending.append((dims,length,P.apply_async(runJob,job)))
+            if len(pending) >= 2*workers:
+                dims, length, R = pending.popleft()
+                yield result(dims,length,R.get())
+        while pending:
+            dims, length, R = pending.popleft()
+            yield result(dims,length,R.get())
@@ -0,0 +1,221 @@
+import os
+import mmap
+import struct
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+
+
+class keyring:
+    """
+    A container of many shared keys in a single file, each stored under a string ID.
+
+    Keys are appended to the end of the ring file, so adding a key never rewrites the keys
+    already in the ring. Alongside the ring is an index file (the ring filename with '.idx'
+    appended) holding the offset of each key in the ring, which is read into a dictionary
+    so each key is found in O(1). The ring itself is accessed through a memory map, so only
+    the pages holding the key that is looked up are read from disk.
+
+    If the index is missing, or is behind the ring (e.g. if a process was killed between
+    appending a key and updating the index), the missing entries are rebuilt by scanning the
+    ring from the last indexed key.
+
+    RING FILE LAYOUT
+    ================
+
+    The file starts with the 8 bytes b"CAring01", followed by the key records. Each record is
+
+        magic       4 bytes     b"CAk2"
+        idLen       uint16      length of the key ID in bytes
+        k           uint8       the neighbourhood size
+        T           uint32      the number of steps
+        Zleft       float32     the Zleft value of the ruleset
+        Zright      float32     the Zright value of the ruleset
+        optLen      uint16      length of the key options in bytes
+        ruleLen     uint32      length of the packed rules in bytes
+        ID          idLen bytes, utf-8
+        options     optLen bytes, utf-8, 'name ::: value' lines of key options (see
+                    CA.getKeyOptions)
+        rules       ruleLen bytes, the chain-rule table CA.g packed 8 rules per byte
+
+    Records written before the chain-rule table was used have the magic b"CAk1" and hold the
+    full rule array of CA.getRuleArr instead, these are still read.
+
+    All integers are little endian. Each line of the index file is the offset of a record
+    and its key ID separated by a tab.
+    """
+
+    magic  = b"CAring01"
+    record = struct.Struct("<4sHBIffHI")
+    recMagic = b"CAk2"
+    recMagicFull = b"CAk1"
+
+    def __init__(self,filename):
+
+        self.filename = filename
+        self.idxName  = filename+".idx"
+
+        # Create an empty ring if it does not yet exist
+        if not os.path.exists(filename):
+            with open(filename,"wb") as f:
+                f.write(self.magic)
+            with open(self.idxName,"w") as f:
+                pass
+
+        with open(filename,"rb") as f:
+            if f.read(len(self.magic)) != self.magic:
+                EXIT("'"+filename+"' is not a keyring file")
+
+        # The index of key IDs to the offset of their record
+        self.index = {}
+        self.indexEnd = len(self.magic)
+        self.map = None
+        self.mapSize = 0
+        self.readIndex()
+
+
+    def readIndex(self):
+        """
+        Read the index file, rebuilding any entries missing from the end of the index.
+        """
+
+        lastOffset = None
+        if os.path.exists(self.idxName):
+            with open(self.idxName,"r",encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    offset, keyId = line[:-1].split("\t",1)
+                    self.index[keyId] = int(offset)
+                    lastOffset = int(offset)
+
+        self.indexEnd = len(self.magic)
+        if lastOffset is not None:
+            self.indexEnd = lastOffset + self.recordSize(lastOffset)
+
+        # Scan any records not in the index
+        size = os.path.getsize(self.filename)
+        if self.indexEnd < size:
+            with open(self.idxName,"a",encoding="utf-8") as f:
+                while self.indexEnd < size:
+                    keyId = self.recordId(self.indexEnd)
+                    self.index[keyId] = self.indexEnd
+                    f.write(str(self.indexEnd)+"\t"+keyId+"\n")
+                    self.indexEnd += self.recordSize(self.indexEnd)
+
+
+    def getMap(self):
+        """
+        Return a read only memory map of the ring, remapping if keys have since been added.
+        """
+
+        size = os.path.getsize(self.filename)
+        if self.map is None or self.mapSize != size:
+            if self.map is not None:
+                self.map.close()
+            with open(self.filename,"rb") as f:
+                self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            self.mapSize = size
+        return self.map
+
+
+    def readRecord(self,offset):
+        """
+        Return the header fields of the record at offset, checking it is a valid record.
+        """
+
+        M = self.getMap()
+        if offset+self.record.size > len(M):
+            EXIT("Keyring '"+self.filename+"' is truncated")
+        fields = self.record.unpack_from(M,offset)
+        if fields[0] not in (self.recMagic,self.recMagicFull):
+            EXIT("Keyring '"+self.filename+"' is corrupt at byte "+str(offset))
+        return fields
+
+
+    def recordSize(self,offset):
+        magic, idLen, k, T, Zl, Zr, optLen, ruleLen = self.readRecord(offset)
+        return self.record.size+idLen+optLen+ruleLen
+
+
+    def recordId(self,offset):
+        magic, idLen, k, T, Zl, Zr, optLen, ruleLen = self.readRecord(offset)
+        s = offset+self.record.size
+        return bytes(self.getMap()[s:s+idLen]).decode("utf-8")
+
+
+    def __contains__(self,keyId):
+        return keyId in self.index
+
+
+    def ids(self):
+        """
+        Return a list of the key IDs in the ring, in the order they were added.
+        """
+        return list(self.index)
+
+
+    def add(self,keyId,C):
+        """
+        Append the key (k, number of steps and ruleset) of the CA C to the ring under keyId.
+        """
+
+        if not isinstance(keyId,str) or len(keyId) == 0 or "\t" in keyId or "\n" in keyId:
+            EXIT("Key ID must be a non-empty string without tabs or newlines")
+        if keyId in self.index:
+            EXIT("Key ID '"+keyId+"' is already in keyring '"+self.filename+"'")
+        if C.g is None or C.k is None or C.numSteps is None:
+            EXIT("Key must have k, T and rules set to be added to a keyring")
+
+        idBytes  = keyId.encode("utf-8")
+        optBytes = "".join([name+" ::: "+str(val)+"\n" for name, val in C.getKeyOptions().items()])
+        optBytes = optBytes.encode("utf-8")
+        rules    = np.packbits(C.g).tobytes()
+        head = self.record.pack(self.recMagic,len(idBytes),C.k,C.numSteps,C.Zleft,C.Zright,\
+                                len(optBytes),len(rules))
+
+        # Append the record in one write, then add it to the index
+        with open(self.filename,"ab") as f:
+            offset = f.tell()
+            f.write(head+idBytes+optBytes+rules)
+        with open(self.idxName,"a",encoding="utf-8") as f:
+            f.write(str(offset)+"\t"+keyId+"\n")
+        self.index[keyId] = offset
+        self.indexEnd = offset+len(head)+len(idBytes)+len(optBytes)+len(rules)
+
+
+    def get(self,keyId,C=None):
+        """
+        Read the key stored under keyId, setting it in the CA C (a new CA if C is None) which
+        is returned.
+        """
+
+        if keyId not in self.index:
+            # The key may have been appended by another process since the index was read
+            self.readIndex()
+            if keyId not in self.index:
+                EXIT("Key ID '"+keyId+"' not in keyring '"+self.filename+"'")
+
+        offset = self.index[keyId]
+        magic, idLen, k, T, Zl, Zr, optLen, ruleLen = self.readRecord(offset)
+        s = offset+self.record.size+idLen
+        opts = {}
+        for line in bytes(self.getMap()[s:s+optLen]).decode("utf-8").splitlines():
+            name, val = line.split(":::",1)
+            opts[name.strip()] = val.strip()
+        packed = np.frombuffer(self.getMap(),dtype=np.uint8,count=ruleLen,offset=s+optLen)
+        ruleArr = np.unpackbits(packed,count=2**k if magic == self.recMagicFull else 2**(k-1))
+        del packed
+
+        if C is None:
+            C = CA()
+        C.setRuleArr(k,T,ruleArr)
+        C.setKeyOptions(opts)
+        return C
+
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+
+from CAencrypt.util import *
+
+
+def currentRSS():
+    """
+    Return the resident set size of this process in bytes, read from /proc/self/statm, or None
+    where that is not available.
+    """
+
+    try:
+        with open("/proc/self/statm","r") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError,ValueError,IndexError):
+        return None
+
+
+def peakRSS():
+    """
+    Return the peak resident set size of this process over its whole run in bytes, or None
+    where that is not available.
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+class memoryProfiler:
+    """
+    Record the peak memory and the top allocation sites of each phase of a run (e.g. reading
+    the input, the noise, each step and writing the output), to be reported as JSON.
+
+    Allocations are traced with tracemalloc, which also traces the data of numpy arrays. For
+    each phase the high-water mark of the traced memory is recorded (tracemalloc.reset_peak
+    is called as each phase begins), along with the resident set size at the start and end of
+    the phase and its peak as sampled by a background thread.
+
+    The sampling thread also takes a tracemalloc snapshot whenever the traced memory of the
+    phase reaches a new high by more than 1/16 (and at least 64 kB), so the allocation sites
+    reported for the phase are those of the memory allocated since it began that was still
+    held at (close to) its peak, including temporary copies freed before the phase ends.
+
+    Tracing slows down the run, and only this process is traced (not pool workers). When
+    enabled is False every method does nothing, so the profiler can be used unconditionally.
+
+    USAGE
+    =====
+
+        prof = memoryProfiler()
+        with prof.phase("decode"):
+            I, d = readBWImage2BinArr("img.png")
+        prof.begin("step 1")
+        C.encSteps(callback=prof.stepCallback(C.numSteps))
+        prof.end()
+        prof.save("memory.json")
+    """
+
+    def __init__(self,enabled=True,topSites=10,interval=0.005):
+
+        self.enabled  = enabled
+        self.topSites = topSites
+        self.interval = interval
+        self.phases   = []
+        self.current  = None
+        if not enabled:
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample,daemon=True)
+        self.sampler.start()
+
+
+    def begin(self,name):
+        """
+        Begin the phase name, ending the current phase if there is one.
+        """
+
+        if not self.enabled:
+            return
+        self.end()
+
+        base = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        traced = tracemalloc.get_traced_memory()[0]
+        rss = currentRSS()
+        with self.lock:
+            self.current = {"name":name, "start":time.time(), "base":base, "peakSnapshot":None,\
+                            "snapshotTraced":traced, "tracedStart":traced, "rssStart":rss,\
+                            "rssPeak":rss}
+
+
+    def end(self):
+        """
+        End the current phase, if there is one, recording its report.
+        """
+
+        if not self.enabled or self.current is None:
+            return
+
+        traced, tracedPeak = tracemalloc.get_traced_memory()
+        rss = currentRSS()
+        with self.lock:
+            P = self.current
+            self.current = None
+        snap = P["peakSnapshot"]
+        if snap is None or traced >= P["snapshotTraced"]:
+            snap = tracemalloc.take_snapshot()
+
+        # Leave out the memory of tracing itself and of this profiler
+        ignore = [tracemalloc.Filter(False,tracemalloc.__file__),tracemalloc.Filter(False,__file__)]
+        snap = snap.filter_traces(ignore)
+        sites = []
+        for S in snap.compare_to(P["base"].filter_traces(ignore),"lineno")[:self.topSites]:
+            if S.size_diff <= 0:
+                break
+            frame = S.traceback[0]
+            sites.append({"site":frame.filename+":"+str(frame.lineno),"bytes":S.size_diff,\
+                          "blocks":S.count_diff})
+
+        rssPeak = P["rssPeak"]
+        if rss is not None and (rssPeak is None or rss>rssPeak):
+            rssPeak = rss
+        self.phases.append({"phase":P["name"], "seconds":time.time()-P["start"],\
+                            "tracedStart":P["tracedStart"], "tracedPeak":tracedPeak,\
+                            "tracedEnd":traced, "rssStart":P["rssStart"], "rssPeak":rssPeak,\
+                            "rssEnd":rss, "topSites":sites})
+
+
+    def phase(self,name):
+        """
+        Return a context manager running its body as the phase name.
+        """
+
+        prof = self
+
+        class _phase:
+            def __enter__(self):
+                prof.begin(name)
+            def __exit__(self,*exc):
+                prof.end()
+                return False
+
+        return _phase()
+
+
+    def stepCallback(self,numSteps,callback=None):
+        """
+        Return a callback for CAsteps and CAstepsReverse (e.g. through encSteps) ending the
+        phase of each step and beginning that of the next, named "step i". callback, if given,
+        is called between the steps as before. The first step phase must be begun before the
+        steps are taken.
+        """
+
+        def stepDone(i,A):
+            self.end()
+            if callback is not None:
+                callback(i,A)
+            if i<numSteps:
+                self.begin("step "+str(i+1))
+
+        if not self.enabled:
+            return callback
+        return stepDone
+
+
+    def report(self):
+        """
+        Return the report of the phases recorded so far as a dictionary, with the peak traced
+        memory and resident set size over the whole run.
+        """
+
+        if not self.enabled:
+            return {}
+        self.end()
+        return {"phases":self.phases,\
+                "tracedPeak":max([P["tracedPeak"] for P in self.phases],default=0),\
+                "rssPeak":peakRSS()}
+
+
+    def save(self,filename):
+        """
+        Write the report to filename as JSON, stopping the profiler.
+        """
+
+        if not self.enabled:
+            return
+        R = self.report()
+        self.stop()
+        with open(filename,"w") as f:
+            json.dump(R,f,indent=2)
+
+
+    def stop(self):
+        """
+        Stop the sampling thread and tracing.
+        """
+
+        if not self.enabled:
+            return
+        self.stopped.set()
+        self.sampler.join()
+        tracemalloc.stop()
+        self.enabled = False
+
+
+    def _sample(self):
+        """
+        The sampling thread, recording the peak resident set size of the current phase and a
+        snapshot of the allocations whenever its traced memory reaches a new high.
+        """
+
+        while not self.stopped.wait(self.interval):
+            rss = currentRSS()
+            traced = tracemalloc.get_traced_memory()[0]
+            with self.lock:
+                P = self.current
+                if P is None:
+                    continue
+                if rss is not None and (P["rssPeak"] is None or rss>P["rssPeak"]):
+                    P["rssPeak"] = rss
+                grow = traced-P["snapshotTraced"]
+                if grow <= max(65536,(P["snapshotTraced"]-P["tracedStart"])//16):
+                    continue
+                P["snapshotTraced"] = traced
+            snap = tracemalloc.take_snapshot()
+            with self.lock:
+                if self.current is P:
+                    P["peakSnapshot"] = snap
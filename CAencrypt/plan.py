@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import platform
+import random as r
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+
+
+# The candidate chunk sizes for the forwards steps and the noise
+stepChunks  = [4096,16384,65536,262144,1048576]
+noiseChunks = [65536,262144,1048576]
+
+# The default file the calibration is cached in
+defaultCache = os.path.join(os.path.expanduser("~"),".cache","CAencrypt","calibration.json")
+
+# The version of the calibration, increased whenever the benchmarks change
+calibrationVersion = 2
+
+
+def machineId():
+    """
+    Return a string identifying the machine and software a calibration was measured on.
+    """
+    return platform.machine()+" "+platform.processor()+" python "+platform.python_version()+\
+        " numpy "+np.__version__+" cpus "+str(os.cpu_count())
+
+
+def workerLevels():
+    """
+    Return the numbers of worker threads considered by the planner, the powers of 2 up to the
+    number of cpus.
+    """
+    levels = [1]
+    while levels[-1]*2 <= (os.cpu_count() or 1):
+        levels.append(levels[-1]*2)
+    return levels
+
+
+def bestTime(f,repeats):
+    """
+    Return the shortest time taken by repeats calls of f.
+    """
+    best = None
+    for i in range(repeats):
+        t = time.perf_counter()
+        f()
+        t = time.perf_counter()-t
+        if best is None or t<best:
+            best = t
+    return best
+
+
+def benchmarkCA(k,N,seed=1):
+    """
+    Return a CA with a random reversible ruleset for k, set to a random state of N cells.
+    """
+    state = r.getstate()
+    r.seed(seed)
+    C = CA(k=k,numSteps=1)
+    C.genRulesLeftReversible()
+    r.setstate(state)
+    C.setBinStartVec(np.random.default_rng(seed).integers(0,2,N,dtype=np.uint8),copy=False)
+    return C
+
+
+def calibrate(N=262144,revN=20000,repeats=3):
+    """
+    Run the micro-benchmarks of the cost model used by planSteps.
+
+    INPUTS
+    ======
+    N
+        The number of cells used to time the forwards steps and noise.
+    revN
+        The number of cells used to time the backwards steps.
+    repeats
+        The number of times each benchmark is run, the fastest time is used.
+
+    RETURNS
+    =======
+    calibration
+        A dictionary of the measured costs in seconds:
+
+            stepCell        stepCell[chunk][workers] the time per cell of a forwards step
+                            with k=7, the time for other k is scaled by (k+1)/8
+            stepFixed       the fixed time of a forwards step (from a step of k cells)
+            revCell         the time per cell of one pass of a backwards step
+            guessCell       the time per cell of findReverseGuess is guessCell[0] plus
+                            guessCell[1] per guess
+            noiseBit        noiseBit[gen][chunk][workers] the time per bit of XORnoise
+    """
+
+    cal = {"version":calibrationVersion, "machine":machineId()}
+
+    # Forwards steps, for each chunk size and number of workers
+    C = benchmarkCA(7,N)
+    cal["stepCell"] = {}
+    for chunk in stepChunks:
+        cal["stepCell"][str(chunk)] = {}
+        for w in workerLevels():
+            t = bestTime(lambda: C.singleCAstep(chunk=chunk,workers=w),repeats)
+            cal["stepCell"][str(chunk)][str(w)] = t/N
+    S = benchmarkCA(7,7)
+    cal["stepFixed"] = bestTime(lambda: S.singleCAstep(),repeats*10)
+
+    # A single pass of a backwards step, using the known guess of the step from the state
+    C = benchmarkCA(7,revN)
+    h = C.stepHint()
+    C.singleCAstep()
+    def revPass():
+        C.singleCAstepReverseL(guess=h)
+        C.swapWorkArr()
+    cal["revCell"] = bestTime(revPass,repeats)/revN
+
+    # The guess engine, fitting a linear cost in the number of guesses from two values of k
+    t = []
+    for k in (5,11):
+        C = benchmarkCA(k,revN//4)
+        t.append(bestTime(C.findReverseGuess,repeats)/(revN//4))
+    b = max((t[1]-t[0])/(2**10-2**4),0.0)
+    cal["guessCell"] = [max(t[0]-b*2**4,0.0),b]
+
+    # The noise, for each generator, chunk size and number of workers
+    cal["noiseBit"] = {}
+    C = CA()
+    C.setNoiseSeed(12345)
+    bits = np.zeros(N,dtype=np.uint8)
+    for gen in noiseGens:
+        C.setNoiseGen(gen)
+        cal["noiseBit"][gen] = {}
+        for chunk in noiseChunks:
+            cal["noiseBit"][gen][str(chunk)] = {}
+            for w in workerLevels():
+                C.setPlan({"noiseChunk":chunk,"noiseWorkers":w})
+                cal["noiseBit"][gen][str(chunk)][str(w)] = bestTime(lambda: C.XORnoise(bits),repeats)/N
+
+    return cal
+
+
+def loadCalibration(filename=defaultCache,recalibrate=False,verbose=False):
+    """
+    Return the calibration cached in filename, first running calibrate and caching the result
+    if there is no cached calibration for this machine (or recalibrate is True).
+    """
+
+    if not recalibrate and exists(filename):
+        try:
+            with open(filename,"r") as f:
+                cal = json.load(f)
+            if cal.get("version") == calibrationVersion and cal.get("machine") == machineId():
+                return cal
+        except ValueError:
+            pass
+
+    if verbose:
+        print("Calibrating the execution planner, cached in '"+filename+"'")
+    cal = calibrate()
+
+    # Write to a temporary file then replace, so a partly written cache is never read
+    d = os.path.dirname(filename)
+    if d != "":
+        os.makedirs(d,exist_ok=True)
+    with open(filename+".tmp","w") as f:
+        json.dump(cal,f,indent=1)
+    os.replace(filename+".tmp",filename)
+    return cal
+
+
+def estimatePlan(C,N,mode,cal,plan):
+    """
+    Estimate the time and peak memory of encrypting (mode 'enc') or decrypting (mode 'dec')
+    N cells with the key set in the CA C, using the execution plan plan (see CA.setPlan).
+
+    RETURNS
+    =======
+    estimate
+        A dictionary with the estimated time in seconds of the steps ("steps") and noise
+        ("noise") along with the total "time", and the estimated peak memory in bytes
+        ("memory") of the CA state, rule tables and the work arrays of the plan.
+    """
+
+    k = C.k
+    T = C.numSteps
+    G = 2**(k-1)
+
+    # Encryption takes backwards steps unless the key encrypts with forwards steps
+    reverse = (mode == "enc") == (C.encDir == "reverse")
+    if reverse:
+        if C.encDir == "forward" or C.boundary == "fixed":
+            # Decrypting with the step hints, or with a fixed boundary, a single pass per step
+            tStep = N*cal["revCell"]
+        elif plan["revEngine"] == "guess":
+            tStep = N*(cal["guessCell"][0]+cal["guessCell"][1]*G+cal["revCell"])
+        else:
+            # On average about half the guesses are tried before the valid one
+            tStep = N*cal["revCell"]*(G+1)/2
+        stepMem = 2*8*G if plan["revEngine"] == "guess" and C.boundary == "periodic" else 0
+    else:
+        chunk = min(plan["stepChunk"],N)
+        c = cal["stepCell"][str(plan["stepChunk"])][str(plan["stepWorkers"])]
+        tStep = cal["stepFixed"]+N*c*(k+1)/8
+        # The neighbourhood values and the wrapped cells of each chunk being worked on
+        stepMem = plan["stepWorkers"]*chunk*9
+    tSteps = T*tStep
+
+    chunk = min(plan["noiseChunk"],N)
+    tNoise = N*cal["noiseBit"][C.noiseGen][str(plan["noiseChunk"])][str(plan["noiseWorkers"])]
+    if C.noiseGen == "EQaDG":
+        noiseMem = chunk*9
+    else:
+        noiseMem = plan["noiseWorkers"]*chunk*2
+
+    # The two CA buffers and the message, and the lut, revG and revNext tables
+    baseMem = 3*N+(1+4+8)*2**k
+
+    return {"steps":tSteps, "noise":tNoise, "time":tSteps+tNoise,\
+            "memory":baseMem+max(stepMem,noiseMem)}
+
+
+def planSteps(C,N,mode,cal,budget=None):
+    """
+    Choose the fastest execution plan for encrypting (mode 'enc') or decrypting (mode 'dec')
+    N cells with the key set in the CA C, whose estimated memory is within budget bytes.
+
+    Every combination of the forwards step chunk size and workers, the backwards step engine
+    and the noise chunk size and workers is estimated with estimatePlan. Only the numbers of
+    noise workers that can be used by the noise generator of the key are considered, and
+    chunk sizes larger than N are treated as N (so only the smallest is considered).
+
+    RETURNS
+    =======
+    plan
+        The chosen plan, see CA.setPlan.
+    estimate
+        The estimates of the chosen plan, see estimatePlan.
+    """
+
+    if mode not in ("enc","dec"):
+        EXIT("Plan mode must be 'enc' or 'dec'")
+
+    def sizes(chunks):
+        return [c for c in chunks if c<N]+[c for c in chunks if c>=N][:1]
+
+    noiseWorkers = workerLevels()
+    if not hasattr(noiseGens[C.noiseGen],"bitsAt"):
+        noiseWorkers = [1]
+
+    best = None
+    for stepChunk in sizes(stepChunks):
+        for stepWorkers in workerLevels():
+            for revEngine in ("scan","guess"):
+                for noiseChunk in sizes(noiseChunks):
+                    for w in noiseWorkers:
+                        plan = {"stepChunk":stepChunk, "stepWorkers":stepWorkers,\
+                                "revEngine":revEngine, "noiseChunk":noiseChunk, "noiseWorkers":w}
+                        est = estimatePlan(C,N,mode,cal,plan)
+                        if budget is not None and est["memory"]>budget:
+                            continue
+                        if best is None or est["time"]<best[1]["time"]:
+                            best = (plan,est)
+
+    if best is None:
+        EXIT("No execution plan fits within the memory budget of "+str(budget)+" bytes")
+    return best
+
+
+def autoPlan(C,N,mode,budget=None,cacheFile=defaultCache,verbose=False):
+    """
+    Choose the execution plan for encrypting or decrypting N cells with planSteps (with the
+    cached calibration) and set it in the CA C.
+    """
+
+    plan, est = planSteps(C,N,mode,loadCalibration(cacheFile,verbose=verbose),budget)
+    C.setPlan(plan)
+    if verbose:
+        printPlan(plan,est,mode,N)
+    return plan, est
+
+
+def printPlan(plan,est,mode,N):
+    """
+    Print an execution plan and its estimates.
+    """
+
+    print(("Encryption" if mode == "enc" else "Decryption")+" plan for "+str(N)+" cells")
+    for name in ("stepChunk","stepWorkers","revEngine","noiseChunk","noiseWorkers"):
+        print("    "+name.ljust(14)+" : "+str(plan[name]))
+    print("    estimated steps time   : "+str('%.3f'%est["steps"])+" seconds")
+    print("    estimated noise time   : "+str('%.3f'%est["noise"])+" seconds")
+    print("    estimated total time   : "+str('%.3f'%est["time"])+" seconds")
+    print("    estimated peak memory  : "+str('%.1f'%(est["memory"]/2**20))+" MB")
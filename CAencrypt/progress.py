@@ -0,0 +1,191 @@
+import sys
+import time
+import threading
+
+
+class CAcancelled(Exception):
+    """
+    Raised by a progressMonitor when its cancelToken is cancelled. step is the number of steps
+    completed before the run was cancelled, and the CA state (CA.CAts) is the state after that
+    many steps, as the steps write to a separate buffer which is only swapped in once complete.
+    """
+
+    def __init__(self,step):
+        Exception.__init__(self,"Cancelled after "+str(step)+" completed steps")
+        self.step = step
+
+
+class cancelToken:
+    """
+    A flag to cooperatively cancel a run. cancel may be called from any thread (or a signal
+    handler), and the run stops at the next chunk of cells with a CAcancelled exception.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def cancelled(self):
+        return self.event.is_set()
+
+
+class progressMonitor:
+    """
+    Track the progress of the CA steps of a run, reporting it at a set interval and stopping
+    the run if a cancelToken is cancelled.
+
+    A progressMonitor is passed as the progress argument of CAsteps, CAstepsReverse (and the
+    functions calling them). The step kernels call tick between chunks of cells, so reports
+    and cancellation are handled part way through a step, not just between steps.
+
+    Each report is a dictionary passed to callback, with
+
+        label       the name of the steps, e.g. "encryption"
+        step        the step being taken (from 1)
+        numSteps    the total number of steps
+        cells       the number of cells processed so far in the run, counting each pass over
+                    the cells of a backwards step
+        guesses     the number of guesses of the first k-1 bits tried so far in the run
+        elapsed     the time since the start of the run in seconds
+        eta         the estimated time remaining in seconds, None until it can be estimated
+
+    The time remaining is estimated from the fraction of the run done, taking each step as
+    passes passes over the cells, where passes is 1 for forwards steps and backwards steps
+    with a known guess, 2 for the "guess" engine, and on average (2^(k-1)+1)/2 when scanning
+    over the guesses.
+
+    INPUTS
+    ======
+    callback
+        Called with each report, by default printProgress.
+    interval
+        The minimum time in seconds between reports.
+    token
+        An optional cancelToken checked on every tick.
+    """
+
+    def __init__(self,callback=None,interval=1.0,token=None):
+
+        if callback is None:
+            callback = printProgress
+        self.callback = callback
+        self.interval = interval
+        self.token    = token
+
+        # The run, and the progress through it
+        self.label     = ""
+        self.numSteps  = 0
+        self.firstStep = 0
+        self.N         = 0
+        self.passes    = 1
+        self.step      = 0
+        self.done      = 0
+        self.cells     = 0
+        self.guesses   = 0
+        self.stepCells = 0
+
+        # The start time of the run and the time of the last report
+        self.tStart  = time.time()
+        self.tReport = self.tStart
+
+        # Ticks may come from several threads stepping chunks of the same step
+        self.lock = threading.Lock()
+
+
+    def begin(self,label,firstStep,numSteps,N,passes):
+        """
+        Start a run of numSteps steps (of which firstStep are already complete) over N cells.
+        """
+
+        self.label     = label
+        self.numSteps  = numSteps
+        self.firstStep = firstStep
+        self.N         = N
+        self.passes    = passes
+        self.step      = firstStep
+        self.done      = firstStep
+        self.tStart    = time.time()
+        self.tReport   = self.tStart
+
+
+    def beginStep(self,step):
+        """
+        Start step (from 1), checking for cancellation before the step is taken.
+        """
+
+        self.step = step
+        self.stepCells = 0
+        self.check()
+
+
+    def endStep(self):
+        self.done = self.step
+        self.stepCells = 0
+
+
+    def end(self):
+        """
+        End the run, giving a final report.
+        """
+
+        self.callback(self.report())
+
+
+    def check(self):
+        """
+        Raise CAcancelled if the token has been cancelled.
+        """
+
+        if self.token is not None and self.token.cancelled():
+            raise CAcancelled(self.done)
+
+
+    def tick(self,cells,guesses=0):
+        """
+        Record that cells more cells have been processed and guesses more guesses tried,
+        reporting the progress if interval seconds have passed since the last report.
+        """
+
+        with self.lock:
+            self.cells += cells
+            self.stepCells += cells
+            self.guesses += guesses
+            t = time.time()
+            report = t-self.tReport >= self.interval
+            if report:
+                self.tReport = t
+        self.check()
+        if report:
+            self.callback(self.report())
+
+
+    def report(self):
+        """
+        Return the current progress report.
+        """
+
+        elapsed = time.time()-self.tStart
+        total = self.numSteps-self.firstStep
+        frac = 0.0
+        if total>0 and self.N>0:
+            # Never take a step to be complete until it is, as a scan may take more passes
+            inStep = min(self.stepCells/(self.N*self.passes),0.99)
+            frac = (self.done-self.firstStep+inStep)/total
+        eta = None
+        if frac>0:
+            eta = elapsed*(1-frac)/frac
+        return {"label":self.label, "step":self.step, "numSteps":self.numSteps,\
+                "cells":self.cells, "guesses":self.guesses, "elapsed":elapsed, "eta":eta}
+
+
+def printProgress(report):
+    """
+    Print a progress report (see progressMonitor) to stderr.
+    """
+
+    eta = "unknown" if report["eta"] is None else str('%.1f'%report["eta"])+" s"
+    print("    - "+report["label"]+" step "+str(report["step"])+"/"+str(report["numSteps"])+\
+          " : "+str(report["cells"])+" cells, "+str(report["guesses"])+" guesses, "+\
+          str('%.1f'%report["elapsed"])+" s elapsed, eta "+eta,file=sys.stderr)
@@ -1,3 +1,8 @@
+import numpy as np
+
+from CAencrypt.util import *
+
+
 class randEQaDG:
     """
     Stands for 'rand Even Quicker and Dirtier Generator'
@@ -56,13 +61,137 @@ class randEQaDG:
         else:
             self.randBit = 0
 
-    def EQaDGbA(self,length):
+    def EQaDGbA(self,length,chunk=65536):
         """
         Generate an array of pseudo random bits in {0,1} using `Even Quicker and Dirtier Generator' 
         random number generation from [1, p275-276].
+
+        This gives the same bits as calling EQaDGb length times, and leaves the generator in the
+        same state, but generates the bits with vectorised numpy operations as follows.
+
+        Let v_n be the value of self.rand after the EQaDG call of the nth bit, i.e. before the
+        shift by 2^31 in EQaDGmp, such that bit n is 1 if v_n < 2^31. As 1664525 is odd
+
+            v_{n+1} = v_n * 1664525 + 1013904223 + 2^31 (mod 2^32)
+
+        which is itself a linear congruential generator, and so can be jumped ahead L values
+        with v_{n+L} = A_L v_n + C_L (mod 2^32). Each chunk of values is then built by doubling,
+        filling values [L,2L) from values [0,L) in a single vector operation. The values are
+        held as uint64, where the product of two 32 bit values cannot overflow.
+
+        The bits are stored in self.randBitArr as a uint8 array.
+        """
+        a = 1664525
+        c = (1013904223 + 0b10000000000000000000000000000000) % 0b100000000000000000000000000000000
+        mask = np.uint64(0b11111111111111111111111111111111)
+
+        self.randBitArr = np.empty(length,dtype=np.uint8)
+        if length == 0:
+            return
+
+        # The first value, from the current state of the generator
+        v = (self.rand*a+1013904223) % 0b100000000000000000000000000000000
+        vals = np.empty(min(chunk,length),dtype=np.uint64)
+        for s in range(0,length,chunk):
+            m = min(chunk,length-s)
+            vals[0] = v
+            L, A, C = 1, a, c
+            while L<m:
+                n = min(L,m-L)
+                vals[L:L+n] = (vals[:n]*np.uint64(A)+np.uint64(C)) & mask
+                L += n
+                A, C = (A*A) % 0b100000000000000000000000000000000, (A*C+C) % 0b100000000000000000000000000000000
+            np.less(vals[:m],0b10000000000000000000000000000000,out=self.randBitArr[s:s+m])
+            v = (int(vals[m-1])*a+c) % 0b100000000000000000000000000000000
+
+        # Leave the generator in the same state as after length calls of EQaDGb
+        self.rand    = int(vals[m-1]) - 0b10000000000000000000000000000000
+        self.randBit = int(self.randBitArr[-1])
+
+    def skip(self,length):
         """
-        self.randBitArr = []
-        for i in range(length):
-            self.EQaDGb()
-            self.randBitArr.append(self.randBit)
+        Skip the next length bits of the sequence, leaving the generator in the same state as
+        after length calls of EQaDGb, with the jump ahead v_{n+L} = A_L v_n + C_L (mod 2^32) of
+        EQaDGbA built by repeated squaring, so in O(log(length)) operations.
+        """
+        if length<=0:
+            return
+        a = 1664525
+        c = (1013904223 + 0b10000000000000000000000000000000) % 0b100000000000000000000000000000000
+
+        # The value after the first skipped bit, then jump the remaining length-1 values
+        v = (self.rand*a+1013904223) % 0b100000000000000000000000000000000
+        n, A, C = length-1, a, c
+        while n>0:
+            if n & 1:
+                v = (A*v+C) % 0b100000000000000000000000000000000
+            A, C = (A*A) % 0b100000000000000000000000000000000, (A*C+C) % 0b100000000000000000000000000000000
+            n >>= 1
+        self.rand    = v - 0b10000000000000000000000000000000
+        self.randBit = 1 if v < 0b10000000000000000000000000000000 else 0
         
+
+
+class randPhilox:
+    """
+    Generate pseudo random bits with the counter based Philox4x64 generator [1], through the
+    numpy Philox bit generator keyed with the seed.
+
+    Unlike randEQaDG the random bits are not a chain of states, the block of four 64 bit
+    words for counter value c is a function of only the key and c. Any bits of the sequence
+    can therefore be generated directly from (seed, offset), see bitsAt, so separate chunks
+    of the sequence can be generated independently and in any order (or in parallel).
+
+    The sequence of bits is the sequence of 64 bit words from numpy.random.Philox(key=seed)
+    with each word taken most significant bit first.
+
+    IMPORTANT NOTE:
+    ==============
+    While Philox is a far better generator than the `Even Quicker and Dirtier Generator' it is
+    still not a cryptographically secure RNG, and the seed is only 32 bits.
+
+    REFERENCES:
+    ==========
+    [1] Salmon J.K., Moraes M.A., Dror R.O. and Shaw D.E. Parallel random numbers: as easy
+        as 1, 2, 3. In: Proceedings of the International Conference for High Performance
+        Computing, Networking, Storage and Analysis (SC11). ACM; 2011.
+    """
+
+    def __init__(self,seed=3574541233091423):
+        self.seed       = seed
+        self.offset     = 0
+        self.randBitArr = None
+
+    def bitsAt(self,offset,length):
+        """
+        Return a uint8 array of the length random bits starting at bit offset of the sequence.
+
+        The Philox counter is advanced directly to the block of words holding bit offset, so
+        the cost does not depend on offset.
+        """
+        if offset<0 or length<0:
+            EXIT("Philox bit offset and length must not be negative")
+
+        # The first and one past the last word holding the bits
+        w0 = offset//64
+        w1 = (offset+length+63)//64
+
+        # Each counter value gives 4 words, so advance to the block holding word w0
+        bg = np.random.Philox(key=self.seed)
+        bg.advance(w0//4)
+        words = bg.random_raw(w1-w0+w0%4)[w0%4:]
+
+        s = offset-64*w0
+        return np.unpackbits(words.astype(">u8").view(np.uint8))[s:s+length]
+
+    def EQaDGbA(self,length):
+        """
+        Generate the next length bits of the sequence into self.randBitArr, so this generator
+        can be used in place of randEQaDG.
+        """
+        self.randBitArr = self.bitsAt(self.offset,length)
+        self.offset    += length
+
+
+# The noise generators that can be selected in a key, see CA.setNoiseGen
+noiseGens = {"EQaDG":randEQaDG, "philox":randPhilox}
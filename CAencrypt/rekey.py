@@ -0,0 +1,119 @@
+import os
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.enc import *
+from CAencrypt.container import *
+from CAencrypt.progress import *
+from CAencrypt.channels import *
+
+
+def rekeyArr(old,new,binArr,hints=None,dims=None):
+    """
+    Re-encrypt a binary array encrypted with the key and noise seed of the CA old with the key
+    and noise seed of the CA new, decrypting it in memory and encrypting the result, so the
+    plaintext is never written out.
+
+    INPUTS
+    ======
+    old, new
+        The CAs holding the old and new keys and noise seeds.
+    binArr
+        The 1D binary array encrypted with the old key. It may be overwritten.
+    hints
+        The masked step hints stored with binArr, needed if old has encDir "forward".
+    dims
+        The dimensions of the image binArr corresponds to, so the channels are taken as set by
+        the channelLayout of each key, see cryptImage. binArr is a single ring if None.
+
+    RETURNS
+    =======
+    array
+        The array encrypted with the new key.
+    hints
+        The masked step hints of the new encryption if new has encDir "forward", else None.
+    """
+
+    if dims is None:
+        dims = (len(binArr),)
+    if old.encDir == "forward" and hints is None:
+        EXIT("Input does not contain the step hints needed by the old forward encryption key")
+    plain, _ = cryptImage(old,"dec",binArr,dims,hints=hints)
+    return cryptImage(new,"enc",plain,dims)
+
+
+def rekeyName(filename,outDir,fmt):
+    """
+    Return the name of the re-encrypted file of filename, in the directory outDir with the
+    extension of the output format fmt.
+    """
+
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(outDir,base+outputFormats[fmt])
+
+
+def _rekeyJob(filename,outfile,fmt):
+    """
+    Re-encrypt a single file with the old and new key CAs of the worker (see initWorker),
+    saving it to outfile in the output format fmt. The file is read and the result written by
+    the worker, so only the filenames are sent between processes. Run with runJob.
+    """
+
+    old, new = workerState()
+    binArr, dims, hints, inFormat, codec = readCipherInput(filename,old.k,old.numSteps)
+    # A compressed message is a single ring, whatever the channels of its image
+    out, hints = rekeyArr(old,new,binArr,hints,dims if codec is None else None)
+    saveCipherOutput(outfile,out,dims,fmt,new.k,new.numSteps,hints,codec)
+    return outfile
+
+
+def rekeyFiles(old,new,filenames,outDir="rekeyed",outFormat="auto",workers=1):
+    """
+    Re-encrypt a list of files (images or packed containers) from the key and noise seed of the
+    CA old to those of the CA new, see rekeyArr, saving each to outDir under the same name
+    with the extension of its output format (see rekeyName). If two files would be saved
+    under the same name the rekey exits before any file is written.
+
+    Each file is read, decrypted, encrypted and saved by one worker of a pool of workers
+    processes, so with several files in flight the reading, forwards steps, backwards steps and
+    writing of different files overlap. Files are handed out as workers become free.
+
+    YIELDS
+    ======
+    filename
+        The name of each input file, in the order given.
+    outfile
+        The name of its re-encrypted file.
+    """
+
+    # Find the output file of each input before anything is written, as inputs with distinct
+    # names may still give the same output name (e.g. a.png and a.cab saved as packed)
+    jobs = []
+    outfiles = {}
+    for f in filenames:
+        if not os.path.exists(f):
+            EXIT("Input file '"+f+"' does not exist.")
+        fmt = chooseOutputFormat(outFormat,"packed" if isPackedCipher(f) else "png")
+        outfile = rekeyName(f,outDir,fmt)
+        if outfile in outfiles:
+            EXIT("Files to rekey '"+outfiles[outfile]+"' and '"+f+"' would both be saved to '"+\
+                 outfile+"'")
+        outfiles[outfile] = f
+        jobs.append((_rekeyJob,f,outfile,fmt))
+    os.makedirs(outDir,exist_ok=True)
+
+    def result(filename,res):
+        return filename, jobResult(res," (rekeying '"+filename+"')")
+
+    if workers<=1:
+        initWorker((old,new))
+        for job in jobs:
+            yield result(job[1],runJob(*job))
+        return
+
+    from multiprocessing import Pool
+
+    with Pool(workers,initializer=initWorker,initargs=((old,new),True)) as P:
+        pending = [(job[1],P.apply_async(runJob,job)) for job in jobs]
+        for filename, R in pending:
+            yield result(filename,R.get())
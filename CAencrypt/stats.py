@@ -0,0 +1,425 @@
+import math
+import mmap
+import numpy as np
+
+from CAencrypt.util import *
+from CAencrypt.container import *
+
+
+def gammq(a,x):
+    """
+    The regularised upper incomplete gamma function Q(a,x), following [1, p209-213].
+
+    Used to find the p-value of chi squared statistics.
+
+    REFERENCES
+    ==========
+    [1] ``Numerical Recipes in Fortran 77, The Art of Scientific Computing, Vol 1'',
+        Press W.H. and Teukolsky S.A. and Vetterling W.T. and Flannery B.P.,
+        2nd ed, Cambridge University Press.
+    """
+
+    if x<0 or a<=0:
+        EXIT("Invalid arguments to gammq")
+    if x == 0:
+        return 1.0
+    gln = math.lgamma(a)
+
+    if x < a+1:
+        # Series representation of P(a,x), Q = 1-P
+        ap, s = a, 1.0/a
+        d = s
+        for n in range(1000):
+            ap += 1
+            d *= x/ap
+            s += d
+            if abs(d) < abs(s)*3e-16:
+                break
+        return max(0.0,1.0 - s*math.exp(-x+a*math.log(x)-gln))
+
+    # Continued fraction representation of Q(a,x), using Lentz's method
+    tiny = 1e-300
+    b = x+1-a
+    c = 1/tiny
+    d = 1/b
+    h = d
+    for i in range(1,1000):
+        an = -i*(i-a)
+        b += 2
+        d = an*d+b
+        if abs(d)<tiny:
+            d = tiny
+        c = b+an/c
+        if abs(c)<tiny:
+            c = tiny
+        d = 1/d
+        de = d*c
+        h *= de
+        if abs(de-1) < 3e-16:
+            break
+    return math.exp(-x+a*math.log(x)-gln)*h
+
+
+def entropy(counts):
+    """
+    The Shannon entropy (in bits) of the distribution given by an array of counts. Values
+    that never occur contribute nothing to the entropy, i.e. 0 log(0) = 0.
+    """
+
+    counts = np.asarray(counts,dtype=np.float64)
+    tot = counts.sum()
+    if tot == 0:
+        return 0.0
+    p = counts[counts>0]/tot
+    return 0.0 - float(np.sum(p*np.log2(p)))
+
+
+class randStats:
+    """
+    Accumulate statistics for testing the randomness of a stream of bits, such as a ciphertext.
+
+    The stream is passed in one chunk at a time with update (for arrays of bits) or updateBytes
+    (for bytes, 8 bits per byte with the most significant bit first), each chunk is processed
+    with vectorised numpy operations, and only a fixed number of running totals are kept. So
+    the memory used is independent of the length of the stream.
+
+    Accumulators for consecutive pieces of a stream (e.g. computed by parallel workers) can be
+    combined with merge.
+
+    The statistics are
+
+    bit entropy:
+        The Shannon entropy of the bits, 1 for a random stream.
+
+    byte entropy:
+        The Shannon entropy of the bytes, 8 for a random stream.
+
+    monobit:
+        The frequency (monobit) test of [1, 2.1], with p-value.
+
+    runs:
+        The runs test of [1, 2.3], with p-value.
+
+    block frequency:
+        The frequency test within a block of [1, 2.2], for blocks of blockSize bits, with
+        p-value.
+
+    serial correlation:
+        The serial correlation coefficient of consecutive bytes, 0 for a random stream.
+
+    REFERENCES
+    ==========
+    [1] Rukhin A. et al., A Statistical Test Suite for Random and Pseudorandom Number
+        Generators for Cryptographic Applications. NIST Special Publication 800-22 Rev 1a; 2010.
+    """
+
+    def __init__(self,blockSize=128):
+
+        if not isinstance(blockSize, int) or blockSize<1:
+            EXIT("Block size for block frequency test must be a positive integer")
+
+        self.blockSize = blockSize
+
+        # Total bits and number of ones
+        self.n  = 0
+        self.n1 = 0
+
+        # Number of changes between consecutive bits, and the first and last bits
+        self.transitions = 0
+        self.firstBit = None
+        self.lastBit  = None
+
+        # Histogram of the byte values, and the bits not yet making up a whole byte
+        self.byteCounts = np.zeros(256,dtype=np.int64)
+        self.partialByte = np.zeros(0,dtype=np.uint8)
+
+        # Sums for the serial correlation of consecutive bytes
+        self.sumXY    = 0
+        self.firstByte = None
+        self.lastByte  = None
+
+        # Sum of (proportion of ones - 1/2)^2 over the complete blocks, and the number of
+        # complete blocks, along with the ones in the current incomplete block
+        self.blockChi    = 0.0
+        self.numBlocks   = 0
+        self.partialOnes = 0
+        self.partialLen  = 0
+
+
+    def update(self,bits):
+        """
+        Add a chunk of bits (a 1D array of binary values) to the statistics.
+        """
+
+        bits = asBinArr(bits,"Bits for statistics")
+        if len(bits) == 0:
+            return
+
+        # Monobit and bit entropy counts
+        self.n  += len(bits)
+        self.n1 += int(np.count_nonzero(bits))
+
+        # Runs, counting changes across the boundary with the previous chunk
+        self.transitions += int(np.count_nonzero(bits[1:] != bits[:-1]))
+        if self.lastBit is not None and self.lastBit != bits[0]:
+            self.transitions += 1
+        if self.firstBit is None:
+            self.firstBit = int(bits[0])
+        self.lastBit = int(bits[-1])
+
+        # Block frequency, completing the previous partial block first
+        B = self.blockSize
+        s = 0
+        if self.partialLen>0:
+            s = min(B-self.partialLen,len(bits))
+            self.partialOnes += int(np.count_nonzero(bits[:s]))
+            self.partialLen  += s
+            if self.partialLen == B:
+                self.blockChi  += (self.partialOnes/B - 0.5)**2
+                self.numBlocks += 1
+                self.partialOnes, self.partialLen = 0, 0
+        nb = (len(bits)-s)//B
+        if nb>0:
+            ones = bits[s:s+nb*B].reshape(nb,B).sum(axis=1,dtype=np.int64)
+            self.blockChi  += float(np.sum((ones/B - 0.5)**2))
+            self.numBlocks += nb
+        if s+nb*B < len(bits):
+            self.partialOnes += int(np.count_nonzero(bits[s+nb*B:]))
+            self.partialLen  += len(bits)-s-nb*B
+
+        # Bytes, completing the previous partial byte first
+        if len(self.partialByte)>0:
+            bits = np.concatenate((self.partialByte,bits))
+        nBytes = len(bits)//8
+        self.partialByte = bits[nBytes*8:].copy()
+        if nBytes>0:
+            self._addBytes(np.packbits(bits[:nBytes*8]))
+
+
+    def updateBytes(self,data):
+        """
+        Add a chunk of bytes (bytes, a memoryview or a uint8 array) to the statistics, where
+        each byte is 8 bits with the most significant bit first.
+        """
+
+        if not isinstance(data,np.ndarray):
+            data = np.frombuffer(data,dtype=np.uint8)
+        self.update(np.unpackbits(data))
+
+
+    def _addBytes(self,B):
+        """
+        Add whole bytes to the byte histogram and serial correlation sums.
+        """
+
+        self.byteCounts += np.bincount(B,minlength=256)
+        X = B.astype(np.int64)
+        self.sumXY += int(np.dot(X[1:],X[:-1]))
+        if self.lastByte is not None:
+            self.sumXY += self.lastByte*int(X[0])
+        if self.firstByte is None:
+            self.firstByte = int(X[0])
+        self.lastByte = int(X[-1])
+
+
+    def merge(self,other):
+        """
+        Merge the statistics of other into this accumulator, where the stream of other directly
+        follows the stream of this accumulator.
+
+        This stream must be a whole number of bytes long. The streams are joined exactly if this
+        stream is also a whole number of blocks long, e.g. when each worker is given a multiple
+        of blockSize/8 bytes, otherwise the incomplete final block of this stream is dropped
+        from the block frequency test.
+        """
+
+        if other.blockSize != self.blockSize:
+            EXIT("Cannot merge statistics with different block sizes")
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.__dict__.update({k:(v.copy() if isinstance(v,np.ndarray) else v)\
+                                  for k,v in other.__dict__.items()})
+            return
+        if len(self.partialByte)>0:
+            EXIT("Statistics can only be merged at a byte boundary")
+
+        self.n  += other.n
+        self.n1 += other.n1
+
+        self.transitions += other.transitions
+        if self.lastBit != other.firstBit:
+            self.transitions += 1
+        self.lastBit = other.lastBit
+
+        self.byteCounts += other.byteCounts
+        self.sumXY += other.sumXY
+        if other.firstByte is not None:
+            self.sumXY += self.lastByte*other.firstByte
+            self.lastByte = other.lastByte
+        self.partialByte = other.partialByte.copy()
+
+        self.blockChi   += other.blockChi
+        self.numBlocks  += other.numBlocks
+        self.partialOnes = other.partialOnes
+        self.partialLen  = other.partialLen
+
+
+    def report(self):
+        """
+        Return a dictionary of the statistics (and p-values) of the stream so far.
+        """
+
+        if self.n == 0:
+            EXIT("No bits added, so no statistics to report")
+
+        R = {}
+        R["bits"]         = self.n
+        R["bit entropy"]  = entropy([self.n-self.n1,self.n1])
+        R["byte entropy"] = entropy(self.byteCounts)
+
+        # Monobit test
+        S = abs(2*self.n1-self.n)/math.sqrt(self.n)
+        R["monobit"]   = S
+        R["monobit p"] = math.erfc(S/math.sqrt(2))
+
+        # Runs test, which is only applicable if the monobit test passes [1, 2.3.4]
+        pi = self.n1/self.n
+        R["runs"] = self.transitions+1
+        if abs(pi-0.5) >= 2/math.sqrt(self.n):
+            R["runs p"] = 0.0
+        else:
+            R["runs p"] = math.erfc(abs(R["runs"]-2*self.n*pi*(1-pi))\
+                                    /(2*math.sqrt(2*self.n)*pi*(1-pi)))
+
+        # Block frequency test
+        if self.numBlocks>0:
+            chi2 = 4*self.blockSize*self.blockChi
+            R["block frequency"]   = chi2
+            R["block frequency p"] = gammq(self.numBlocks/2,chi2/2)
+
+        # Serial correlation of consecutive bytes
+        nB = int(self.byteCounts.sum())
+        if nB>1:
+            vals = np.arange(256,dtype=np.float64)
+            s1 = float(np.dot(self.byteCounts,vals))
+            s2 = float(np.dot(self.byteCounts,vals*vals))
+            den = nB*s2 - s1*s1
+            R["serial correlation"] = (nB*self.sumXY - s1*s1)/den if den != 0 else 1.0
+
+        return R
+
+
+def printStatsReport(R,name=""):
+    """
+    Print the dictionary returned by randStats.report.
+    """
+
+    if name:
+        print("Randomness statistics for "+name)
+    print("    = bits               : "+str(R["bits"]))
+    print("    = bit entropy        : "+str('%.6f'%R["bit entropy"])+" (random : 1)")
+    print("    = byte entropy       : "+str('%.6f'%R["byte entropy"])+" (random : 8)")
+    print("    = monobit            : "+str('%.4f'%R["monobit"])+"   p = "+str('%.4f'%R["monobit p"]))
+    print("    = runs               : "+str(R["runs"])+"   p = "+str('%.4f'%R["runs p"]))
+    if "block frequency" in R:
+        print("    = block frequency    : "+str('%.4f'%R["block frequency"])\
+              +"   p = "+str('%.4f'%R["block frequency p"]))
+    if "serial correlation" in R:
+        print("    = serial correlation : "+str('%.6f'%R["serial correlation"])+" (random : 0)")
+
+
+def fileStats(filename,start=0,length=None,blockSize=128,chunk=1048576):
+    """
+    Accumulate randStats for a file, streaming the file chunk bytes at a time.
+
+    PNG images are decoded (and the statistics found for the image bits as read by
+    readBWImage2BinArr), and for packed containers the statistics are found for the cells
+    only (not the header or step hints). Any other file is treated as raw bytes. For raw bytes
+    only length bytes from byte start are used (to the end of the file if length is None),
+    such that pieces of a large file can be processed by separate workers and merged.
+
+    The memory used is independent of the size of a raw file or packed container. A png image
+    cannot be decoded a part at a time, so the decoded image (one or two bytes per value) is
+    held whole, and only its bits are streamed chunk bytes (of values) at a time.
+    """
+
+    S = randStats(blockSize=blockSize)
+    if filename.lower().endswith(".png"):
+        if not os.path.exists(filename):
+            EXIT("File for statistics '"+filename+"' does not exist")
+        with Image.open(filename) as im:
+            I = imageArray(im,"Image "+filename)
+        rows = max(1,chunk//max(1,I[0].nbytes)) if len(I)>0 else 1
+        for a in range(0,len(I),rows):
+            S.update(image2BinArr(I[a:a+rows]))
+        return S
+
+    if isPackedCipher(filename):
+        with open(filename,"rb") as f:
+            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as M:
+                s, length = readPackedHeader(M,filename)[5:]
+            f.seek(s)
+            remaining = length//8
+            while remaining>0:
+                data = f.read(min(chunk,remaining))
+                S.updateBytes(data)
+                remaining -= len(data)
+            # The cells of a final partial byte
+            if length%8 != 0:
+                S.update(np.unpackbits(np.frombuffer(f.read(1),dtype=np.uint8),count=length%8))
+        return S
+
+    with open(filename,"rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining>0:
+            n = chunk if remaining is None else min(chunk,remaining)
+            data = f.read(n)
+            if not data:
+                break
+            S.updateBytes(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return S
+
+
+def _fileStatsPiece(piece):
+    return fileStats(*piece)
+
+
+def parallelFileStats(filenames,workers=1,blockSize=128,pieceSize=67108864):
+    """
+    Find the randStats of the concatenation of a list of files, splitting raw files into
+    pieces of pieceSize bytes processed in parallel by a pool of workers and then merged in
+    order. PNG images and packed containers are each a single piece.
+    """
+
+    import os
+    from multiprocessing import Pool
+
+    # Pieces must be a whole number of blocks long to be merged exactly
+    step = max(1,blockSize//math.gcd(blockSize,8))
+    pieceSize = max(step,(pieceSize//step)*step)
+
+    pieces = []
+    for fn in filenames:
+        if not os.path.exists(fn):
+            EXIT("File for statistics '"+fn+"' does not exist")
+        if fn.lower().endswith(".png") or isPackedCipher(fn):
+            pieces.append((fn,0,None,blockSize))
+        else:
+            size = os.path.getsize(fn)
+            for s in range(0,max(size,1),pieceSize):
+                pieces.append((fn,s,pieceSize,blockSize))
+
+    if workers>1:
+        with Pool(workers) as P:
+            results = P.map(_fileStatsPiece,pieces)
+    else:
+        results = map(_fileStatsPiece,pieces)
+
+    S = randStats(blockSize=blockSize)
+    for R in results:
+        S.merge(R)
+    return S
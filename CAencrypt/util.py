@@ -1,7 +1,9 @@
 import sys
+import signal
 import numpy as np
 import os.path
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
 
 
 def EXIT(msg):
@@ -37,7 +39,44 @@ def padLeftZeros(toPad,Size):
     return ("0" * (Size-len(toPad))) + toPad
 
 
-def xorArrays(A1,A2):
+def asBinArr(A,name="Array",copy=False):
+    """
+    Validate that A contains only binary values and return it as a 1D uint8 array.
+
+    This is the single point at which binary arrays are validated when they enter the CA,
+    all internal stages then pass around the returned (trusted) uint8 arrays without
+    re-checking or converting them. If A is already a 1D uint8 array (e.g. from
+    readBWImage2BinArr) and copy is False then A itself is returned without a copy.
+
+    INPUTS
+    ======
+    A
+        The array (or list) to validate.
+    name
+        The name of the array, used in the error message if A is not binary.
+    copy
+        If True always return a new array, rather than possibly A itself.
+
+    RETURNS
+    =======
+    binary array
+        A 1D uint8 array containing the values of A.
+    """
+
+    A = np.asarray(A)
+    if A.ndim != 1:
+        A = A.reshape(-1)
+    if len(A)>0:
+        if A.dtype != np.bool_ and np.amax(A)>1:
+            EXIT(name+" should be binary, contains values > 1.")
+        if A.dtype.kind in "if" and np.amin(A)<0:
+            EXIT(name+" should be binary, contains values < 0.")
+    if copy:
+        return np.array(A,dtype=np.uint8)
+    return A.astype(np.uint8,copy=False)
+
+
+def xorArrays(A1,A2,out=None):
     """
     XOR two arrays of equal length that we assume contain only binary values.
 
@@ -46,36 +85,36 @@ def xorArrays(A1,A2):
     A1, A2
         The two arrays to XOR together. They must both be of the same length and only contain
         binary values (as integers).
+    out
+        Optional array to write the result to, which may be A1 itself to XOR in place. 
 
     RETURNS
     =======
     XORed array
-        An array of binary values containing the result of XORing A1 and A2.
+        A uint8 array of binary values containing the result of XORing A1 and A2.
     """
 
     # First make sure the arrays are of equal length
     if len(A1) != len(A2):
         EXIT("Arrays to XOR not of equal length")
 
-    # Then XOR the input arrays
-    XORed = []
-    for i in range(len(A1)):
-        if (A1[i]==1 or A1[i]==0) and (A2[i]==1 or A2[i]==0):
-            XORed.append(A1[i]^A2[i])
-        else:
-            EXIT("Arrays to XOR contain non-binary value")
-
-    return np.array(XORed,dtype=int)
+    # Then XOR the input arrays, checking the inputs are binary
+    A1 = asBinArr(A1,"Arrays to XOR")
+    A2 = asBinArr(A2,"Arrays to XOR")
+    return np.bitwise_xor(A1,A2,out=out)
 
 
 def binaryShannonEntroypy(binArr):
-    """
+    r"""
     Calcualte the binary Shannon entropy (S) from an array of binary values in {0,1}.
     Also calcualte the metric entropy (M in [0,1]), which is the Shannon entropy divided by 
     the length of the array.
 
     We want, for a completely random array, the metric entropy to be as close to 1 as possible.
 
+    For a fuller set of statistics on (possibly very large) streams of bits see randStats in
+    CAencrypt.stats.
+
     Shannon entropy is calculated with:
     
         $$$   S = - \sum_{i=0}^{1} p(i)log_{2}(p(i))   $$$
@@ -104,19 +143,21 @@ def binaryShannonEntroypy(binArr):
         The Shannon entroppy divided by the length of the input array.
     """
 
-    # Convert the input array to a numpy array, just to make sure it's in that form
-    B = np.array(binArr,dtype=int)
-
-    # Check that the array only contains the values 0 and 1
-    if np.amax(B)>1 or np.amin(B)<0:
-        EXIT("binary Shannon entropy calcualtion can only take in array containing binary values")
+    # Convert the input array to a numpy array, checking it only contains the values 0 and 1
+    B = asBinArr(binArr,"binary Shannon entropy input")
+    if len(B) == 0:
+        EXIT("binary Shannon entropy calcualtion needs a non-empty array")
 
     # Then calculate the p(0) and p(1) values
-    p0 = np.count_nonzero(B==0) / len(B)
-    p1 = np.count_nonzero(B==1) / len(B)
+    p1 = np.count_nonzero(B) / len(B)
+    p0 = 1 - p1
 
-    # Then calculate the Shannon entropy
-    S = - ( (p0*np.log2(p0)) + (p1*np.log2(p1)) )
+    # Then calculate the Shannon entropy, where a value that never occurs contributes zero
+    # (as p log(p) -> 0 as p -> 0)
+    S = 0.0
+    for p in (p0,p1):
+        if p>0:
+            S -= p*np.log2(p)
 
     # And the metric entropy
     M = S / len(B)
@@ -124,69 +165,165 @@ def binaryShannonEntroypy(binArr):
     return S, M
     
 
+def imageArray(im,name="Image"):
+    """
+    Return the values of a PIL image as a uint8 or uint16 array of shape (height,width) for a
+    single channel image, or (height,width,channels) for a multi-channel image (e.g. RGB or
+    RGBA).
+
+    16 bit modes (e.g. "I;16", or "I" as used for 16 bit pngs) give uint16 arrays, all other
+    modes uint8 arrays. Palette images are converted to RGB (or RGBA if they have transparency),
+    as the palette itself is not encrypted.
+    """
+
+    if im.mode in ("P","PA"):
+        im = im.convert("RGBA" if im.mode == "PA" or "transparency" in im.info else "RGB")
+    I = np.asarray(im)
+
+    if im.mode.startswith("I"):
+        if I.size>0 and (np.amax(I)>65535 or np.amin(I)<0):
+            EXIT(name+" contains pixel values outside [0,65535]")
+        return I.astype(np.uint16,copy=False)
+    if I.dtype != np.uint8:
+        if I.size>0 and (np.amax(I)>255 or np.amin(I)<0):
+            EXIT(name+" contains pixel values outside [0,255]")
+        I = I.astype(np.uint8)
+    return I
+
+
+def image2BinArr(I):
+    """
+    Convert a uint8 or uint16 array of values (see imageArray) to a 1D binary array, each value
+    becoming 8 or 16 bits with the most significant bit first. The conversion is done on the
+    whole array at once, a uint16 array being viewed as big endian bytes.
+    """
+
+    if I.dtype == np.uint16:
+        I = I.astype(">u2").view(np.uint8)
+    elif I.dtype != np.uint8:
+        EXIT("Array of values to convert to a binary array must be uint8 or uint16")
+    return np.unpackbits(I.reshape(-1))
+
+
+def packed2Image(IA,dim):
+    """
+    Convert a binary array packed 8 cells per byte (uint8) to the array of values of dimensions
+    dim. The values are uint16 if IA holds 2 bytes per value, else uint8 (where as before the
+    array is resized to dim if it is not 1 byte per value).
+    """
+
+    if len(IA) == 2*int(np.prod(dim)):
+        return IA.view(">u2").astype(np.uint16).reshape(dim)
+    return np.array(np.resize(IA,dim),dtype=np.uint8)
+
+
+def binArr2Image(binArr,dim):
+    """
+    Convert a 1D binary array whose length is divisable by 8 back to the array of values of
+    dimensions dim, the inverse of image2BinArr, see packed2Image.
+    """
+
+    return packed2Image(np.packbits(np.asarray(binArr,dtype=np.uint8)),dim)
+
+
 def readBWImage2BinArr(filename):
     """
-    Read a black and white image to a binary array.
+    Read an image to a binary array.
 
-    This is done by first converting each pixel in the image into an integer in [0,255].
+    This is done by first reading the value of each channel of each pixel in the image, as an
+    integer in [0,255] (or [0,65535] for 16 bit images), see imageArray.
 
-    We then convert each value in the array into an array of 8 binary values and flatten all
-    these arrays.
+    We then convert each value in the array into an array of 8 (or 16) binary values and
+    flatten all these arrays, see image2BinArr. The channels of each pixel are kept together,
+    in the order they are stored.
 
     E.g. if the input is a 50 x 50 pixel black and white image will be converted into a 1D array
          of 2500 values in [0,255]. Each element is then converted into an array of 8 bits which
-         results in an array of 20000 bits.
+         results in an array of 20000 bits. A 50 x 50 pixel RGB image gives 60000 bits, and a
+         16 bit greyscale image 40000 bits.
 
     INPUTS
     ======
     filename
-        The filename of the image to read. The image must be greyscale.
+        The filename of the image to read. The image may be greyscale, greyscale with alpha, RGB
+        or RGBA with 8 bits per channel, or greyscale with 16 bits.
 
     RETURNS
     =======
     image array
-        A 1D binary array containing the image data. Each pixel is converted to an 8 bit binary integer.
+        A 1D binary (uint8) array containing the image data. Each value is converted to an 8 (or
+        16) bit binary integer.
     
     dims
-        The dimensions of the file that is read.
+        The dimensions of the file that is read, (height,width) or (height,width,channels). The
+        number of bits per value is the length of the array over the product of dims.
     """
 
     if not os.path.exists(filename):
         EXIT("File to read as binary array, "+filename+", does not exist")
 
     # Load the image in as an array
-    I = Image.open(filename)
-    I = np.array(I,dtype=int)
-    dims = I.shape
-    I = I.flatten()
+    with Image.open(filename) as im:
+        I = imageArray(im,"Image "+filename)
+
+    # Then convert each element to bits, the most significant bit first
+    return image2BinArr(I), I.shape
+
+
+def bytes2BinArr(data):
+    """
+    Convert bytes to a binary array, each byte becoming 8 bits with the most significant bit
+    first (as for the pixels in readBWImage2BinArr).
+
+    INPUTS
+    ======
+    data
+        The bytes to convert, as bytes, a bytearray, a memoryview or a numpy uint8 array.
 
-    # Then convert each element to a binary array
-    BA = []
-    for b in range(len(I)):
-        bitString = padLeftZeros(bin(I[b])[2:],8)
-        for j in range(8):
-            BA.append(int(bitString[j]))
+    RETURNS
+    =======
+    binary array
+        A 1D uint8 array of 8 times the length of data.
+    """
+
+    if isinstance(data,np.ndarray):
+        if data.dtype != np.uint8:
+            EXIT("Array of bytes to convert to a binary array must be uint8")
+        return np.unpackbits(data.reshape(-1))
+    return np.unpackbits(np.frombuffer(data,dtype=np.uint8))
+
+
+def binArr2Bytes(binArr):
+    """
+    Convert a binary array whose length is divisable by 8 to bytes, the inverse of bytes2BinArr.
+    """
 
-    return np.array(BA,dtype=int), dims
+    if len(binArr)%8 != 0:
+        EXIT("Length of array to convert to bytes must be divisable by 8")
+    return np.packbits(np.asarray(binArr,dtype=np.uint8)).tobytes()
 
 
-def saveBinArr2BWImage(filename,binArr,dim):
+def saveBinArr2BWImage(filename,binArr,dim,meta=None):
     """
-    Take a binary array and save as a black and white png image.
+    Take a binary array and save as a png image.
 
-    Each 8 bits of the binary array correspond to a pixel value in [0,255].
+    Each 8 bits of the binary array correspond to a pixel value in [0,255], or each 16 bits to
+    a value in [0,65535] if the array has 16 bits for each value in dim, see binArr2Image.
     This is then rearranged to the dimensions given in dim and then saved to
     the output filename.
 
     INPUTS
     ======
     filename
-        The filename to save the image to. Image will be greyscale.
+        The filename to save the image to. Image will be greyscale, or greyscale with alpha,
+        RGB or RGBA if dim has 2, 3 or 4 channels.
     binArr
         A 1d array containing the information about each pixel. Each 8 bits in the array contain
-        the greyscale infromation of a single pixel.
+        the greyscale infromation of a single pixel (or channel of a pixel).
     dim
-        The dimensions of final saved image.
+        The dimensions of final saved image, as returned by readBWImage2BinArr.
+    meta
+        An optional dictionary of strings saved as text chunks in the png, see readImageMeta.
     """
 
     # Check that the input binary array is 1D
@@ -197,27 +334,98 @@ def saveBinArr2BWImage(filename,binArr,dim):
     if len(binArr)%8 != 0:
         EXIT("Length of array to save as a BW image must be divisable by 8")
     
-    # Convert each 8 bit section of the input array 
-    IA = []
-    for b in range(len(binArr)//8):
-
-        # Convert the 8 bit string to a string
-        tmpStr = str(binArr[b*8])
-        tmpStr = tmpStr + str(binArr[(b*8)+1])
-        tmpStr = tmpStr + str(binArr[(b*8)+2])
-        tmpStr = tmpStr + str(binArr[(b*8)+3])
-        tmpStr = tmpStr + str(binArr[(b*8)+4])
-        tmpStr = tmpStr + str(binArr[(b*8)+5])
-        tmpStr = tmpStr + str(binArr[(b*8)+6])
-        tmpStr = tmpStr + str(binArr[(b*8)+7])
-
-        # Append this value to the temporary array
-        IA.append(int(tmpStr,2))
-        
+    # Convert each 8 (or 16) bit section of the input array to an integer, with the first bit
+    # of each section the most significant
+    IA = binArr2Image(binArr,dim)
+    if IA.dtype == np.uint16 and len(dim) != 2:
+        EXIT("16 bit images can only be saved with a single channel")
+    if len(dim) == 3 and dim[2] not in (2,3,4):
+        EXIT("Images can only be saved with 1, 2, 3 or 4 channels")
+
     # Then save this 'image array' to the output file
-    im = Image.fromarray(np.array(np.resize(IA,dim),dtype=np.uint8))
-    im.save(filename)
+    im = Image.fromarray(IA)
+    if meta:
+        info = PngInfo()
+        for name, val in meta.items():
+            info.add_text(name,str(val))
+        im.save(filename,pnginfo=info)
+    else:
+        im.save(filename)
+
+
+def readImageMeta(filename):
+    """
+    Return a dictionary of the text chunks of a png image, as saved by saveBinArr2BWImage.
+    """
+
+    if not os.path.exists(filename):
+        EXIT("Image "+filename+" does not exist")
+
+    with Image.open(filename) as I:
+        return dict(getattr(I,"text",{}))
 
 
         
         
+
+
+# The state shared by the jobs of a worker (e.g. the CA holding the key), set by initWorker
+_workerState = None
+
+
+def resetWorkerSignals():
+    """
+    Restore the default SIGTERM handler and ignore SIGINT in a pool worker process, which
+    would otherwise inherit handlers that only cancel a cancelToken. Workers are stopped by the
+    pool with SIGTERM, and runs are cancelled on SIGINT through the parent process.
+    """
+
+    signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+
+def initWorker(state,pool=False):
+    """
+    Set the state shared by the jobs run in this process, returned by workerState. Used as the
+    initializer of a pool (with pool True, also resetting the signal handlers of the worker
+    process, see resetWorkerSignals), or called directly before running the jobs in this
+    process. The state is sent to each worker once, rather than with every job.
+    """
+
+    global _workerState
+    _workerState = state
+    if pool:
+        resetWorkerSignals()
+
+
+def workerState():
+    """
+    Return the state set by initWorker.
+    """
+
+    return _workerState
+
+
+def runJob(fn,*args):
+    """
+    Run the job fn(*args) in a worker, returning (result, None), or (None, err) with err the
+    message of an EXIT in the job. The error is returned rather than raised so the pool is not
+    left waiting on an exited process, see jobResult.
+    """
+
+    try:
+        return fn(*args), None
+    except SystemExit as e:
+        return None, str(e.code)
+
+
+def jobResult(res,context=""):
+    """
+    Return the result of a job run with runJob, exiting with its error (already formatted by
+    EXIT in the worker, followed by context) if it failed.
+    """
+
+    out, err = res
+    if err is not None:
+        sys.exit(err+context)
+    return out
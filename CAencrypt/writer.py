@@ -0,0 +1,136 @@
+import threading
+import queue
+import numpy as np
+
+from CAencrypt.util import *
+
+
+class snapshotWriter:
+    """
+    A bounded background writer for the per-step snapshots taken in verbose-save mode.
+
+    Each snapshot is packed into bytes (8 cells per byte) on the calling thread, which is
+    a cheap bulk copy, and then placed on a bounded queue. A single worker thread takes
+    each packed snapshot from the queue and encodes/writes it to disk, such that the CA
+    steps do not wait on PNG encoding or disk writes. If the queue is full the calling
+    thread blocks until there is space, so memory use is bounded by maxQueue snapshots.
+
+    SNAPSHOT FORMATS
+    ================
+
+    png:
+        A png image, identical to the output of saveBinArr2BWImage.
+
+    packed:
+        The raw packed bits of the CA state, 8 cells per byte (most significant bit first)
+        written with no header. This avoids the zlib compression of png encoding.
+
+    npy:
+        The packed bits saved as a numpy .npy file, which also records the array length.
+
+    USAGE
+    =====
+
+        W = snapshotWriter(fmt="packed")
+        for i in range(numSteps):
+            C.singleCAstepReverseL()
+            W.submit("enc"+str(i+1)+W.ext,C.CAts,dims)
+        W.close()
+    """
+
+    formats = {"png":".png", "packed":".bin", "npy":".npy"}
+
+    def __init__(self,fmt="png",maxQueue=4):
+
+        if fmt not in self.formats:
+            EXIT("Unknown snapshot format '"+str(fmt)+"', use one of "+", ".join(self.formats))
+        if not isinstance(maxQueue, int) or maxQueue<1:
+            EXIT("Snapshot queue size must be a positive integer")
+
+        # The snapshot format and the file extension for that format
+        self.fmt = fmt
+        self.ext = self.formats[fmt]
+
+        # The bounded queue of snapshots waiting to be written
+        self.queue = queue.Queue(maxsize=maxQueue)
+
+        # Any error raised by the worker thread, re-raised on the calling thread
+        self.error = None
+
+        # The number of snapshots written so far
+        self.numWritten = 0
+
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+
+
+    def submit(self,filename,binArr,dim):
+        """
+        Queue a snapshot of the binary array binArr to be written to filename.
+
+        The array is packed (and so copied) before this returns, so the caller is free to
+        overwrite binArr as soon as submit returns.
+
+        INPUTS
+        ======
+        filename
+            The filename to write the snapshot to.
+        binArr
+            A 1D array of binary values, the CA state to save.
+        dim
+            The dimensions of the image the state corresponds to (only used for png).
+        """
+
+        if self.error is not None:
+            self._raise()
+
+        binArr = np.asarray(binArr)
+        if len(binArr.shape) != 1:
+            EXIT("Array to snapshot must be 1D")
+
+        # Pack the state, this both copies the state and reduces the size of the copy by 8
+        self.queue.put((filename,np.packbits(binArr),len(binArr),dim))
+
+
+    def close(self):
+        """
+        Wait for all the queued snapshots to be written and stop the worker thread.
+        """
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            self._raise()
+
+
+    def _raise(self):
+        EXIT("Failed to write snapshot : "+str(self.error))
+
+
+    def _run(self):
+        """
+        The worker thread, writing each queued snapshot until a None is taken from the queue.
+        """
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # After an error keep draining the queue so submit never blocks forever
+            if self.error is not None:
+                continue
+            filename, packed, length, dim = item
+            try:
+                if self.fmt == "png":
+                    if length%8 != 0:
+                        raise ValueError("length of array to save as a png must be divisable by 8")
+                    im = Image.fromarray(packed2Image(packed,dim))
+                    im.save(filename)
+                elif self.fmt == "packed":
+                    with open(filename,"wb") as f:
+                        f.write(packed.tobytes())
+                else:
+                    np.save(filename,packed)
+                self.numWritten += 1
+            except Exception as e:
+                self.error = e
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Run the tests against the CAencrypt package of this checkout
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
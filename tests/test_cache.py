@@ -0,0 +1,31 @@
+import random as r
+import numpy as np
+
+from CAencrypt.enc import *
+from CAencrypt.cache import *
+
+
+def planarCA():
+    r.seed(5)
+    C = CA(k=7,numSteps=2)
+    C.genRulesLeftReversible()
+    C.setChannelLayout("planar")
+    C.setNoiseSeed(1234)
+    return C
+
+
+def test_digest_covers_dims(tmp_path):
+    C = planarCA()
+    cache = resultCache(str(tmp_path/"cache"),2**20)
+    bits = np.random.default_rng(1).integers(0,2,8*4*6*3,dtype=np.uint8)
+
+    # The same bits as an RGB image and as a greyscale image of three times the width
+    rgb  = cache.digest(C,"enc",bits,(4,6,3))
+    grey = cache.digest(C,"enc",bits,(4,18))
+    assert rgb != grey
+    assert rgb == cache.digest(C,"enc",bits,(4,6,3))
+
+    cache.put(rgb,bits,(4,6,3))
+    assert cache.get(rgb) is not None
+    assert cache.get(grey) is None
+    assert cache.counts["hits"] == 1 and cache.counts["misses"] == 1
@@ -0,0 +1,31 @@
+import random as r
+import numpy as np
+import pytest
+
+from CAencrypt.enc import *
+from CAencrypt.compiled import *
+
+
+def keyCA(encDir="reverse"):
+    r.seed(7)
+    C = CA(k=7,numSteps=3)
+    C.genRulesLeftReversible()
+    C.setEncDir(encDir)
+    return C
+
+
+@pytest.mark.parametrize("encDir",["reverse","forward"])
+@pytest.mark.parametrize("seed",[12345,2**32+12345,2**40+7])
+def test_compiled_matches_CA(encDir,seed):
+    C = keyCA(encDir)
+    K = compiledKey(C)
+    bits = np.random.default_rng(3).integers(0,2,2000,dtype=np.uint8)
+
+    C.setNoiseSeed(seed)
+    ref = C.encryptArr(bits).copy()
+    refHints = C.getMaskedHints() if encDir == "forward" else None
+
+    out, hints = encryptWithKey(K,bits,seed)
+    assert (out == ref).all()
+    assert hints == refHints
+    assert (decryptWithKey(K,out,seed,hints=hints) == bits).all()
@@ -0,0 +1,42 @@
+import os
+import random as r
+import numpy as np
+import pytest
+
+from CAencrypt.enc import *
+from CAencrypt.container import *
+from CAencrypt.rekey import *
+
+
+def keyCA(seed,noiseSeed):
+    r.seed(seed)
+    C = CA(k=5,numSteps=2)
+    C.genRulesLeftReversible()
+    C.setNoiseSeed(noiseSeed)
+    return C
+
+
+def test_rekeyFiles(tmp_path):
+    old, new = keyCA(1,11), keyCA(2,22)
+    bits = np.random.default_rng(1).integers(0,2,8*4*5,dtype=np.uint8)
+    fn = str(tmp_path/"a.cab")
+    savePackedCipher(fn,old.encryptArr(bits),(4,5),old.k,old.numSteps)
+
+    outDir = str(tmp_path/"out")
+    res = list(rekeyFiles(old,new,[fn],outDir))
+    assert res == [(fn,os.path.join(outDir,"a.cab"))]
+    assert (new.decryptArr(readPackedCipher(res[0][1])[0]) == bits).all()
+
+
+def test_rekeyFiles_output_name_clash(tmp_path):
+    old, new = keyCA(1,11), keyCA(2,22)
+    bits = np.random.default_rng(1).integers(0,2,8*4*5,dtype=np.uint8)
+    enc = old.encryptArr(bits)
+    savePackedCipher(str(tmp_path/"a.cab"),enc,(4,5),old.k,old.numSteps)
+    saveCipherOutput(str(tmp_path/"a.png"),enc,(4,5),"png")
+
+    # Both are saved as out/a.cab with packed output
+    outDir = str(tmp_path/"out")
+    with pytest.raises(SystemExit):
+        list(rekeyFiles(old,new,[str(tmp_path/"a.png"),str(tmp_path/"a.cab")],outDir,"packed"))
+    assert not os.path.exists(outDir)
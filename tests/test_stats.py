@@ -0,0 +1,48 @@
+import numpy as np
+
+from CAencrypt.stats import *
+from CAencrypt.container import *
+
+
+def randomBytes(n,seed=1):
+    return np.random.default_rng(seed).integers(0,256,n,dtype=np.uint8).tobytes()
+
+
+def test_fileStats_raw(tmp_path):
+    data = randomBytes(5000)
+    fn = str(tmp_path/"raw.bin")
+    with open(fn,"wb") as f:
+        f.write(data)
+
+    S = randStats()
+    S.updateBytes(data)
+    assert fileStats(fn,chunk=777).report() == S.report()
+
+    # Only the given piece of the file
+    S = randStats()
+    S.updateBytes(data[1024:3072])
+    assert fileStats(fn,start=1024,length=2048).report() == S.report()
+
+
+def test_parallelFileStats_raw_pieces(tmp_path):
+    data = randomBytes(10000)
+    fn = str(tmp_path/"raw.bin")
+    with open(fn,"wb") as f:
+        f.write(data)
+
+    S = randStats()
+    S.updateBytes(data)
+    for workers in (1,2):
+        R = parallelFileStats([fn],workers=workers,pieceSize=1600).report()
+        assert R == S.report()
+
+
+def test_fileStats_packed_container(tmp_path):
+    bits = np.unpackbits(np.frombuffer(randomBytes(600),dtype=np.uint8))
+    fn = str(tmp_path/"c.cab")
+    savePackedCipher(fn,bits,(20,30),7,3,hints=[1,2,3])
+
+    S = randStats()
+    S.update(bits)
+    assert fileStats(fn,chunk=100).report() == S.report()
+    assert parallelFileStats([fn],pieceSize=16).report() == S.report()